@@ -0,0 +1,66 @@
+import math
+import random
+
+# Synthetic policies and traffic for the benchmarks, generated from a seed so every run sees the same data.
+
+TLDS = ('com', 'net', 'org', 'io', 'co.il', 'de')
+CONTENT_TYPES = ('text/html; charset=utf-8', 'application/javascript', 'text/css', 'image/png',
+                 'image/webp', 'application/json', 'video/mp4', 'application/octet-stream')
+CONTENT_RULES = (['text', 'image/*'], ['text/html', 'application/json'], ['image', 'video'],
+                 ['text', 'application/javascript', 'image/*'])
+# Host distributions of the generated traffic
+UNIFORM = 'uniform'
+ZIPF = 'zipf'
+DISTRIBUTIONS = (UNIFORM, ZIPF)
+
+
+def domain_name(index: int) -> str:
+    return f"site{index}.{TLDS[index % len(TLDS)]}"
+
+
+def approved_domains(count: int) -> list:
+    """Rows of the approved_domains table, a mix of subtree, exact ("=") and wildcard ("*.") rules."""
+    rules = []
+    for index in range(count):
+        prefix = '=' if index % 10 == 8 else '*.' if index % 10 == 9 else ''
+        rules.append({'domain': prefix + domain_name(index)})
+    return rules
+
+
+def content_rules(count: int, domains_count: int) -> list:
+    """Rows of the contents table for the first approved domains."""
+    return [{'domain_name': domain_name(index), 'content': CONTENT_RULES[index % len(CONTENT_RULES)]}
+            for index in range(min(count, domains_count))]
+
+
+def traffic(count: int, domains_count: int, distribution=ZIPF, blocked_ratio=0.1, hosts_count=10000, seed=1):
+    """
+    Generate (host, response content type) pairs.
+    The hosts are drawn from a pool of hosts_count distinct hosts: subdomains of the approved domains and,
+    for blocked_ratio of the pool, domains outside the list. Zipf traffic hits a few hosts most of the time.
+    """
+    rng = random.Random(seed)
+    hosts = []
+    for index in range(max(hosts_count, 1)):
+        if rng.random() < blocked_ratio or domains_count == 0:
+            hosts.append(f"www.blocked{index}.example")
+        else:
+            domain_index = rng.randrange(domains_count)
+            # Exact rules only allow the domain itself, wildcard rules only its subdomains
+            subdomain = '' if domain_index % 10 == 8 else rng.choice(('www.', 'cdn.', 'api.v2.'))
+            hosts.append(subdomain + domain_name(domain_index))
+
+    if distribution == ZIPF:
+        weights = [1 / rank for rank in range(1, len(hosts) + 1)]
+        picked = rng.choices(hosts, weights, k=count)
+    else:
+        picked = [rng.choice(hosts) for _ in range(count)]
+    return [(host, rng.choice(CONTENT_TYPES)) for host in picked]
+
+
+def percentile(sorted_values, fraction):
+    """The nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return 0.0
+    rank = max(math.ceil(fraction * len(sorted_values)), 1)
+    return sorted_values[rank - 1]
@@ -0,0 +1,87 @@
+from core.iflow import IFlow
+
+# A lightweight IFlow for driving the plugin pipelines without mitmproxy.
+# It keeps only what the plugins read and write: the host, the request line and headers,
+# and the response, so the benchmark measures the plugins rather than the flow objects.
+
+
+class FakeRequest:
+    __slots__ = ('host', 'path', 'method', 'headers', 'cookies', 'content')
+
+    def __init__(self, host, path='/', method='GET', headers=None, content=b''):
+        self.host = host
+        self.path = path
+        self.method = method
+        self.headers = headers or {}
+        self.cookies = {}
+        self.content = content
+
+
+class FakeResponse:
+    __slots__ = ('status_code', 'headers', 'content', 'stream')
+
+    def __init__(self, status_code, content=b'', headers=None):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers or {}
+        self.stream = False
+
+
+class FakeFlow(IFlow):
+    def __init__(self, host, path='/', method='GET', client_ip='127.0.0.1', connection_id=0, proxy_user=None):
+        self.request = FakeRequest(host, path, method)
+        self.response = None
+        self.killed = False
+        self.client_ip = client_ip
+        self.connection_id = connection_id
+        self.proxy_user = proxy_user
+
+    def get_host(self):
+        return self.request.host
+
+    def get_request(self):
+        return self.request
+
+    def get_client_ip(self):
+        return self.client_ip
+
+    def get_connection_id(self):
+        return self.connection_id
+
+    def get_proxy_user(self):
+        return self.proxy_user
+
+    def get_response(self):
+        return self.response
+
+    def get_content(self):
+        return self.response.content if self.response is not None else self.request.content
+
+    def set_content(self, content):
+        self.response.content = content
+
+    def kill(self, status=403, txt="Unauthorized request!", ct="text/plain"):
+        self.killed = True
+        self.response = FakeResponse(status, txt, {"Content-Type": ct})
+
+    def make_response(self, status, data, content_type):
+        # Like MitmFlow, content_type holds the response headers, copied so the response can add its own.
+        # A bare content type string is taken as the Content-Type header
+        headers = {"Content-Type": content_type} if isinstance(content_type, str) else dict(content_type)
+        self.response = FakeResponse(status, data, headers)
+
+    def make_response_with_cookie(self, status, data, content_type, key, value):
+        self.make_response(status, data, content_type)
+        self.response.headers["set-cookie"] = key + "=" + value
+
+    def stream_response(self):
+        self.response.stream = True
+
+    def discard_response_body(self):
+        pass
+
+    def get_cookie(self, key):
+        return self.request.cookies.get(key)
+
+    def set_cookie(self, key, value):
+        self.request.cookies[key] = value
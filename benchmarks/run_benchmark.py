@@ -0,0 +1,230 @@
+import argparse
+import asyncio
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+from datetime import datetime, timezone
+from time import perf_counter
+sys.path.insert(0, os.path.abspath(
+    os.path.join(os.path.dirname(__file__), '..')))
+from benchmarks import datasets
+from benchmarks.fake_flow import FakeFlow, FakeResponse
+
+# Throughput benchmark of the plugin pipelines.
+# Every (configuration, allow list size) pair runs in a fresh Python process, since the plugins and the
+# database are singletons configured from the environment: the process writes a generated database,
+# builds the pipelines through PluginsManagement like runner.py does, and pushes the generated flows
+# through request -> response headers -> response with FakeFlow instead of mitmproxy.
+#
+# Usage: python benchmarks/run_benchmark.py [--configs white-list full] [--sizes 10 1000 1000000]
+#        [--flows N] [--distribution zipf|uniform] [--output results.json] [--compare old-results.json]
+#
+# The results are written as JSON (by default into benchmarks/results/) so runs can be compared over time.
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+RESULTS_DIR = os.path.join(ROOT, 'benchmarks', 'results')
+
+# Configuration name -> (request plugins list, response plugins list), as stored in the plugins table
+CONFIGURATIONS = {
+    'white-list': (['White List Plugin'], []),
+    'content-filter': (['White List Plugin'], ['Filter Content']),
+    'full': (['Settings Plugin', 'White List Plugin'], ['Filter Content']),
+}
+DEFAULT_SIZES = [10, 1000, 100000, 1000000]
+
+
+def write_database(configuration, args):
+    """Insert the generated tables through the configured backend, so each backend stores them in its own format."""
+    import dal
+    from core.singleton_pattern import Singleton
+    request_plugins, response_plugins = CONFIGURATIONS[configuration]
+    db = dal.get_db()
+    with db.transaction():
+        db.insert('plugins', {'request_plugins_list': request_plugins})
+        db.insert('plugins', {'response_plugins_list': response_plugins})
+        for row in datasets.approved_domains(args['size']):
+            db.insert('approved_domains', row)
+        for row in datasets.content_rules(args['content_rules'], args['size']):
+            db.insert('contents', row)
+    # The measured startup loads the database from disk, like the proxy does
+    if hasattr(db, 'close'):
+        db.close()
+    Singleton._instances.pop(type(db), None)
+
+
+async def drive(management, flows, warmup):
+    """Run the flows through the pipelines as runner.py does. Return the measured latencies and wall time."""
+    request_pipeline = management.request_pipeline
+    response_pipeline = management.response_pipeline
+    latencies = []
+    measure_start = perf_counter()
+    for index, (host, content_type) in enumerate(flows):
+        if index == warmup:
+            reset_counters()
+            measure_start = perf_counter()
+        flow = FakeFlow(host)
+        start = perf_counter()
+        await request_pipeline.on_request(flow)
+        if flow.response is None:
+            upstream_response = flow.response = FakeResponse(200, b'', {'Content-Type': content_type})
+            await response_pipeline.on_response_headers(flow)
+            if flow.response is upstream_response:
+                await response_pipeline.on_response(flow)
+        latencies.append(perf_counter() - start)
+    return latencies[warmup:], perf_counter() - measure_start
+
+
+def reset_counters():
+    from core import metrics
+    from core.verdict_cache import caches
+    metrics.reset()
+    for cache in caches.values():
+        cache.hits = cache.misses = 0
+
+
+def run_one(args):
+    """Benchmark one configuration in this process, the environment was set by the parent."""
+    configuration = args['configuration']
+    write_database(configuration, args)
+    flows = datasets.traffic(args['flows'] + args['warmup'], args['size'], args['distribution'],
+                             args['blocked_ratio'], args['hosts'], args['seed'])
+
+    from core import metrics
+    from core.verdict_cache import caches
+    from plugins.plugins_management import PluginsManagement
+
+    start = perf_counter()
+    management = PluginsManagement()
+    management.set_plugins_instances()
+    startup_seconds = perf_counter() - start
+    if args['snapshots']:
+        # Measure the memory-mapped snapshots rather than the in-memory tables they replace
+        for plugin in management.request_plugins_instances + management.response_plugins_instances:
+            if getattr(plugin, 'snapshot_writer', None) is not None:
+                plugin.snapshot_writer.wait()
+        management.reload_policy()
+
+    latencies, wall_seconds = asyncio.run(drive(management, flows, args['warmup']))
+    latencies.sort()
+    return {
+        'configuration': configuration,
+        'allow_list_size': args['size'],
+        'content_rules': min(args['content_rules'], args['size']),
+        'distribution': args['distribution'],
+        'flows': len(latencies),
+        'startup_seconds': round(startup_seconds, 4),
+        'flows_per_second': round(len(latencies) / wall_seconds, 1) if wall_seconds else 0,
+        'p50_us': round(datasets.percentile(latencies, 0.5) * 1e6, 2),
+        'p99_us': round(datasets.percentile(latencies, 0.99) * 1e6, 2),
+        'verdicts': {f'{hook}:{verdict}': count for (hook, verdict), count in sorted(metrics.verdicts.items())},
+        'plugins': {
+            f'{stats.plugin}:{stats.hook}': {
+                'calls': stats.calls,
+                'mean_us': round(stats.seconds / stats.calls * 1e6, 2) if stats.calls else 0,
+            } for stats in metrics.hook_stats.values()},
+        'verdict_caches': {
+            name: {'hits': cache.hits, 'misses': cache.misses} for name, cache in caches.items()},
+    }
+
+
+def run_in_subprocess(args, configuration, size):
+    child_args = dict(vars(args), configuration=configuration, size=size)
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(os.environ,
+                   SAFEBROWSE_DB_BACKEND=args.backend,
+                   SAFEBROWSE_DB_PATH=os.path.join(tmp, 'db.json'),
+                   SAFEBROWSE_SQLITE_DB_PATH=os.path.join(tmp, 'db.sqlite3'),
+                   SAFEBROWSE_POLICY_SNAPSHOT_DIR=os.path.join(tmp, 'snapshots') if args.snapshots else '',
+                   SAFEBROWSE_POLICY_POLL_INTERVAL='0')
+        if args.cache_size is not None:
+            env['SAFEBROWSE_VERDICT_CACHE_SIZE'] = str(args.cache_size)
+        process = subprocess.run([sys.executable, os.path.abspath(__file__), '--run-one', json.dumps(child_args)],
+                                 env=env, cwd=tmp, capture_output=True, text=True)
+    if process.returncode != 0:
+        sys.exit(f"The {configuration} benchmark with {size} domains failed:\n{process.stderr}")
+    # The plugins print their startup messages, the result is the last line
+    return json.loads(process.stdout.strip().splitlines()[-1])
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def compare(results, previous_path):
+    """Print the change of throughput and p99 against the matching runs of a previous results file."""
+    with open(previous_path) as f:
+        previous = {(run['configuration'], run['allow_list_size'], run['distribution']): run
+                    for run in json.load(f)['results']}
+    print(f"\nCompared with {previous_path}")
+    for run in results:
+        old = previous.get((run['configuration'], run['allow_list_size'], run['distribution']))
+        if old is None:
+            continue
+        throughput = (run['flows_per_second'] / old['flows_per_second'] - 1) * 100 if old['flows_per_second'] else 0
+        p99 = (run['p99_us'] / old['p99_us'] - 1) * 100 if old['p99_us'] else 0
+        print(f"{run['configuration']:<16}{run['allow_list_size']:>10}  flows/s {throughput:+7.1f}%  p99 {p99:+7.1f}%")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the plugin pipelines with synthetic flows.")
+    parser.add_argument('--configs', nargs='+', choices=list(CONFIGURATIONS), default=list(CONFIGURATIONS))
+    parser.add_argument('--sizes', nargs='+', type=int, default=DEFAULT_SIZES,
+                        help="numbers of approved domains to benchmark")
+    parser.add_argument('--content-rules', type=int, default=1000,
+                        help="number of approved domains with content type rules")
+    parser.add_argument('--flows', type=int, default=100000)
+    parser.add_argument('--warmup', type=int, default=1000, help="flows run before measuring")
+    parser.add_argument('--distribution', choices=datasets.DISTRIBUTIONS, default=datasets.ZIPF)
+    parser.add_argument('--hosts', type=int, default=10000, help="number of distinct hosts in the traffic")
+    parser.add_argument('--blocked-ratio', type=float, default=0.1,
+                        help="fraction of the hosts outside the approved domains")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--backend', choices=('json', 'sqlite', 'tinydb'), default='json')
+    parser.add_argument('--snapshots', action='store_true', help="match against the compiled policy snapshots")
+    parser.add_argument('--cache-size', type=int, help="verdict cache size, 0 disables the caches")
+    parser.add_argument('--output', help="results file, by default benchmarks/results/<time>.json")
+    parser.add_argument('--compare', help="a previous results file to compare with")
+    parser.add_argument('--run-one', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_one:
+        print(json.dumps(run_one(json.loads(args.run_one))))
+        return
+
+    started = datetime.now(timezone.utc)
+    results = []
+    print(f"{'configuration':<16}{'domains':>10}{'flows/s':>12}{'p50 us':>10}{'p99 us':>10}{'startup s':>11}")
+    for configuration in args.configs:
+        for size in args.sizes:
+            run = run_in_subprocess(args, configuration, size)
+            results.append(run)
+            print(f"{configuration:<16}{size:>10}{run['flows_per_second']:>12.0f}{run['p50_us']:>10.1f}"
+                  f"{run['p99_us']:>10.1f}{run['startup_seconds']:>11.3f}")
+
+    output = args.output or os.path.join(RESULTS_DIR, started.strftime('%Y%m%dT%H%M%SZ') + '.json')
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    parameters = {key: value for key, value in vars(args).items() if key not in ('output', 'compare', 'run_one')}
+    with open(output, 'w') as f:
+        json.dump({
+            'started': started.isoformat(),
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'parameters': parameters,
+            'results': results,
+        }, f, indent=4)
+    print(f"Results written to {output}")
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+import os
+
+# Runtime configuration of the proxy.
+# Every value can be overridden with an environment variable of the same name prefixed by "SAFEBROWSE_".
+
+
+def _get(name, default, cast=str):
+    value = os.environ.get('SAFEBROWSE_' + name)
+    return default if value is None else cast(value)
+
+
+# Maximum number of hosts kept in each per-plugin verdict cache (0 disables the cache)
+VERDICT_CACHE_SIZE = _get('VERDICT_CACHE_SIZE', 10000, int)
+# Seconds a cached verdict stays valid, 0 keeps it until the policy changes or it is evicted
+VERDICT_CACHE_TTL = _get('VERDICT_CACHE_TTL', 0, float)
+# Responses with a larger Content-Length are streamed to the client instead of buffered,
+# the on_response hooks of the plugins don't see their body
+STREAM_RESPONSE_MIN_BYTES = _get('STREAM_RESPONSE_MIN_BYTES', 1024 * 1024, int)
+# Stream the responses without a Content-Length (chunked) too, instead of buffering them for the plugins
+STREAM_UNKNOWN_LENGTH_RESPONSES = _get('STREAM_UNKNOWN_LENGTH_RESPONSES', 0, int) == 1
+# Size in bytes of the database journal that triggers its compaction into a fresh snapshot
+DB_JOURNAL_COMPACT_BYTES = _get('DB_JOURNAL_COMPACT_BYTES', 4 * 1024 * 1024, int)
+# Flush every journal record to disk before the write returns
+DB_JOURNAL_FSYNC = _get('DB_JOURNAL_FSYNC', 1, int) == 1
+# Seconds between two writes of the database journal in write-behind mode, mutations made in between
+# are persisted together by a background thread. 0 writes every mutation before it returns
+DB_WRITE_BEHIND_INTERVAL = _get('DB_WRITE_BEHIND_INTERVAL', 0, float)
+# Storage backend of the plugins: "json" (DalDB), "sqlite" (DalSQLite) or "tinydb" (DalTinyDB)
+DB_BACKEND = _get('DB_BACKEND', 'json')
+# The JSON database, also migrated into SQLite the first time the "sqlite" backend starts
+DB_PATH = _get('DB_PATH', 'db.json')
+SQLITE_DB_PATH = _get('SQLITE_DB_PATH', 'db.sqlite3')
+# Threads running the blocking work of async plugin hooks (database writes, password hashing)
+BLOCKING_POOL_SIZE = _get('BLOCKING_POOL_SIZE', 4, int)
+# Directory of the compiled policy snapshots memory-mapped by the plugins ("" disables them)
+POLICY_SNAPSHOT_DIR = _get('POLICY_SNAPSHOT_DIR', 'policy_snapshots')
+# Seconds between two checks for database changes made by other proxy workers (0 disables the checks)
+POLICY_POLL_INTERVAL = _get('POLICY_POLL_INTERVAL', 1.0, float)
+# Import each plugin on its first use instead of at startup, when the plugin manifest can describe it
+LAZY_PLUGINS = _get('LAZY_PLUGINS', 1, int) == 1
+# Cache of the plugin classes, titles and hooks read from the plugins' sources ("" disables the cache file),
+# kept next to the plugins directory it describes whatever the working directory of the proxy
+PLUGIN_MANIFEST_PATH = _get('PLUGIN_MANIFEST_PATH',
+                            os.path.join(os.path.dirname(os.path.abspath(__file__)), 'plugins_manifest.json'))
+# Threads hashing the settings.it passwords, apart from the blocking pool
+PASSWORD_HASH_WORKERS = _get('PASSWORD_HASH_WORKERS', 2, int)
+# Password hashes a single client can have in progress, its further login attempts get a 429
+PASSWORD_HASH_PER_CLIENT = _get('PASSWORD_HASH_PER_CLIENT', 1, int)
+# scrypt cost of the password hashes (a power of 2), stored hashes with another cost are redone on login
+PASSWORD_SCRYPT_N = _get('PASSWORD_SCRYPT_N', 2 ** 14, int)
+# Seconds a settings.it login session stays valid after its last use
+SESSION_TTL = _get('SESSION_TTL', 8 * 60 * 60, float)
+# Maximum number of login sessions kept in memory, the ones closest to expiring are dropped first
+SESSION_MAX = _get('SESSION_MAX', 10000, int)
+# Keep the login sessions in the database, so they survive a restart and are shared by the workers
+SESSION_PERSIST = _get('SESSION_PERSIST', 1, int) == 1
+# Seconds between two checks of a cached settings UI file for changes on disk
+STATIC_ASSETS_CHECK_INTERVAL = _get('STATIC_ASSETS_CHECK_INTERVAL', 2.0, float)
+# Listen for a debugger on DEBUG_PORT and wait for it to attach before serving
+DEBUG = _get('DEBUG', 0, int) == 1
+DEBUG_PORT = _get('DEBUG_PORT', 5678, int)
+# Number of proxy workers started by supervisor.py, 0 starts one per CPU core
+WORKERS = _get('WORKERS', 0, int)
+# First loopback port of the workers started by supervisor.py in relay mode, worker i listens on WORKER_BASE_PORT + i
+WORKER_BASE_PORT = _get('WORKER_BASE_PORT', 18080, int)
+# Set by supervisor.py: listen with SO_REUSEPORT, so all the workers share the public port
+REUSE_PORT = _get('REUSE_PORT', 0, int) == 1
+# Set by supervisor.py in relay mode: every client connects from the supervisor's loopback address,
+# so the client addresses can't tell the clients apart
+BEHIND_RELAY = _get('BEHIND_RELAY', 0, int) == 1
@@ -0,0 +1,74 @@
+import inspect
+from core.iflow import IFlow
+
+# The host of the management UI and its API
+ADMIN_HOST = "settings.it"
+ADMIN_HOSTS = frozenset((ADMIN_HOST, "www." + ADMIN_HOST))
+
+
+def is_admin_host(host: str) -> bool:
+    """Check if the host is the management host, the only check normal traffic pays."""
+    return host in ADMIN_HOSTS
+
+
+def route_path(path: str) -> str:
+    """
+    Normalize a request path into a routing key.
+    The query string is dropped and API calls are keyed from "/api/" on,
+    so relative calls made from nested UI pages reach the same handler.
+    """
+    path = path.split('?', 1)[0]
+    api_start = path.find('/api/')
+    return path[api_start:] if api_start > 0 else path
+
+
+class AdminRouter():
+    """
+    Routing table of the settings.it API keyed by (host, path, method).
+    Plugins register their handlers into it from PluginBase.register_routes.
+    """
+
+    def __init__(self):
+        self.routes = {}
+        self.fallbacks = []
+        # Route registrations of plugins that are not loaded yet, run by the first request no route matches
+        self.lazy_registrations = []
+
+    def add(self, method: str, path: str, handler) -> None:
+        """Register a handler called with the flow for an exact path and method."""
+        self.routes[(ADMIN_HOST, path, method)] = handler
+
+    def add_fallback(self, handler) -> None:
+        """Register a handler tried, in order, when no route matches. It returns True if it handled the flow."""
+        self.fallbacks.append(handler)
+
+    def add_lazy(self, register) -> None:
+        """Defer a plugin's registrations, register(router) is called before the first request no route matches."""
+        self.lazy_registrations.append(register)
+
+    def load_lazy(self) -> None:
+        registrations, self.lazy_registrations = self.lazy_registrations, []
+        for register in registrations:
+            register(self)
+
+    async def dispatch(self, flow: IFlow) -> bool:
+        """Call the handler of the request, awaiting it if it is a coroutine. Return False if nothing handled it."""
+        req = flow.get_request()
+        key = (ADMIN_HOST, route_path(req.path), req.method)
+        handler = self.routes.get(key)
+        if handler is None and self.lazy_registrations:
+            self.load_lazy()
+            handler = self.routes.get(key)
+        if handler is not None:
+            result = handler(flow)
+            if inspect.isawaitable(result):
+                await result
+            return True
+
+        for fallback in self.fallbacks:
+            result = fallback(flow)
+            if inspect.isawaitable(result):
+                result = await result
+            if result:
+                return True
+        return False
@@ -0,0 +1,60 @@
+from collections import deque
+
+# Aho-Corasick automaton: finds every occurrence of a set of strings in a single pass over a text.
+# The strings are stored in a trie whose nodes carry a failure link, the longest proper suffix of the
+# node's string that is also in the trie. Scanning follows the trie and falls back along the failure
+# links on a mismatch, so the text is read once whatever the number of strings.
+# Each node also lists the strings ending there, including the ones reached through its failure links.
+
+
+class AhoCorasick:
+    """An automaton over (string, value) pairs, several pairs may share a string."""
+
+    def __init__(self, keys=()):
+        # Node -> {character: node}, node 0 is the root
+        self.goto = [{}]
+        self.fail = [0]
+        # Node -> ((length, value), ...) of the strings ending at the node
+        self.outputs = [()]
+        for key, value in keys:
+            self._add(key, value)
+        self._link()
+
+    def _add(self, key: str, value):
+        if not key:
+            raise ValueError("Cannot match an empty string")
+        node = 0
+        for char in key:
+            next_node = self.goto[node].get(char)
+            if next_node is None:
+                next_node = len(self.goto)
+                self.goto[node][char] = next_node
+                self.goto.append({})
+                self.fail.append(0)
+                self.outputs.append(())
+            node = next_node
+        self.outputs[node] += ((len(key), value),)
+
+    def _link(self):
+        """Compute the failure links breadth first, a node's link is always shallower than the node."""
+        queue = deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in self.goto[node].items():
+                queue.append(child)
+                fallback = self.fail[node]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[child] = self.goto[fallback].get(char, 0)
+                self.outputs[child] += self.outputs[self.fail[child]]
+
+    def iter_matches(self, text: str):
+        """Yield (start, end, value) of every occurrence in the text, end being exclusive, by end position."""
+        goto, fail, outputs = self.goto, self.fail, self.outputs
+        node = 0
+        for end, char in enumerate(text, 1):
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            for length, value in outputs[node]:
+                yield end - length, end, value
@@ -0,0 +1,131 @@
+# Label-reversed suffix index for domain rules.
+# The domain "a.example.com" is stored as the path com -> example -> a, so a lookup
+# walks the host labels from right to left and costs O(number of labels in the host)
+# no matter how many rules are in the index.
+#
+# Supported rules:
+#   example.com      - the domain itself and all of its subdomains
+#   =example.com     - the exact host only
+#   *.example.com    - subdomains only (wildcard), not example.com itself
+
+EXACT = 1
+SUBTREE = 2
+WILDCARD = 4
+
+
+def normalize_host(host: str) -> str:
+    """Lower-case the host and strip the leading "www." and trailing dot."""
+    host = host.lower().rstrip('.')
+    return host[len("www."):] if host.startswith("www.") else host
+
+
+def iter_suffixes(host: str):
+    """Yield the host and then each parent domain, e.g. "a.b.com", "b.com", "com"."""
+    start = 0
+    while True:
+        yield host[start:]
+        dot = host.find('.', start)
+        if dot < 0:
+            return
+        start = dot + 1
+
+
+def parse_rule(rule: str):
+    """
+    Split a domain rule into its reversed labels and the rule kind flag.
+    Raises ValueError for an empty or malformed rule.
+    """
+    rule = rule.strip().lower()
+    if rule.startswith('='):
+        flag, rule = EXACT, rule[1:]
+    elif rule.startswith('*.'):
+        flag, rule = WILDCARD, rule[2:]
+    else:
+        flag = SUBTREE
+
+    rule = normalize_host(rule)
+    labels = rule.split('.')
+    if not rule or any(not label or label == '*' for label in labels):
+        raise ValueError(f"Invalid domain rule: {rule!r}")
+    return labels[::-1], flag
+
+
+class _Node:
+    __slots__ = ('children', 'flags')
+
+    def __init__(self):
+        self.children = {}
+        self.flags = 0
+
+
+class DomainIndex:
+    def __init__(self, rules=()):
+        self._root = _Node()
+        # Maps every rule as written to its parsed key, and every key to the number
+        # of rules spelling it, so "www.a.com" and "a.com" can be removed independently
+        self._rules = {}
+        self._refs = {}
+        for rule in rules:
+            self.add(rule)
+
+    def __contains__(self, rule: str) -> bool:
+        return rule in self._rules
+
+    def __len__(self) -> int:
+        return len(self._rules)
+
+    def add(self, rule: str) -> None:
+        """Add a rule to the index. Adding an existing rule is a no-op."""
+        if rule in self._rules:
+            return
+        labels, flag = parse_rule(rule)
+        key = (tuple(labels), flag)
+        self._rules[rule] = key
+        self._refs[key] = self._refs.get(key, 0) + 1
+
+        node = self._root
+        for label in labels:
+            child = node.children.get(label)
+            if child is None:
+                child = node.children[label] = _Node()
+            node = child
+        node.flags |= flag
+
+    def remove(self, rule: str) -> None:
+        """Remove a rule from the index and prune the nodes it no longer needs."""
+        key = self._rules.pop(rule, None)
+        if key is None:
+            return
+        self._refs[key] -= 1
+        if self._refs[key]:
+            return
+        del self._refs[key]
+
+        labels, flag = key
+        path = [self._root]
+        for label in labels:
+            path.append(path[-1].children[label])
+        path[-1].flags &= ~flag
+
+        # Walk back up and drop nodes that carry no rule and lead nowhere
+        for depth in range(len(labels), 0, -1):
+            node = path[depth]
+            if node.flags or node.children:
+                break
+            del path[depth - 1].children[labels[depth - 1]]
+
+    def match(self, host: str) -> bool:
+        """Return True if the host is covered by any rule in the index."""
+        labels = normalize_host(host).split('.')
+        remaining = len(labels)
+        node = self._root
+        for label in reversed(labels):
+            node = node.children.get(label)
+            if node is None:
+                return False
+            remaining -= 1
+            if node.flags & SUBTREE:
+                return True
+            if remaining and node.flags & WILDCARD:
+                return True
+        return bool(node.flags & EXACT)
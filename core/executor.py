@@ -0,0 +1,18 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+import config
+
+# Bounded thread pool for the blocking work of plugins: database writes (a journal fsync),
+# password hashing, file I/O. An async hook awaiting run_blocking lets mitmproxy's event loop
+# keep serving the other connections meanwhile, and the bound keeps a burst of admin requests
+# from starting an unbounded number of threads.
+
+executor = ThreadPoolExecutor(
+    max_workers=config.BLOCKING_POOL_SIZE, thread_name_prefix='safebrowse-blocking')
+
+
+async def run_blocking(func, *args, **kwargs):
+    """Run a blocking call on the thread pool and await its result."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, functools.partial(func, *args, **kwargs))
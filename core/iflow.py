@@ -17,6 +17,18 @@ class IFlow(ABC):
     def make_response(self, status, data, content_type) -> None:
         pass
 
+    def stream_response(self) -> None:
+        pass
+
+    def get_client_ip(self) -> str:
+        pass
+
+    def get_connection_id(self) -> str:
+        pass
+
+    def get_proxy_user(self) -> str:
+        pass
+
     def get_cookie(self, key: str) -> str:
         pass
 
@@ -0,0 +1,118 @@
+from bisect import bisect_left
+from core.verdict_cache import caches
+
+# Process-wide counters of the plugin pipelines, served in the Prometheus text format at settings.it/api/metrics.
+# Every hook call costs two perf_counter() reads, a bisect over the buckets and a few integer increments,
+# the stats objects are looked up once when a pipeline is compiled, never per flow.
+# The counters are kept by plugin title, so they survive the pipelines being rebuilt after a plugins list change.
+# Each proxy worker serves its own counters.
+
+CONTENT_TYPE_PROMETHEUS = "text/plain; version=0.0.4; charset=utf-8"
+# Upper bounds in seconds of the hook latency histogram buckets
+LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025,
+                   0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+ALLOW = 'allow'
+BLOCK = 'block'
+
+
+class HookStats:
+    """Latency histogram and call counters of one hook of one plugin."""
+    __slots__ = ('plugin', 'hook', 'calls', 'short_circuits', 'seconds', 'buckets')
+
+    def __init__(self, plugin: str, hook: str):
+        self.plugin = plugin
+        self.hook = hook
+        self.calls = 0
+        # Calls that returned a falsy value and stopped the pipeline
+        self.short_circuits = 0
+        self.seconds = 0.0
+        # Non-cumulative counts, the last one is the +Inf bucket
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def observe(self, seconds: float, result) -> None:
+        self.calls += 1
+        self.seconds += seconds
+        self.buckets[bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        if not result:
+            self.short_circuits += 1
+
+
+# (plugin title, hook name) -> HookStats
+hook_stats = {}
+# (hook name, verdict) -> number of flows the pipeline let through or stopped
+verdicts = {}
+
+
+def get_hook_stats(plugin: str, hook: str) -> HookStats:
+    stats = hook_stats.get((plugin, hook))
+    if stats is None:
+        stats = hook_stats[(plugin, hook)] = HookStats(plugin, hook)
+    return stats
+
+
+def count_verdict(hook: str, passed: bool) -> None:
+    key = (hook, ALLOW if passed else BLOCK)
+    verdicts[key] = verdicts.get(key, 0) + 1
+
+
+def reset() -> None:
+    """Zero all the counters. The stats objects are kept, the compiled pipelines hold references to them."""
+    for stats in hook_stats.values():
+        stats.__init__(stats.plugin, stats.hook)
+    verdicts.clear()
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(**labels) -> str:
+    return '{' + ','.join(f'{name}="{_escape(str(value))}"' for name, value in labels.items()) + '}'
+
+
+def render() -> str:
+    """Return all the counters in the Prometheus text exposition format."""
+    lines = [
+        '# HELP safebrowse_hook_duration_seconds Time spent in each plugin hook.',
+        '# TYPE safebrowse_hook_duration_seconds histogram',
+    ]
+    all_stats = sorted(hook_stats.values(), key=lambda stats: (stats.plugin, stats.hook))
+    for stats in all_stats:
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS + ('+Inf',), stats.buckets):
+            cumulative += count
+            lines.append('safebrowse_hook_duration_seconds_bucket' +
+                         _labels(plugin=stats.plugin, hook=stats.hook, le=bound) + f' {cumulative}')
+        labels = _labels(plugin=stats.plugin, hook=stats.hook)
+        lines.append(f'safebrowse_hook_duration_seconds_sum{labels} {stats.seconds!r}')
+        lines.append(f'safebrowse_hook_duration_seconds_count{labels} {stats.calls}')
+
+    lines += ['# HELP safebrowse_hook_calls_total Calls of each plugin hook.',
+              '# TYPE safebrowse_hook_calls_total counter']
+    lines += [f'safebrowse_hook_calls_total{_labels(plugin=stats.plugin, hook=stats.hook)} {stats.calls}'
+              for stats in all_stats]
+    lines += ['# HELP safebrowse_hook_short_circuits_total Calls of each plugin hook that stopped the pipeline.',
+              '# TYPE safebrowse_hook_short_circuits_total counter']
+    lines += [f'safebrowse_hook_short_circuits_total{_labels(plugin=stats.plugin, hook=stats.hook)} '
+              f'{stats.short_circuits}' for stats in all_stats]
+
+    lines += ['# HELP safebrowse_verdicts_total Flows let through (allow) or stopped (block) by each pipeline.',
+              '# TYPE safebrowse_verdicts_total counter']
+    lines += [f'safebrowse_verdicts_total{_labels(hook=hook, verdict=verdict)} {count}'
+              for (hook, verdict), count in sorted(verdicts.items())]
+
+    lines += ['# HELP safebrowse_verdict_cache_hits_total Lookups answered by each verdict cache.',
+              '# TYPE safebrowse_verdict_cache_hits_total counter']
+    lines += [f'safebrowse_verdict_cache_hits_total{_labels(cache=name)} {cache.hits}'
+              for name, cache in sorted(caches.items())]
+    lines += ['# HELP safebrowse_verdict_cache_misses_total Lookups missed by each verdict cache.',
+              '# TYPE safebrowse_verdict_cache_misses_total counter']
+    lines += [f'safebrowse_verdict_cache_misses_total{_labels(cache=name)} {cache.misses}'
+              for name, cache in sorted(caches.items())]
+    return '\n'.join(lines) + '\n'
+
+
+def handle_metrics(flow) -> None:
+    """settings.it GET /api/metrics handler."""
+    flow.make_response(200, render(), {"Content-Type": CONTENT_TYPE_PROMETHEUS})
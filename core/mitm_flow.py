@@ -26,6 +26,19 @@ class MitmFlow(IFlow):
         """Get the host from the request."""
         return self.flow_of_mitmproxy.request.pretty_host
 
+    def get_client_ip(self):
+        """Get the IP address of the client connection."""
+        return self.flow_of_mitmproxy.client_conn.peername[0]
+
+    def get_connection_id(self):
+        """Get the id of the client connection, shared by the requests made on it."""
+        return self.flow_of_mitmproxy.client_conn.id
+
+    def get_proxy_user(self):
+        """Get the user name the client authenticated to the proxy with (the proxyauth option), or None."""
+        proxy_auth = self.flow_of_mitmproxy.metadata.get('proxyauth')
+        return proxy_auth[0] if proxy_auth else None
+
     def get_request(self):
         """Get the request object from the flow."""
         return self.flow_of_mitmproxy.request
@@ -34,6 +47,23 @@ class MitmFlow(IFlow):
         """Get the response object from the flow."""
         return self.flow_of_mitmproxy.response
 
+    def stream_response(self):
+        """Stream the response body to the client as it arrives instead of buffering it in the proxy."""
+        self.flow_of_mitmproxy.response.stream = True
+
+    def discard_response_body(self):
+        """
+        Send the current response and drop the upstream body chunk by chunk as it arrives.
+        Used when the response was replaced at the headers phase, before its body was read.
+        """
+        pending = [self.flow_of_mitmproxy.response.content or b""]
+
+        def drop_upstream_chunk(chunk):
+            # The replacement body goes out with the first chunk, everything from upstream is dropped
+            return pending.pop() if pending else b""
+
+        self.flow_of_mitmproxy.response.stream = drop_upstream_chunk
+
     def make_response(self, status, data, content_type):
         """
         Create a response with the given status, data, and content type.
@@ -0,0 +1,103 @@
+import asyncio
+import base64
+import functools
+import hashlib
+import hmac
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import config
+
+# Password hashing of the settings.it users.
+# Passwords are stored as "scrypt$n$r$p$salt$hash" (salt and hash in base64). scrypt is deliberately slow,
+# so it runs on its own small thread pool: a burst of logins queues there instead of holding up
+# the proxy's event loop or the database writes of the shared blocking pool.
+# A client may only have PASSWORD_HASH_PER_CLIENT hashes running or queued at once.
+#
+# Older users were stored with an unsalted SHA-256 hex digest. Those still verify, and
+# needs_rehash() tells the caller to store a scrypt hash instead after a successful login.
+
+SCRYPT_PREFIX = 'scrypt'
+SALT_BYTES = 16
+HASH_BYTES = 32
+
+hashing_executor = ThreadPoolExecutor(
+    max_workers=config.PASSWORD_HASH_WORKERS, thread_name_prefix='safebrowse-hashing')
+# The hash of the stand-in password verified for unknown users, computed once on the hashing pool
+_dummy_hash = None
+_dummy_hash_lock = threading.Lock()
+
+
+def _scrypt(password: str, salt: bytes, n: int, r: int, p: int) -> bytes:
+    return hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p, dklen=HASH_BYTES,
+                          maxmem=256 * n * r + 1024 * 1024)
+
+
+def hash_password(password: str) -> str:
+    n, r, p = config.PASSWORD_SCRYPT_N, 8, 1
+    salt = os.urandom(SALT_BYTES)
+    digest = _scrypt(password, salt, n, r, p)
+    return '$'.join((SCRYPT_PREFIX, str(n), str(r), str(p),
+                     base64.b64encode(salt).decode(), base64.b64encode(digest).decode()))
+
+
+def verify_password(password: str, stored) -> bool:
+    """Check a password against a stored hash. A missing hash (unknown user) takes as long and fails."""
+    if stored is None:
+        verify_password(password, dummy_hash())
+        return False
+    if stored.startswith(SCRYPT_PREFIX + '$'):
+        try:
+            _, n, r, p, salt, digest = stored.split('$')
+            expected = base64.b64decode(digest)
+            return hmac.compare_digest(_scrypt(password, base64.b64decode(salt), int(n), int(r), int(p)), expected)
+        except ValueError:
+            return False
+    # Legacy unsalted SHA-256
+    return hmac.compare_digest(hashlib.sha256(password.encode()).hexdigest(), stored)
+
+
+def needs_rehash(stored: str) -> bool:
+    """Check if a stored hash is a legacy one or uses other scrypt parameters than the configured ones."""
+    return not stored.startswith(f'{SCRYPT_PREFIX}${config.PASSWORD_SCRYPT_N}$8$1$')
+
+
+def start_dummy_hash() -> None:
+    """Start hashing the stand-in password on the hashing pool, so it is ready before the first login needs it."""
+    global _dummy_hash
+    with _dummy_hash_lock:
+        if _dummy_hash is None:
+            _dummy_hash = hashing_executor.submit(hash_password, os.urandom(16).hex())
+
+
+def dummy_hash() -> str:
+    """Verified when the user does not exist, so an unknown user name takes as long as a wrong password."""
+    start_dummy_hash()
+    # Queued on the pool before any login, so a login never waits for a job queued behind itself
+    return _dummy_hash.result()
+
+
+class ClientLimiter:
+    """Counts the hashing jobs of each client, only used from the event loop."""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.active = {}
+
+    def acquire(self, client) -> bool:
+        count = self.active.get(client, 0)
+        if count >= self.limit:
+            return False
+        self.active[client] = count + 1
+        return True
+
+    def release(self, client) -> None:
+        count = self.active.pop(client) - 1
+        if count:
+            self.active[client] = count
+
+
+async def run_hashing(func, *args):
+    """Run a hashing call on the hashing pool and await its result."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(hashing_executor, functools.partial(func, *args))
@@ -3,16 +3,36 @@ from core.singleton_pattern import SingletonABCMeta
 from core.iflow import IFlow
 
 
+# The flow hooks can also be declared "async def", the pipeline awaits them,
+# so a plugin can await blocking work with core.executor.run_blocking without stalling the proxy.
+# Settings.it API handlers registered in register_routes can be coroutines too.
+
+
 class PluginBase(metaclass=SingletonABCMeta):
     @abstractmethod
     def title() -> str:
         """Return the title of the plugin."""
         pass
 
+    def register_routes(self, router) -> None:
+        """Register the plugin's settings.it API handlers into the admin router."""
+        pass
+
+    def reload_policy(self) -> None:
+        """Reload the plugin's state from the database after another proxy process changed it."""
+        pass
+
     def on_request(self, flow: IFlow) -> bool:
         """Process the request. Return False to stop further processing."""
         pass
 
-    def on_responce(self, flow: IFlow) -> bool:
+    def on_response(self, flow: IFlow) -> bool:
         """Process the response. Return False to stop further processing."""
         pass
+
+    def on_response_headers(self, flow: IFlow) -> bool:
+        """
+        Process the response as soon as its headers arrive, before the body is read.
+        Return False to stop further processing.
+        """
+        return True
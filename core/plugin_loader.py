@@ -0,0 +1,228 @@
+import ast
+import importlib
+import json
+import os
+import sys
+from time import perf_counter
+from core.singleton_pattern import Singleton
+
+# Loads the plugins named in the plugins lists without importing them up front.
+#
+# A manifest file caches, for every plugin module, the plugin classes it defines, their titles and the
+# flow hooks they override, read from the module's source without importing it. Each entry is keyed
+# by the file's size and modification time, so an edited or uploaded plugin is parsed again.
+#
+# With the manifest, a plugin is wrapped in a LazyPlugin: the pipelines are compiled from the manifest
+# and the plugin module is imported and instantiated on its first hook call or the first settings.it request
+# that no loaded plugin routes. Plugins the manifest can't describe (a class deriving from another plugin,
+# a title that isn't a constant) are imported when the lists are loaded, as before.
+#
+# A plugin module whose file changed since it was imported (an uploaded new version) is reloaded with
+# importlib.reload and its plugin is instantiated again, the plugins of unchanged modules are kept as they are.
+
+PLUGINS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'plugins')
+MANIFEST_FORMAT = 1
+# The flow hooks of PluginBase a plugin can override
+HOOKS = ('on_request', 'on_response', 'on_response_headers')
+
+
+def inspect_plugin_source(source: str) -> dict:
+    """
+    Describe the classes of a plugin module from its source.
+    Return {class name: {"title": str or None, "hooks": {hook name: is async}, "lazy": bool}}.
+    """
+    classes = {}
+    for node in ast.parse(source).body:
+        if not isinstance(node, ast.ClassDef):
+            continue
+        title = None
+        hooks = {}
+        for item in node.body:
+            if not isinstance(item, (ast.FunctionDef, ast.AsyncFunctionDef)):
+                continue
+            if item.name in HOOKS:
+                hooks[item.name] = isinstance(item, ast.AsyncFunctionDef)
+            elif item.name == 'title' and item.body and isinstance(item.body[-1], ast.Return) \
+                    and isinstance(item.body[-1].value, ast.Constant) and isinstance(item.body[-1].value.value, str):
+                title = item.body[-1].value.value
+        # Hooks inherited from anything but PluginBase are not visible in the source
+        direct_plugin = [ast.unparse(base) for base in node.bases] == ['PluginBase']
+        classes[node.name] = {'title': title, 'hooks': hooks, 'lazy': direct_plugin and title is not None}
+    return classes
+
+
+class PluginManifest:
+    """The manifest file, loaded once and written back when an entry was (re)built."""
+
+    def __init__(self, path):
+        self.path = path
+        self.modules = {}
+        self.changed = False
+        try:
+            with open(path) as f:
+                manifest = json.load(f)
+            if manifest.get('format') == MANIFEST_FORMAT:
+                self.modules = manifest['modules']
+        except (OSError, ValueError, KeyError):
+            pass
+
+    def lookup(self, module_name: str, class_name: str):
+        """Return the manifest entry of a plugin class, or None if its module doesn't define it."""
+        module_path = os.path.join(PLUGINS_DIR, module_name + '.py')
+        try:
+            stat = os.stat(module_path)
+        except OSError:
+            return None
+        entry = self.modules.get(module_name)
+        if entry is None or entry['size'] != stat.st_size or entry['mtime_ns'] != stat.st_mtime_ns:
+            try:
+                with open(module_path, encoding='utf-8') as f:
+                    classes = inspect_plugin_source(f.read())
+            except (OSError, SyntaxError, ValueError):
+                return None
+            entry = self.modules[module_name] = {
+                'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'classes': classes}
+            self.changed = True
+        return entry['classes'].get(class_name)
+
+    def save(self):
+        if not self.changed or not self.path:
+            return
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump({'format': MANIFEST_FORMAT, 'modules': self.modules}, f, indent=4)
+            os.replace(tmp_path, self.path)
+            self.changed = False
+        except OSError as e:
+            print(f"Failed to write the plugin manifest {self.path}: {e}")
+
+
+# Size and mtime of each plugin module's file when it was imported
+_module_signatures = {}
+
+
+def file_signature(module_name: str):
+    try:
+        stat = os.stat(os.path.join(PLUGINS_DIR, module_name + '.py'))
+    except OSError:
+        return None
+    return stat.st_size, stat.st_mtime_ns
+
+
+def module_changed(module_name: str) -> bool:
+    """Check if the file of an imported plugin module changed since it was imported."""
+    if f'plugins.{module_name}' not in sys.modules:
+        return False
+    # A module another module imported is taken as up to date the first time it is seen here
+    signature = _module_signatures.setdefault(module_name, file_signature(module_name))
+    return signature != file_signature(module_name)
+
+
+def import_plugin(module_name: str, class_name: str):
+    """
+    Import a plugin module and return the (singleton) instance of its plugin class.
+    The module is reloaded if its file changed since it was imported, and its classes are instantiated again.
+    """
+    full_name = f'plugins.{module_name}'
+    if module_changed(module_name):
+        module = sys.modules[full_name]
+        # Forget the instances of the old classes, the reloaded module defines new ones
+        for cls in [cls for cls in Singleton._instances if cls.__module__ == full_name]:
+            del Singleton._instances[cls]
+        module = importlib.reload(module)
+        print(f"Reloaded the plugin module {full_name}")
+    else:
+        module = importlib.import_module(full_name)
+    _module_signatures[module_name] = file_signature(module_name)
+    return getattr(module, class_name)()
+
+
+async def _blocked():
+    return False
+
+
+class LazyPlugin:
+    """
+    Stands in for a plugin until it is first used, with the title and hooks recorded in the manifest.
+    Other attributes are read from the plugin, loading it.
+    """
+
+    def __init__(self, module_name: str, class_name: str, info: dict):
+        self.module_name = module_name
+        self.class_name = class_name
+        self.info = info
+        # The file the manifest entry was read from
+        self.signature = file_signature(module_name)
+        # The plugin instance once loaded
+        self.instance = None
+
+    def load(self):
+        if self.instance is None:
+            start = perf_counter()
+            self.instance = import_plugin(self.module_name, self.class_name)
+            print(f"Loaded the {self.title()} plugin in {perf_counter() - start:.3f}s")
+        return self.instance
+
+    def title(self) -> str:
+        return self.info['title']
+
+    def hook(self, hook_name: str):
+        """
+        Return (hook, is async) for a hook the plugin overrides, or None. The hook loads the plugin when called,
+        and blocks the flow if the plugin fails to load: a flow the plugin can't check is not let through.
+        """
+        if hook_name not in self.info['hooks']:
+            return None
+        is_async = self.info['hooks'][hook_name]
+
+        def call(flow):
+            try:
+                plugin = self.load()
+            except Exception as e:
+                print(f"Failed to load the {self.title()} plugin, blocking the flow: {e}")
+                flow.kill()
+                return _blocked() if is_async else False
+            return getattr(plugin, hook_name)(flow)
+        return call, is_async
+
+    def register_routes(self, router) -> None:
+        router.add_lazy(lambda router: self.load().register_routes(router))
+
+    def reload_policy(self) -> None:
+        # A plugin that is not loaded yet reads the current policy when it loads
+        if self.instance is not None:
+            self.instance.reload_policy()
+
+    def __getattr__(self, name):
+        if name in ('module_name', 'class_name', 'info', 'signature', 'instance'):
+            raise AttributeError(name)
+        return getattr(self.load(), name)
+
+
+# One proxy per plugin class, so a plugin in both lists is the same object like the singleton it stands for
+_lazy_plugins = {}
+
+
+def plugin_changed(module_name: str, class_name: str) -> bool:
+    """Check if the plugin's module file changed since it was imported, or since its manifest entry was read."""
+    proxy = _lazy_plugins.get((module_name, class_name))
+    if proxy is not None and proxy.signature != file_signature(module_name):
+        return True
+    return module_changed(module_name)
+
+
+def get_plugin(manifest: PluginManifest, module_name: str, class_name: str, lazy=True):
+    """
+    Return a LazyPlugin for the plugin if lazy loading is enabled and possible, else the loaded plugin.
+    A plugin whose module file changed is replaced, the others are returned as they are.
+    """
+    proxy = _lazy_plugins.get((module_name, class_name))
+    if proxy is not None and not plugin_changed(module_name, class_name):
+        return proxy if proxy.instance is None else proxy.instance
+    _lazy_plugins.pop((module_name, class_name), None)
+    info = manifest.lookup(module_name, class_name) if lazy else None
+    if info is None or not info['lazy']:
+        return import_plugin(module_name, class_name)
+    proxy = _lazy_plugins[(module_name, class_name)] = LazyPlugin(module_name, class_name, info)
+    return proxy
@@ -0,0 +1,183 @@
+import array
+import hashlib
+import mmap
+import os
+import struct
+import threading
+from bisect import bisect_left
+from core.domain_index import EXACT, SUBTREE, WILDCARD, iter_suffixes, normalize_host, parse_rule
+
+# Compiled, read-only policy snapshot memory-mapped from a file.
+# A plugin compiles its rules once into sorted arrays of 64-bit hashes of the rule domains,
+# and every proxy process maps the same file read-only, so the OS shares one copy of it
+# instead of each worker parsing the table and building its own index.
+#
+# Layout, in native byte order (the snapshot is a local cache, not a portable format):
+#   header     - magic, format, policy version length, number of exact/subtree/wildcard rules, table size, pool size
+#   version    - the database version of the compiled table, padded to 8 bytes
+#   exact      - sorted u64 hashes of the "=a.com" rules
+#   subtree    - sorted u64 hashes of the "a.com" rules
+#   wildcard   - sorted u64 hashes of the "*.a.com" rules
+#   table keys - sorted u64 hashes of the domains of a domain -> list of strings table
+#   offsets    - u64 offsets of each key's strings in the pool, plus the end of the pool
+#   pool       - the strings of each key, UTF-8 and newline separated
+#
+# A lookup hashes the host and each of its parent domains and binary searches the arrays,
+# O(labels * log(rules)). Two domains with the same 64-bit hash are indistinguishable,
+# with a million rules the odds of a false match are about one in ten million million per lookup.
+
+MAGIC = b'SBPS'
+FORMAT = 1
+HEADER = struct.Struct('=4sII5Q4x')
+
+
+def domain_hash(domain: str) -> int:
+    return int.from_bytes(hashlib.blake2b(domain.encode(), digest_size=8).digest(), 'little')
+
+
+def _padded(data: bytes) -> bytes:
+    return data + b'\0' * (-len(data) % 8)
+
+
+def write_snapshot(path, version, rules=(), table=None):
+    """
+    Compile domain rules and a domain -> list of strings table into a snapshot file.
+    The file is written to a temporary file and renamed, processes mapping the old one keep it.
+    """
+    hashes = {EXACT: set(), SUBTREE: set(), WILDCARD: set()}
+    for rule in rules:
+        try:
+            labels, flag = parse_rule(rule)
+        except ValueError:
+            continue
+        hashes[flag].add(domain_hash('.'.join(reversed(labels))))
+
+    entries = sorted((domain_hash(normalize_host(domain)), '\n'.join(values))
+                     for domain, values in (table or {}).items())
+    keys = array.array('Q', (key for key, _ in entries))
+    offsets = array.array('Q', [0])
+    pool = bytearray()
+    for _, values in entries:
+        pool += values.encode()
+        offsets.append(len(pool))
+
+    version = str(version).encode()
+    arrays = [array.array('Q', sorted(hashes[flag])) for flag in (EXACT, SUBTREE, WILDCARD)]
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, FORMAT, len(version), *(len(hashes) for hashes in arrays),
+                            len(keys), len(pool)))
+        f.write(_padded(version))
+        for hashes in arrays:
+            f.write(hashes.tobytes())
+        f.write(keys.tobytes())
+        f.write(offsets.tobytes())
+        f.write(pool)
+    os.replace(tmp_path, path)
+
+
+def _contains(hashes, value):
+    index = bisect_left(hashes, value)
+    return index < len(hashes) and hashes[index] == value
+
+
+class PolicySnapshot:
+    """A snapshot file mapped read-only, unmapped when the object is garbage collected."""
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(self._mmap)
+        if len(view) < HEADER.size:
+            raise ValueError(f"Truncated policy snapshot {path}")
+        magic, file_format, version_length, exact_count, subtree_count, wildcard_count, \
+            table_count, pool_size = HEADER.unpack_from(view)
+        if magic != MAGIC or file_format != FORMAT:
+            raise ValueError(f"Not a policy snapshot of this version: {path}")
+
+        offset = HEADER.size
+        self.version = bytes(view[offset:offset + version_length]).decode()
+        offset += version_length + (-version_length % 8)
+        arrays = []
+        for count in (exact_count, subtree_count, wildcard_count, table_count, table_count + 1):
+            arrays.append(view[offset:offset + count * 8].cast('Q'))
+            offset += count * 8
+        self._exact, self._subtree, self._wildcard, self._keys, self._offsets = arrays
+        self._pool = view[offset:offset + pool_size]
+        if len(self._pool) != pool_size:
+            raise ValueError(f"Truncated policy snapshot {path}")
+
+    def __len__(self) -> int:
+        return len(self._exact) + len(self._subtree) + len(self._wildcard)
+
+    def match(self, host: str) -> bool:
+        """Return True if the host is covered by any rule, with the semantics of DomainIndex.match."""
+        for depth, suffix in enumerate(iter_suffixes(normalize_host(host))):
+            hashed = domain_hash(suffix)
+            if _contains(self._subtree, hashed):
+                return True
+            # Exact rules only cover the host itself, wildcards only its subdomains
+            if _contains(self._wildcard if depth else self._exact, hashed):
+                return True
+        return False
+
+    def lookup(self, domain: str):
+        """Return the table strings of the domain, or None if the domain is not in the table."""
+        hashed = domain_hash(domain)
+        index = bisect_left(self._keys, hashed)
+        if index == len(self._keys) or self._keys[index] != hashed:
+            return None
+        return bytes(self._pool[self._offsets[index]:self._offsets[index + 1]]).decode().split('\n')
+
+
+def open_snapshot(path, version):
+    """Map the snapshot if it exists and was compiled from this version of the database, else return None."""
+    try:
+        snapshot = PolicySnapshot(path)
+    except (OSError, ValueError):
+        return None
+    return snapshot if snapshot.version == str(version) else None
+
+
+class SnapshotWriter:
+    """
+    Recompiles a snapshot in a background thread after policy changes.
+    build() returns (version, rules, table), changes scheduled while a write runs are folded into one more write.
+    on_written() is called after each write, e.g. to map the new snapshot.
+    """
+
+    def __init__(self, path, build, on_written=None):
+        self.path = path
+        self.build = build
+        self.on_written = on_written
+        self.lock = threading.Lock()
+        self.pending = False
+        self.thread = None
+
+    def schedule(self):
+        with self.lock:
+            self.pending = True
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+
+    def wait(self):
+        """Block until the scheduled writes are done."""
+        thread = self.thread
+        if thread is not None:
+            thread.join()
+
+    def _run(self):
+        while True:
+            with self.lock:
+                if not self.pending:
+                    self.thread = None
+                    return
+                self.pending = False
+            try:
+                os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+                write_snapshot(self.path, *self.build())
+                if self.on_written is not None:
+                    self.on_written()
+            except Exception as e:
+                print(f"Failed to write the policy snapshot {self.path}: {e}")
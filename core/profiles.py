@@ -0,0 +1,172 @@
+import ipaddress
+import threading
+import config
+from core.domain_index import DomainIndex, parse_rule
+from core.singleton_pattern import Singleton
+from core.verdict_cache import PolicyGeneration
+from dal import get_db
+
+# Per-client policy profiles.
+# A profile is a row of the "profiles" table:
+#   {"name": "kids", "networks": ["10.0.1.0/24", "fd00::/64"], "users": ["alice"],
+#    "approved_domains": ["a.com", "*.b.com"], "contents": {"a.com": ["text", "image/*"]}}
+# A client whose proxy-auth user is in "users", or else whose address is in one of the "networks"
+# (the most specific network wins), gets the approved domains of the profile instead of the global list,
+# and its content rules if it defines any. Every other client gets the global policy.
+# Behind the relay of supervisor.py every client connects from the same address, profiles with networks
+# are refused there.
+#
+# The networks are compiled into one hash table per prefix length, so resolving an address costs one dict
+# lookup per distinct prefix length in use. The resolved profile is cached per client connection,
+# requests on the same connection skip the lookup, and the entry is dropped when the client disconnects.
+
+PROFILES_TABLE = 'profiles'
+# Connections whose profile is remembered, in case disconnections are missed
+MAX_CACHED_CONNECTIONS = 100000
+
+
+class CidrTable:
+    """Longest-prefix match of IPv4 and IPv6 addresses against a set of networks."""
+
+    def __init__(self, entries=()):
+        # IP version -> prefix length -> network address as an int -> value
+        self.tables = {4: {}, 6: {}}
+        for network, value in entries:
+            network = ipaddress.ip_network(network, strict=False)
+            self.tables[network.version].setdefault(network.prefixlen, {})[int(network.network_address)] = value
+        # The prefix lengths in use, longest first
+        self.prefix_lengths = {version: sorted(table, reverse=True) for version, table in self.tables.items()}
+
+    def lookup(self, address):
+        """Return the value of the most specific network holding the address, or None. Raises ValueError."""
+        ip = ipaddress.ip_address(address)
+        if ip.version == 6 and ip.ipv4_mapped is not None:
+            ip = ip.ipv4_mapped
+        value = int(ip)
+        table = self.tables[ip.version]
+        for prefix_length in self.prefix_lengths[ip.version]:
+            host_bits = ip.max_prefixlen - prefix_length
+            hit = table[prefix_length].get(value >> host_bits << host_bits)
+            if hit is not None:
+                return hit
+        return None
+
+
+class Profile:
+    __slots__ = ('name', 'domain_index', 'contents', 'compiled_contents')
+
+    def __init__(self, row):
+        self.name = row['name']
+        self.domain_index = DomainIndex(row.get('approved_domains', []))
+        # Domain -> allowed content types, None to apply the global content rules
+        self.contents = row.get('contents') or None
+        # Filled by the content filter the first time it needs the profile's rules
+        self.compiled_contents = None
+
+
+def validate_profile(row) -> str:
+    """Return an error message for a malformed profile row, or None."""
+    if not isinstance(row, dict) or not isinstance(row.get('name'), str) or not row['name']:
+        return "A profile needs a name"
+    for key in ('networks', 'users', 'approved_domains'):
+        values = row.get(key, [])
+        if not isinstance(values, list) or not all(isinstance(value, str) for value in values):
+            return f"{key} must be a list of strings"
+    if row.get('networks') and config.BEHIND_RELAY:
+        return "Profiles can't select clients by network behind the supervisor's relay"
+    for network in row.get('networks', []):
+        try:
+            ipaddress.ip_network(network, strict=False)
+        except ValueError:
+            return f"Invalid network {network}"
+    for domain in row.get('approved_domains', []):
+        try:
+            parse_rule(domain)
+        except ValueError:
+            return f"Invalid domain {domain}"
+    contents = row.get('contents', {})
+    if not isinstance(contents, dict) or not all(isinstance(types, list) for types in contents.values()):
+        return "contents must map domains to lists of content types"
+    return None
+
+
+class ProfileStore(metaclass=Singleton):
+    """The profiles compiled from the database, shared by the white list and the content filter."""
+
+    def __init__(self, db=None):
+        self.db = db if db is not None else get_db()
+        self.db.ensure_index(PROFILES_TABLE, 'name')
+        self.lock = threading.Lock()
+        self.version = None
+        self.profiles = {}
+        self.networks = CidrTable()
+        self.users = {}
+        # Bumped on every reload, the connection cache entries of an older generation are stale
+        self.generation = 0
+        # Client connection id -> (generation, profile or None)
+        self.connections = {}
+        self.reload()
+
+    def reload(self, force=False) -> bool:
+        """Recompile the profiles if the table changed. Return True if it did."""
+        with self.lock:
+            version = self.db.version(PROFILES_TABLE)
+            if version == self.version and not force:
+                return False
+            profiles, networks, users = {}, [], {}
+            for row in self.db.fetch_all(PROFILES_TABLE):
+                error = validate_profile(row)
+                if error is not None:
+                    print(f"Skipping the invalid profile {row.get('name')}: {error}")
+                    continue
+                profile = profiles[row['name']] = Profile(row)
+                networks.extend((network, profile) for network in row.get('networks', []))
+                for user in row.get('users', []):
+                    users[user] = profile
+            self.networks = CidrTable(networks)
+            self.users = users
+            self.profiles = profiles
+            self.version = version
+            self.generation += 1
+            self.connections = {}
+        PolicyGeneration().bump()
+        return True
+
+    def resolve(self, flow):
+        """Return the profile of the flow's client, or None for the global policy."""
+        if not self.profiles:
+            return None
+        connection_id = flow.get_connection_id()
+        cached = self.connections.get(connection_id)
+        if cached is not None and cached[0] == self.generation:
+            return cached[1]
+
+        profile = self.users.get(flow.get_proxy_user())
+        if profile is None:
+            try:
+                profile = self.networks.lookup(flow.get_client_ip())
+            except (TypeError, ValueError):
+                profile = None
+        if len(self.connections) >= MAX_CACHED_CONNECTIONS:
+            self.connections = {}
+        self.connections[connection_id] = (self.generation, profile)
+        return profile
+
+    def forget_connection(self, connection_id) -> None:
+        self.connections.pop(connection_id, None)
+
+    def rows(self):
+        return self.db.fetch_all(PROFILES_TABLE)
+
+    def save(self, row) -> None:
+        """Insert or replace the profile of the same name. Blocking, run it on the blocking pool."""
+        with self.db.transaction():
+            self.db.remove(PROFILES_TABLE, 'name', row['name'])
+            self.db.insert(PROFILES_TABLE, row)
+
+    def delete(self, name) -> bool:
+        """Delete a profile. Return False if there is none of that name. Blocking."""
+        if not self.db.search(PROFILES_TABLE, 'name', name):
+            return False
+        self.db.remove(PROFILES_TABLE, 'name', name)
+        return True
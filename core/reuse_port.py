@@ -0,0 +1,28 @@
+import asyncio
+import socket
+
+# Lets several proxy workers listen on the same port (see supervisor.py).
+# mitmproxy opens its listening socket itself with asyncio.start_server and has no option for SO_REUSEPORT,
+# so the workers turn it on for every server created by their event loop before mitmproxy starts listening.
+# The kernel then spreads the incoming connections over the workers, and each worker sees the real
+# address of its clients.
+
+
+def is_supported() -> bool:
+    return hasattr(socket, 'SO_REUSEPORT')
+
+
+def enable_reuse_port() -> None:
+    """Make the servers created by asyncio from now on share their port with the other workers' servers."""
+    base_loop = asyncio.base_events.BaseEventLoop
+    create_server = base_loop.create_server
+    if getattr(create_server, 'reuse_port_enabled', False):
+        return
+
+    async def create_server_reusing_port(self, *args, **kwargs):
+        if kwargs.get('sock') is None:
+            kwargs.setdefault('reuse_port', True)
+        return await create_server(self, *args, **kwargs)
+
+    create_server_reusing_port.reuse_port_enabled = True
+    base_loop.create_server = create_server_reusing_port
@@ -0,0 +1,156 @@
+import hashlib
+import heapq
+import secrets
+import threading
+import time
+from core.executor import executor
+
+# Login sessions of the settings.it admin API.
+# A session is a random token handed to the browser in the "session" cookie, the store keeps it by the
+# SHA-256 of the token, so a copy of the database doesn't hold usable tokens.
+#
+# Checking a session is a dict lookup. Every check slides its expiry to now + SESSION_TTL, and the
+# expiries are ordered in a heap: entries are not moved when a session is extended, an entry popped
+# before its session's current expiry is pushed back with it, so expiring costs O(log n) per
+# expired or extended session and is only done when the earliest entry is due, never by scanning.
+# At most SESSION_MAX sessions are kept, the one closest to expiring is dropped to make room.
+#
+# With a database, the sessions are also kept in its "sessions" table, so they survive a restart and
+# are shared by the proxy workers: a token unknown to this process is looked up there before being refused.
+# A sliding expiry is written back only once it moved by a tenth of the TTL, off the event loop.
+
+SESSIONS_TABLE = 'sessions'
+
+
+def token_key(token: str) -> str:
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+class Session:
+    __slots__ = ('key', 'user', 'expires', 'stored_expires')
+
+    def __init__(self, key, user, expires, stored_expires=None):
+        self.key = key
+        self.user = user
+        self.expires = expires
+        # The expiry last written to the database
+        self.stored_expires = expires if stored_expires is None else stored_expires
+
+
+class SessionStore:
+    def __init__(self, ttl: float, max_sessions: int, db=None):
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.db = db
+        self.lock = threading.Lock()
+        self.sessions = {}
+        # (expiry, key) entries, possibly older than the session's current expiry
+        self.expiries = []
+        if db is not None:
+            db.ensure_index(SESSIONS_TABLE, 'token')
+            self._load()
+
+    def _load(self):
+        now = time.time()
+        for row in list(self.db.fetch_all(SESSIONS_TABLE)):
+            if row['expires'] > now:
+                self._add(Session(row['token'], row['user-name'], row['expires']))
+            else:
+                self.db.remove(SESSIONS_TABLE, 'token', row['token'])
+
+    def _add(self, session):
+        self.sessions[session.key] = session
+        heapq.heappush(self.expiries, (session.expires, session.key))
+        while len(self.sessions) > self.max_sessions:
+            # Only dropped from memory, the database keeps it until it expires
+            self._pop_earliest()
+
+    def _pop_earliest(self):
+        """Drop the session that expires first, skipping the heap entries of dropped or extended sessions."""
+        while self.expiries:
+            expires, key = heapq.heappop(self.expiries)
+            session = self.sessions.get(key)
+            if session is None:
+                continue
+            if session.expires > expires:
+                heapq.heappush(self.expiries, (session.expires, key))
+                continue
+            del self.sessions[key]
+            return session
+
+    def _expire(self, now):
+        while self.expiries and self.expiries[0][0] <= now:
+            expires, key = heapq.heappop(self.expiries)
+            session = self.sessions.get(key)
+            if session is None:
+                continue
+            if session.expires > expires:
+                # Extended since the entry was pushed
+                heapq.heappush(self.expiries, (session.expires, key))
+                continue
+            del self.sessions[key]
+            if self.db is not None:
+                executor.submit(self._remove_stored_if_expired, key, now)
+
+    def _remove_stored_if_expired(self, key, now):
+        # Another proxy process may have extended the session meanwhile
+        rows = self.db.search(SESSIONS_TABLE, 'token', key)
+        if rows and rows[0]['expires'] <= now:
+            self.db.remove(SESSIONS_TABLE, 'token', key)
+
+    def create(self, user: str) -> str:
+        """Start a session for the user and return its token."""
+        token = secrets.token_urlsafe(32)
+        key = token_key(token)
+        now = time.time()
+        with self.lock:
+            self._expire(now)
+            self._add(Session(key, user, now + self.ttl))
+        if self.db is not None:
+            self.db.insert(SESSIONS_TABLE, {'token': key, 'user-name': user, 'expires': now + self.ttl})
+        return token
+
+    def get(self, token):
+        """Return the user of a live session and extend it, or None."""
+        if not token:
+            return None
+        key = token_key(token)
+        now = time.time()
+        with self.lock:
+            if self.expiries and self.expiries[0][0] <= now:
+                self._expire(now)
+            session = self.sessions.get(key)
+            if session is None:
+                session = self._load_stored(key, now)
+                if session is None:
+                    return None
+            session.expires = now + self.ttl
+            if self.db is not None and session.expires - session.stored_expires > self.ttl / 10:
+                session.stored_expires = session.expires
+                executor.submit(self.db.update, SESSIONS_TABLE, {'expires': session.expires}, 'token', key)
+            return session.user
+
+    def _load_stored(self, key, now):
+        """Look up a session another proxy process created."""
+        if self.db is None:
+            return None
+        rows = self.db.search(SESSIONS_TABLE, 'token', key)
+        if not rows or rows[0]['expires'] <= now:
+            return None
+        session = Session(key, rows[0]['user-name'], rows[0]['expires'])
+        self._add(session)
+        return session
+
+    def delete(self, token) -> None:
+        """End a session, e.g. on log out."""
+        if not token:
+            return
+        key = token_key(token)
+        with self.lock:
+            # Its heap entry is dropped when it comes up
+            self.sessions.pop(key, None)
+        if self.db is not None:
+            executor.submit(self.db.remove, SESSIONS_TABLE, 'token', key)
+
+    def __len__(self):
+        return len(self.sessions)
@@ -0,0 +1,20 @@
+from time import perf_counter
+
+# Measures the phases of the proxy startup, logged once the proxy serves.
+
+
+class StartupTimer:
+    def __init__(self):
+        self.start = self.last = perf_counter()
+        self.phases = []
+
+    def mark(self, phase: str) -> None:
+        """Record the time since the previous mark as the duration of the phase."""
+        now = perf_counter()
+        self.phases.append((phase, now - self.last))
+        self.last = now
+
+    def report(self) -> str:
+        total = self.last - self.start
+        phases = ', '.join(f"{phase} {seconds:.3f}s" for phase, seconds in self.phases)
+        return f"Startup took {total:.3f}s: {phases}"
@@ -0,0 +1,202 @@
+import gzip
+import hashlib
+import mimetypes
+import os
+import re
+import threading
+import time
+from email.utils import formatdate, parsedate_to_datetime
+
+try:
+    import brotli
+except ImportError:  # Optional, the assets are then only precompressed with gzip
+    brotli = None
+
+# In-memory cache of the static files of the settings UI.
+# A file is read, hashed and compressed once, on its first request, and served from memory after that.
+# Its size and mtime are checked again at most every STATIC_ASSETS_CHECK_INTERVAL seconds,
+# so a rebuilt UI is picked up without a restart.
+#
+# Every response carries an ETag and Last-Modified, conditional requests get a 304 without a body.
+# Compressible files are also kept gzip (and brotli, when the brotli package is installed) compressed,
+# the variant sent is chosen from the request's Accept-Encoding.
+
+MIME_TYPES = {
+    '.html': 'text/html; charset=utf-8',
+    '.htm': 'text/html; charset=utf-8',
+    '.css': 'text/css; charset=utf-8',
+    '.js': 'text/javascript; charset=utf-8',
+    '.mjs': 'text/javascript; charset=utf-8',
+    '.json': 'application/json',
+    '.map': 'application/json',
+    '.webmanifest': 'application/manifest+json',
+    '.txt': 'text/plain; charset=utf-8',
+    '.xml': 'application/xml',
+    '.svg': 'image/svg+xml',
+    '.png': 'image/png',
+    '.jpg': 'image/jpeg',
+    '.jpeg': 'image/jpeg',
+    '.gif': 'image/gif',
+    '.webp': 'image/webp',
+    '.avif': 'image/avif',
+    '.ico': 'image/x-icon',
+    '.bmp': 'image/bmp',
+    '.woff': 'font/woff',
+    '.woff2': 'font/woff2',
+    '.ttf': 'font/ttf',
+    '.otf': 'font/otf',
+    '.eot': 'application/vnd.ms-fontobject',
+    '.wasm': 'application/wasm',
+    '.mp4': 'video/mp4',
+    '.webm': 'video/webm',
+    '.mp3': 'audio/mpeg',
+    '.wav': 'audio/wav',
+    '.pdf': 'application/pdf',
+}
+DEFAULT_MIME_TYPE = 'application/octet-stream'
+# Media types worth compressing, the others (images, fonts, media) are compressed already
+COMPRESSIBLE_TYPES = ('text/', 'application/json', 'application/manifest+json', 'application/xml',
+                      'image/svg+xml', 'application/wasm', 'image/x-icon', 'font/ttf', 'font/otf',
+                      'application/vnd.ms-fontobject')
+# Smaller files are sent as they are
+MIN_COMPRESS_SIZE = 256
+# The build names its bundles with a content hash ("main.3f2a1b9c.js"), they can be cached for good
+HASHED_NAME = re.compile(r'\.[0-9a-f]{8,}\.')
+CACHE_FOREVER = 'public, max-age=31536000, immutable'
+CACHE_REVALIDATE = 'no-cache'
+
+
+def mime_type(path: str) -> str:
+    ext = os.path.splitext(path)[1].lower()
+    if ext in MIME_TYPES:
+        return MIME_TYPES[ext]
+    return mimetypes.guess_type(path)[0] or DEFAULT_MIME_TYPE
+
+
+def accepted_encodings(accept_encoding: str) -> set:
+    """The content codings the client accepts, from an Accept-Encoding header ("gzip, br;q=0.8, *;q=0")."""
+    accepted = set()
+    for part in accept_encoding.lower().split(','):
+        coding, _, params = part.strip().partition(';')
+        q = 1.0
+        for param in params.split(';'):
+            name, _, value = param.strip().partition('=')
+            if name == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if coding and q > 0:
+            accepted.add(coding.strip())
+    return accepted
+
+
+class Asset:
+    __slots__ = ('signature', 'content_type', 'etag', 'last_modified', 'mtime', 'cache_control',
+                 'variants', 'checked')
+
+    def __init__(self, path: str, name: str, signature):
+        with open(path, 'rb') as f:
+            content = f.read()
+        self.signature = signature
+        self.content_type = mime_type(name)
+        self.etag = '"' + hashlib.blake2b(content, digest_size=12).hexdigest() + '"'
+        # HTTP dates have a one second resolution
+        self.mtime = int(signature[1] // 1_000_000_000)
+        self.last_modified = formatdate(self.mtime, usegmt=True)
+        self.cache_control = CACHE_FOREVER if HASHED_NAME.search(os.path.basename(name)) else CACHE_REVALIDATE
+        # Content coding -> body, in order of preference
+        self.variants = {}
+        if len(content) >= MIN_COMPRESS_SIZE and self.content_type.startswith(COMPRESSIBLE_TYPES):
+            if brotli is not None:
+                self._add_variant('br', brotli.compress(content))
+            self._add_variant('gzip', gzip.compress(content, compresslevel=9, mtime=0), len(content))
+        self.variants['identity'] = content
+        self.checked = time.monotonic()
+
+    def _add_variant(self, coding, body, original_size=None):
+        if original_size is None or len(body) < original_size:
+            self.variants[coding] = body
+
+    def not_modified(self, headers) -> bool:
+        """Check the conditional headers of a request against the asset."""
+        if_none_match = headers.get('If-None-Match')
+        if if_none_match:
+            tags = [tag.strip() for tag in if_none_match.split(',')]
+            # Weak comparison, a "W/" tag matches the same strong tag
+            return '*' in tags or any(tag.removeprefix('W/') == self.etag for tag in tags)
+        if_modified_since = headers.get('If-Modified-Since')
+        if if_modified_since:
+            try:
+                return self.mtime <= parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError):
+                return False
+        return False
+
+    def select(self, accept_encoding: str):
+        """Return (content coding, body) of the best variant the client accepts."""
+        if len(self.variants) > 1 and accept_encoding:
+            accepted = accepted_encodings(accept_encoding)
+            for coding, body in self.variants.items():
+                if coding in accepted:
+                    return coding, body
+        return 'identity', self.variants['identity']
+
+
+class StaticAssets:
+    """The files under a root directory, cached in memory by their path relative to it."""
+
+    def __init__(self, root: str, check_interval: float = 2.0):
+        self.root = os.path.realpath(root)
+        self.check_interval = check_interval
+        self.lock = threading.Lock()
+        self.assets = {}
+
+    def resolve(self, name: str):
+        """Return the absolute path of a file under the root, or None if the name escapes the root."""
+        path = os.path.realpath(os.path.join(self.root, name))
+        return path if os.path.commonpath((path, self.root)) == self.root else None
+
+    def get(self, name: str):
+        """Return the cached Asset of the file, reloading it if it changed on disk, or None if there is no such file."""
+        asset = self.assets.get(name)
+        if asset is not None and time.monotonic() - asset.checked < self.check_interval:
+            return asset
+
+        path = self.resolve(name)
+        try:
+            stat = os.stat(path) if path is not None else None
+        except OSError:
+            stat = None
+        if stat is None or not os.path.isfile(path):
+            self.assets.pop(name, None)
+            return None
+
+        signature = (stat.st_size, stat.st_mtime_ns)
+        with self.lock:
+            asset = self.assets.get(name)
+            if asset is None or asset.signature != signature:
+                asset = self.assets[name] = Asset(path, name, signature)
+            asset.checked = time.monotonic()
+        return asset
+
+    def response(self, name: str, request_headers):
+        """Return (status, body, headers) of the response serving the file, or None if there is no such file."""
+        asset = self.get(name)
+        if asset is None:
+            return None
+        headers = {
+            "Content-Type": asset.content_type,
+            "ETag": asset.etag,
+            "Last-Modified": asset.last_modified,
+            "Cache-Control": asset.cache_control,
+        }
+        if len(asset.variants) > 1:
+            headers["Vary"] = "Accept-Encoding"
+        if asset.not_modified(request_headers):
+            return 304, b"", headers
+
+        coding, body = asset.select(request_headers.get('Accept-Encoding', ''))
+        if coding != 'identity':
+            headers["Content-Encoding"] = coding
+        return 200, body, headers
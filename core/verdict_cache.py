@@ -0,0 +1,73 @@
+import time
+from collections import OrderedDict
+from core.singleton_pattern import Singleton
+
+# Returned by VerdictCache.get when there is no valid cached verdict for the key,
+# so that None, False or an empty list can be cached like any other verdict
+MISS = object()
+
+# Every cache created in the process by name, so their counters can be reported together
+caches = {}
+
+
+class PolicyGeneration(metaclass=Singleton):
+    """
+    Process-wide counter of policy changes.
+    Every mutation made through the admin API bumps it, which invalidates all the
+    verdicts cached under an older generation.
+    """
+
+    def __init__(self):
+        self.value = 0
+
+    def bump(self) -> int:
+        self.value += 1
+        return self.value
+
+
+class VerdictCache:
+    """
+    Bounded LRU cache of per-host verdicts.
+    Entries remember the policy generation they were computed under and are dropped
+    lazily when read after the policy changed, so invalidation never clears the cache at once.
+    """
+
+    def __init__(self, name: str, max_size: int, ttl: float = 0):
+        self.name = name
+        self.max_size = max_size
+        self.ttl = ttl
+        self.generation = PolicyGeneration()
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        caches[name] = self
+
+    def get(self, key):
+        """Return the cached verdict for the key, or MISS."""
+        entry = self._entries.get(key)
+        if entry is not None:
+            verdict, generation, expires = entry
+            if generation == self.generation.value and (not expires or expires > time.monotonic()):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return verdict
+            # Computed under an older policy or expired
+            del self._entries[key]
+        self.misses += 1
+        return MISS
+
+    def put(self, key, verdict) -> None:
+        """Cache a verdict under the current policy generation, evicting the least recently used entry."""
+        if self.max_size <= 0:
+            return
+        expires = time.monotonic() + self.ttl if self.ttl else 0
+        self._entries[key] = (verdict, self.generation.value, expires)
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        """Return the counters used to size the cache."""
+        return {'size': len(self._entries), 'max_size': self.max_size,
+                'hits': self.hits, 'misses': self.misses,
+                'generation': self.generation.value}
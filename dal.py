@@ -0,0 +1,17 @@
+import config
+
+# Selects the storage backend of the plugins from the configuration,
+# every backend implements insert/search/update/remove/fetch_all
+
+
+def get_db():
+    """Return the shared instance of the backend set by config.DB_BACKEND ("json", "sqlite" or "tinydb")."""
+    if config.DB_BACKEND == 'sqlite':
+        from dal_sqlite import DalSQLite
+        return DalSQLite(config.SQLITE_DB_PATH, config.DB_PATH)
+    if config.DB_BACKEND == 'tinydb':
+        from dal_tinydb import DalTinyDB
+        return DalTinyDB(config.DB_PATH)
+
+    from dal_db import DalDB
+    return DalDB(config.DB_PATH)
@@ -1,42 +1,500 @@
+import atexit
 import json
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
 from pathlib import Path
+import config
 from core.singleton_pattern import Singleton
 
+try:
+    import fcntl
+except ImportError:  # Windows, a single proxy process owns the database files
+    fcntl = None
+
+# Key of the snapshot holding the sequence number of the last journal record it includes
+SEQ_KEY = '__seq__'
+# Keys of the snapshot holding the sequence number of the last change of each table, and the database id
+VERSIONS_KEY = '__versions__'
+ID_KEY = '__id__'
+
+# The database is a JSON snapshot plus an append-only journal of the operations made after it.
+# A write appends one record to the journal instead of rewriting the whole file,
+# and once the journal grows past DB_JOURNAL_COMPACT_BYTES a background thread folds it into a fresh snapshot.
+# Every record carries an increasing sequence number, so replaying a journal over a snapshot
+# that already includes some of its records is harmless.
+#
+# Mutations made inside a transaction() block are applied in memory and written at commit as a
+# single batch record, a torn batch is dropped as a whole on recovery so a transaction is all or nothing.
+#
+# Plugins can declare secondary indexes per (table, key) with ensure_index. An index maps each value
+# of the key to the rows holding it, so search is a dict lookup and update/remove only visit the matching rows.
+#
+# Several proxy processes can share the same files (see supervisor.py). Every write holds an exclusive
+# lock file, first applies the records the other processes appended since its last read, and then
+# appends its own, so the journal stays one ordered history. refresh() applies the other processes'
+# records without writing, the workers poll it to pick up the admin changes made in any of them.
+#
+# With DB_WRITE_BEHIND_INTERVAL set, mutations are applied in memory and their records are kept pending,
+# a background thread appends all of them at once (one write and one fsync) at most once per interval.
+# Sequence numbers are given when the records are written, and if another process wrote in the meantime
+# the state is reloaded from the journal so every process ends up with the same order of operations.
+
+
+def index_value(value):
+    """Return a hashable stand-in for a row value, lists and dicts are compared by content."""
+    if isinstance(value, list):
+        return tuple(index_value(item) for item in value)
+    if isinstance(value, dict):
+        return json.dumps(value, sort_keys=True)
+    return value
+
 
 class DalDB(metaclass=Singleton):
     def __init__(self, db_path='db.json'):
         self.db_path = Path(db_path)
+        self.journal_path = Path(str(self.db_path) + '.journal')
+        # The journal being folded into the snapshot by a compaction
+        self.compacting_journal_path = Path(str(self.db_path) + '.journal.compacting')
+        self.lock = threading.RLock()
+        # Held by the process writing the journal, and by the process compacting it
+        self.lock_file = Path(str(self.db_path) + '.lock').open('a')
+        self.compaction_lock_file = Path(str(self.db_path) + '.compaction.lock').open('a')
+        self.lock_file_depth = 0
+        self.compaction_lock = threading.Lock()
+        self.compaction_thread = None
+        self.journal = None
+        # (table name, key) -> {index value: [rows]}
+        self.indexes = {}
+        # Serialized operations of the open transaction, None outside of a transaction
+        self.batch = None
+        # Write-behind mode: serialized records waiting for the next flush, without their sequence number
+        self.write_behind_interval = config.DB_WRITE_BEHIND_INTERVAL
+        self.pending = []
+        self.flush_thread = None
+        # Mutations persisted by a flush together with an earlier one instead of in a write of their own
+        self.coalesced_writes = 0
         self.db_path.touch(exist_ok=True)
         self.load_db()
+        if self.write_behind_interval > 0:
+            atexit.register(self.flush)
+
+    @classmethod
+    def read(cls, db_path):
+        """
+        Load the tables of a database file without making it the shared instance, e.g. to migrate it.
+        Read-only: the snapshot and the journals are only read, no lock file or record is written next to them.
+        """
+        dal = cls.__new__(cls)
+        dal.db_path = Path(db_path)
+        dal.indexes = {}
+        dal.pending = []
+        dal._read_snapshot()
+        dal._replay(Path(str(dal.db_path) + '.journal.compacting'), truncate_torn=False)
+        dal._replay(Path(str(dal.db_path) + '.journal'), truncate_torn=False)
+        return dal.db
+
+    def close(self):
+        self.flush()
+        self.journal.close()
+        self.lock_file.close()
+        self.compaction_lock_file.close()
+
+    @contextmanager
+    def _process_lock(self):
+        """Hold the lock file against the other processes sharing the database, re-entrant within this one."""
+        with self.lock:
+            if self.lock_file_depth == 0 and fcntl is not None:
+                fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+            self.lock_file_depth += 1
+            try:
+                yield
+            finally:
+                self.lock_file_depth -= 1
+                if self.lock_file_depth == 0 and fcntl is not None:
+                    fcntl.flock(self.lock_file, fcntl.LOCK_UN)
 
     def load_db(self):
+        with self._process_lock():
+            self._read_snapshot()
+
+            # The indexes are rebuilt from scratch once the state is loaded
+            indexed_keys = list(self.indexes)
+            self.indexes = {}
+
+            # Replay the operations written after the snapshot
+            self._replay(self.compacting_journal_path)
+            self._replay(self.journal_path)
+            self._open_journal()
+            if self.db_id is None:
+                # A new database (or one older than the ids), give it the id its table versions start from
+                record = {'op': 'meta', 'id': uuid.uuid4().hex, 'seq': self.seq + 1}
+                self._write_record(json.dumps(record))
+                self._apply(record)
+                self.seq += 1
+
+            for table_name, key in indexed_keys:
+                self.ensure_index(table_name, key)
+
+    def _read_snapshot(self):
         with self.db_path.open() as f:
             self.db = json.load(f) if self.db_path.stat().st_size != 0 else {}
+        self.seq = self.db.pop(SEQ_KEY, 0)
+        self.table_versions = self.db.pop(VERSIONS_KEY, {})
+        self.db_id = self.db.pop(ID_KEY, None)
+
+    def ensure_index(self, table_name, key):
+        """Maintain a secondary index of the table on the key from now on."""
+        with self.lock:
+            if (table_name, key) in self.indexes:
+                return
+            index = {}
+            for item in self.db.get(table_name, []):
+                index.setdefault(index_value(item.get(key)), []).append(item)
+            self.indexes[(table_name, key)] = index
+
+    def _table_indexes(self, table_name):
+        return [(key, index) for (indexed_table, key), index in self.indexes.items() if indexed_table == table_name]
+
+    def _matching_rows(self, table_name, key, value):
+        index = self.indexes.get((table_name, key))
+        if index is not None:
+            return list(index.get(index_value(value), ()))
+        return [item for item in self.db.get(table_name, []) if item.get(key) == value]
 
     def save_db(self):
-        with self.db_path.open('w') as f:
-            json.dump(self.db, f, indent=4)
+        """Write the whole database to a fresh snapshot and empty the journal."""
+        self.compact()
 
-    def insert(self, table_name, data):
+    def refresh(self):
+        """Apply the changes other processes made to the database. Return True if anything changed."""
+        # Cheap check without the lock, most polls find nothing new
+        try:
+            stat = os.stat(self.journal_path)
+        except FileNotFoundError:
+            stat = None
+        if stat is not None and stat.st_ino == self.journal_inode and stat.st_size == self.journal_size:
+            return False
+        with self._process_lock():
+            return self._catch_up()
+
+    def flush(self):
+        """Write the pending mutations of write-behind mode to the journal now, for callers that need durability."""
+        if not self.pending:
+            return
+        with self._process_lock():
+            self._catch_up()
+
+    def _schedule_flush(self):
+        if self.flush_thread is None:
+            self.flush_thread = threading.Thread(target=self._flush_later, daemon=True)
+            self.flush_thread.start()
+
+    def _flush_later(self):
+        time.sleep(self.write_behind_interval)
+        with self.lock:
+            # Mutations made from now on schedule the next flush
+            self.flush_thread = None
+            self.flush()
+
+    def _catch_up(self):
+        """
+        Apply the journal records appended by other processes since the last read,
+        after writing the pending write-behind records. Needs the process lock.
+        """
+        if not self.pending:
+            return self._read_journal()
+
+        lines, self.pending = self.pending, []
+        tables = self.db
+        changed = self._read_journal()
+        records = []
+        for line in lines:
+            self.seq += 1
+            records.append(line[:-1] + ', "seq": %d}' % self.seq)
+        self._write_record('\n'.join(records))
+        self.coalesced_writes += len(lines) - 1
+        if changed or self.db is not tables:
+            # The other process' records were applied after ours in memory but come first in the journal,
+            # or a reload after its compaction dropped ours
+            self.load_db()
+        return changed
+
+    def _read_journal(self):
+        seq = self.seq
+        if os.stat(self.journal_path).st_ino != self.journal_inode:
+            # Another process compacted the journal, start over from the snapshot and the journals
+            self.load_db()
+        elif os.path.getsize(self.journal_path) != self.journal_size:
+            self._replay(self.journal_path, self.journal_size)
+            self.journal_size = os.fstat(self.journal.fileno()).st_size
+        return self.seq != seq
+
+    def _replay(self, journal_path, offset=0, truncate_torn=True):
+        if not journal_path.exists():
+            return
+
+        with journal_path.open('rb+' if truncate_torn else 'rb') as f:
+            f.seek(offset)
+            for line in f:
+                try:
+                    if not line.endswith(b'\n'):
+                        raise ValueError("Incomplete record")
+                    record = json.loads(line)
+                except ValueError:
+                    # A torn record left by a crash in the middle of an append, drop it
+                    print(f"Dropping a torn record at the end of {journal_path}")
+                    if truncate_torn:
+                        f.truncate(offset)
+                    break
+                offset += len(line)
+                if record['seq'] > self.seq:
+                    self._apply(record)
+                    self.seq = record['seq']
+
+    def _open_journal(self):
+        if self.journal is not None:
+            self.journal.close()
+        self.journal = self.journal_path.open('a', encoding='utf-8')
+        self.journal_size = self.journal.tell()
+        self.journal_inode = os.fstat(self.journal.fileno()).st_ino
+
+    @contextmanager
+    def transaction(self):
+        """
+        Group mutations into one durable write at the end of the block.
+        If the block raises, the in-memory state is rolled back and nothing is written.
+        Nested transactions are part of the outermost one.
+        """
+        with self._process_lock():
+            if self.batch is not None:
+                yield self
+                return
+
+            # The other processes' writes go first, and wait for this transaction to end
+            self._catch_up()
+            self.batch = []
+            # Tables as they were before the transaction touched them, and copies of the updated rows
+            self.rollback_tables = {}
+            self.rollback_rows = []
+            try:
+                yield self
+            except BaseException:
+                self._rollback()
+                raise
+            else:
+                ops, self.batch = self.batch, None
+                if ops and self.write_behind_interval > 0:
+                    self.pending.append('{"op": "batch", "ops": [' + ', '.join(ops) + ']}')
+                    self._schedule_flush()
+                elif ops:
+                    try:
+                        self._write_record(
+                            '{"op": "batch", "ops": [' + ', '.join(ops) + '], "seq": %d}' % (self.seq + 1))
+                    except BaseException:
+                        # The batch is not in the journal, so it must not stay in memory either
+                        self._rollback()
+                        raise
+                    self.seq += 1
+            finally:
+                self.batch = None
+                self.rollback_tables = self.rollback_rows = None
+
+    def _rollback(self):
+        for item, saved in reversed(self.rollback_rows):
+            item.clear()
+            item.update(saved)
+        for table_name, rows in self.rollback_tables.items():
+            if rows is None:
+                self.db.pop(table_name, None)
+            else:
+                self.db[table_name] = rows
+
+        # The indexes of the touched tables may point to rolled back rows
+        for table_name, key in list(self.indexes):
+            if table_name in self.rollback_tables:
+                del self.indexes[(table_name, key)]
+                self.ensure_index(table_name, key)
+
+    def _append(self, record):
+        """Apply an operation and append it to the journal, or to the open transaction."""
+        with self.lock:
+            if self.batch is not None:
+                table_name = record['table']
+                if table_name not in self.rollback_tables:
+                    table = self.db.get(table_name)
+                    self.rollback_tables[table_name] = None if table is None else list(table)
+                if record['op'] == 'update':
+                    self.rollback_rows.extend((item, dict(item)) for item in self._matching_rows(
+                        table_name, record['key'], record['value']))
+                self.batch.append(json.dumps(record))
+                self._apply(record)
+                return
+
+            if self.write_behind_interval > 0:
+                line = json.dumps(record)
+                self._apply(record)
+                self.pending.append(line)
+                self._schedule_flush()
+                return
+
+            with self._process_lock():
+                self._catch_up()
+                record['seq'] = self.seq + 1
+                self._write_record(json.dumps(record))
+                self._apply(record)
+                self.seq += 1
+
+    def _write_record(self, line):
+        with self.lock:
+            line += '\n'
+            try:
+                self.journal.write(line)
+                self.journal.flush()
+                if config.DB_JOURNAL_FSYNC:
+                    os.fsync(self.journal.fileno())
+            except BaseException:
+                # Drop whatever part of the record reached the file, the caller doesn't apply it
+                try:
+                    self.journal.truncate(self.journal_size)
+                except (OSError, ValueError):
+                    pass
+                raise
+            self.journal_size += len(line)
+
+            if self.journal_size >= config.DB_JOURNAL_COMPACT_BYTES and self.compaction_thread is None:
+                self.compaction_thread = threading.Thread(
+                    target=self._compact_in_background, daemon=True)
+                self.compaction_thread.start()
+
+    def _compact_in_background(self):
+        try:
+            self.compact()
+        finally:
+            self.compaction_thread = None
+
+    def compact(self):
+        """Fold the journal into a fresh snapshot written with write-to-temp and atomic rename."""
+        with self.compaction_lock:
+            if fcntl is not None:
+                try:
+                    fcntl.flock(self.compaction_lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    # Another process is compacting the same journal
+                    return
+            try:
+                self._compact()
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(self.compaction_lock_file, fcntl.LOCK_UN)
+
+    def _compact(self):
+        # Only serializing the state and switching journals holds up the writers
+        with self._process_lock():
+            self._catch_up()
+            snapshot = json.dumps(
+                {**self.db, SEQ_KEY: self.seq, VERSIONS_KEY: self.table_versions, ID_KEY: self.db_id}, indent=4)
+            self.journal.close()
+            self.journal = None
+            if self.compacting_journal_path.exists():
+                # A previous compaction did not finish, keep its records until this one does
+                with self.compacting_journal_path.open('ab') as dst, self.journal_path.open('rb') as src:
+                    dst.write(src.read())
+                self.journal_path.unlink()
+            else:
+                os.replace(self.journal_path, self.compacting_journal_path)
+            self._open_journal()
+
+        tmp_path = Path(f"{self.db_path}.{os.getpid()}.tmp")
+        with tmp_path.open('w') as f:
+            f.write(snapshot)
+            f.flush()
+            os.fsync(f.fileno())
+        # A process reloading in between must not see the new snapshot without the compacting journal or the reverse
+        with self._process_lock():
+            os.replace(tmp_path, self.db_path)
+            self.compacting_journal_path.unlink()
+
+    def version(self, table_name):
+        """
+        Return a string that changes whenever the table changes, to tell whether data compiled from it is stale.
+        It includes a random id of the database, so a recreated database never matches an old version.
+        """
+        return f"{self.db_id}:{self.table_versions.get(table_name, 0)}"
+
+    def _apply(self, record):
+        op = record['op']
+        if op == 'batch':
+            for batch_record in record['ops']:
+                self._apply(batch_record)
+            return
+        if op == 'meta':
+            self.db_id = record['id']
+            return
+
+        # The sequence number the record will be written with
+        self.table_versions[record['table']] = self.seq + len(self.pending) + 1
+        if op == 'insert':
+            self._insert(record['table'], record['data'])
+        elif op == 'update':
+            self._update(record['table'], record['data'],
+                         record['key'], record['value'])
+        elif op == 'remove':
+            self._remove(record['table'], record['key'], record['value'])
+
+    def _insert(self, table_name, data):
         if table_name not in self.db:
             self.db[table_name] = []
         self.db[table_name].append(data)
-        self.save_db()
+        for key, index in self._table_indexes(table_name):
+            index.setdefault(index_value(data.get(key)), []).append(data)
+
+    def _update(self, table_name, data, key, value):
+        rows = self._matching_rows(table_name, key, value)
+        # Only the indexes on the updated keys have to move the rows
+        changed_indexes = [(indexed_key, index) for indexed_key, index in self._table_indexes(table_name)
+                           if indexed_key in data]
+        for item in rows:
+            for indexed_key, index in changed_indexes:
+                self._unindex(index, indexed_key, item)
+            item.update(data)
+            for indexed_key, index in changed_indexes:
+                index.setdefault(index_value(item.get(indexed_key)), []).append(item)
+
+    def _remove(self, table_name, key, value):
+        rows = self._matching_rows(table_name, key, value)
+        if not rows:
+            return
+        for indexed_key, index in self._table_indexes(table_name):
+            for item in rows:
+                self._unindex(index, indexed_key, item)
+        removed = {id(item) for item in rows}
+        self.db[table_name] = [item for item in self.db.get(
+            table_name, []) if id(item) not in removed]
+
+    @staticmethod
+    def _unindex(index, key, item):
+        bucket_value = index_value(item.get(key))
+        bucket = index[bucket_value]
+        bucket[:] = [row for row in bucket if row is not item]
+        if not bucket:
+            del index[bucket_value]
+
+    def insert(self, table_name, data):
+        self._append({'op': 'insert', 'table': table_name, 'data': data})
 
     def search(self, table_name, key, value):
-        return [item for item in self.db.get(table_name, []) if item.get(key) == value]
+        return self._matching_rows(table_name, key, value)
 
     def update(self, table_name, data, key, value):
-        table = self.db.get(table_name, [])
-        for item in table:
-            if item.get(key) == value:
-                item.update(data)
-        self.save_db()
+        self._append({'op': 'update', 'table': table_name,
+                     'data': data, 'key': key, 'value': value})
 
     def remove(self, table_name, key, value):
-        self.db[table_name] = [item for item in self.db.get(
-            table_name, []) if item.get(key) != value]
-        self.save_db()
+        self._append({'op': 'remove', 'table': table_name,
+                     'key': key, 'value': value})
 
     def fetch_all(self, table_name):
         return self.db.get(table_name, [])
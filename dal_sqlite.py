@@ -0,0 +1,214 @@
+import json
+import secrets
+import sqlite3
+import sys
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from core.singleton_pattern import Singleton
+from dal_db import DalDB
+
+# SQLite storage with the same interface as DalDB.
+# Every table holds its rows as JSON documents, and the keys used by search/update/remove
+# get an expression index the first time they are queried, so lookups don't scan the table.
+# Several proxy processes can share the file, SQLite serializes their writes and refresh()
+# tells a process whether another one committed since it last looked.
+# The _versions table counts the writes to every table, its '' row holds a random id of the database.
+
+
+def quote_identifier(name):
+    return '"' + name.replace('"', '""') + '"'
+
+
+def key_expression(key):
+    """The SQL expression extracting a top-level key of the row documents."""
+    path = '$."' + key.replace('"', '\\"') + '"'
+    return "json_extract(data, '" + path.replace("'", "''") + "')"
+
+
+def where_clause(key, value):
+    """Build the condition matching rows whose key equals the value, as DalDB compares them."""
+    if isinstance(value, (list, dict)):
+        # json_extract returns lists and dicts as minified JSON text
+        return f"{key_expression(key)} = json(?)", json.dumps(value)
+    return f"{key_expression(key)} IS ?", value
+
+
+class DalSQLite(metaclass=Singleton):
+    def __init__(self, db_path='db.sqlite3', json_db_path='db.json'):
+        is_new = not Path(db_path).exists()
+        # Autocommit mode, transactions are opened explicitly
+        self.conn = sqlite3.connect(
+            db_path, check_same_thread=False, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        # Wait for the other processes' write transactions instead of failing with "database is locked"
+        self.conn.execute('PRAGMA busy_timeout=5000')
+        self.lock = threading.RLock()
+        self.in_transaction = False
+        self._load_schema()
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS _versions (name TEXT PRIMARY KEY, version INTEGER NOT NULL)")
+        self.conn.execute(
+            "INSERT OR IGNORE INTO _versions (name, version) VALUES ('', ?)", (secrets.randbits(62),))
+        self.data_version = self._data_version()
+
+        # One-shot migration of the JSON database the first time the SQLite backend is used
+        if is_new and Path(json_db_path).exists() and Path(json_db_path).stat().st_size:
+            self.migrate_json(json_db_path)
+
+    def _load_schema(self):
+        rows = self.conn.execute(
+            "SELECT type, name FROM sqlite_master WHERE type IN ('table', 'index')").fetchall()
+        self.tables = {name for kind, name in rows if kind == 'table'}
+        self.indexes = {name for kind, name in rows if kind == 'index'}
+
+    def _data_version(self):
+        # Changes whenever another connection commits to the database file
+        return self.conn.execute('PRAGMA data_version').fetchone()[0]
+
+    def refresh(self):
+        """Return True if another process changed the database since the last call."""
+        with self.lock:
+            data_version = self._data_version()
+            if data_version == self.data_version:
+                return False
+            self.data_version = data_version
+            # The other process may have created tables and indexes
+            self._load_schema()
+            return True
+
+    def _ensure_table(self, table_name):
+        if table_name not in self.tables:
+            self.conn.execute(
+                f"CREATE TABLE IF NOT EXISTS {quote_identifier(table_name)} "
+                "(id INTEGER PRIMARY KEY, data TEXT NOT NULL)")
+            self.tables.add(table_name)
+
+    def ensure_index(self, table_name, key):
+        """Create the expression index of the key, queried keys are also indexed on first use."""
+        index_name = f"{table_name}__{key}"
+        if index_name not in self.indexes:
+            with self.lock:
+                self._ensure_table(table_name)
+                self.conn.execute(
+                    f"CREATE INDEX IF NOT EXISTS {quote_identifier(index_name)} "
+                    f"ON {quote_identifier(table_name)} ({key_expression(key)})")
+                self.indexes.add(index_name)
+
+    def migrate_json(self, json_db_path):
+        """Copy every table of a JSON database (DalDB or TinyDB layout) into SQLite in one transaction."""
+        tables = DalDB.read(json_db_path)
+        with self.transaction():
+            for table_name, rows in tables.items():
+                # TinyDB stores a table as a dict of documents keyed by their id
+                rows = rows.values() if isinstance(rows, dict) else rows
+                self._ensure_table(table_name)
+                self.conn.executemany(
+                    f"INSERT INTO {quote_identifier(table_name)} (data) VALUES (?)",
+                    ((json.dumps(row),) for row in rows))
+                self._bump_version(table_name)
+
+    @contextmanager
+    def transaction(self):
+        """
+        Group mutations into one SQLite transaction committed at the end of the block,
+        and rolled back if the block raises. Nested transactions are part of the outermost one.
+        """
+        with self.lock:
+            if self.in_transaction:
+                yield self
+                return
+
+            self.conn.execute('BEGIN IMMEDIATE')
+            self.in_transaction = True
+            try:
+                yield self
+            except BaseException:
+                self.conn.execute('ROLLBACK')
+                # Tables created inside the transaction are gone
+                self._load_schema()
+                raise
+            else:
+                self.conn.execute('COMMIT')
+            finally:
+                self.in_transaction = False
+
+    def _bump_version(self, table_name):
+        self.conn.execute(
+            "INSERT INTO _versions (name, version) VALUES (?, 1) "
+            "ON CONFLICT(name) DO UPDATE SET version = version + 1", (table_name,))
+
+    def version(self, table_name):
+        """Return a string that changes whenever the table changes, to tell whether data compiled from it is stale."""
+        with self.lock:
+            rows = dict(self.conn.execute(
+                "SELECT name, version FROM _versions WHERE name IN ('', ?)", (table_name,)))
+            return f"{rows['']}:{rows.get(table_name, 0)}"
+
+    def flush(self):
+        # Every write is committed before it returns
+        pass
+
+    def insert(self, table_name, data):
+        with self.transaction():
+            self._ensure_table(table_name)
+            self.conn.execute(
+                f"INSERT INTO {quote_identifier(table_name)} (data) VALUES (?)", (json.dumps(data),))
+            self._bump_version(table_name)
+
+    def search(self, table_name, key, value):
+        if table_name not in self.tables:
+            return []
+        with self.lock:
+            self.ensure_index(table_name, key)
+            condition, param = where_clause(key, value)
+            rows = self.conn.execute(
+                f"SELECT data FROM {quote_identifier(table_name)} WHERE {condition} ORDER BY id", (param,))
+            return [json.loads(data) for data, in rows]
+
+    def update(self, table_name, data, key, value):
+        if table_name not in self.tables:
+            return
+        with self.transaction():
+            self.ensure_index(table_name, key)
+            condition, param = where_clause(key, value)
+            rows = self.conn.execute(
+                f"SELECT id, data FROM {quote_identifier(table_name)} WHERE {condition}", (param,)).fetchall()
+
+            # Rows are merged in Python to keep the shallow dict.update semantics of DalDB
+            updated = []
+            for row_id, row_data in rows:
+                item = json.loads(row_data)
+                item.update(data)
+                updated.append((json.dumps(item), row_id))
+            self.conn.executemany(
+                f"UPDATE {quote_identifier(table_name)} SET data = ? WHERE id = ?", updated)
+            self._bump_version(table_name)
+
+    def remove(self, table_name, key, value):
+        if table_name not in self.tables:
+            return
+        with self.transaction():
+            self.ensure_index(table_name, key)
+            condition, param = where_clause(key, value)
+            self.conn.execute(
+                f"DELETE FROM {quote_identifier(table_name)} WHERE {condition}", (param,))
+            self._bump_version(table_name)
+
+    def fetch_all(self, table_name):
+        if table_name not in self.tables:
+            return []
+        with self.lock:
+            rows = self.conn.execute(
+                f"SELECT data FROM {quote_identifier(table_name)} ORDER BY id")
+            return [json.loads(data) for data, in rows]
+
+
+if __name__ == '__main__':
+    # One-shot migration: python dal_sqlite.py [db.json] [db.sqlite3]
+    json_path = sys.argv[1] if len(sys.argv) > 1 else 'db.json'
+    sqlite_path = sys.argv[2] if len(sys.argv) > 2 else 'db.sqlite3'
+    if Path(sqlite_path).exists():
+        sys.exit(f"{sqlite_path} already exists")
+    DalSQLite(sqlite_path, json_path)
+    print(f"Migrated {json_path} to {sqlite_path}")
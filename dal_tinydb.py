@@ -1,29 +1,113 @@
+import json
+import os
+import threading
+from contextlib import contextmanager
 from tinydb import TinyDB, Query
+from tinydb.storages import MemoryStorage
+from core.singleton_pattern import Singleton
 
 
-class DalTinyDB:
+class DalTinyDB(metaclass=Singleton):
     def __init__(self, db_path='db.json'):
+        self.db_path = db_path
         self.db = TinyDB(db_path)
+        # TinyDB is not thread-safe, the plugins call it from the blocking pool
+        self.lock = threading.RLock()
+        self.in_transaction = False
+        self.mtime = self._mtime()
+
+    def _mtime(self):
+        try:
+            return os.stat(self.db_path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def version(self, table_name):
+        """Return a string that changes whenever the database file changes, TinyDB keeps no per-table counter."""
+        try:
+            stat = os.stat(self.db_path)
+        except FileNotFoundError:
+            return ''
+        return f"{stat.st_ino}:{stat.st_mtime_ns}:{stat.st_size}"
+
+    def refresh(self):
+        """
+        Return True if the database file changed since the last call.
+        TinyDB reads the file on every query, so there is nothing to reload, and writes
+        made by this process are reported too.
+        """
+        mtime = self._mtime()
+        if mtime == self.mtime:
+            return False
+        self.mtime = mtime
+        return True
+
+    @contextmanager
+    def transaction(self):
+        """
+        Apply the mutations of the block to an in-memory copy of the database
+        and write it once at the end with write-to-temp and atomic rename.
+        If the block raises, the copy is dropped and the file is untouched.
+        """
+        with self.lock:
+            if self.in_transaction:
+                yield self
+                return
+
+            file_db = self.db
+            memory_db = TinyDB(storage=MemoryStorage)
+            memory_db.storage.write(file_db.storage.read() or {})
+            self.db = memory_db
+            self.in_transaction = True
+            try:
+                yield self
+            except BaseException:
+                self.db = file_db
+                raise
+            else:
+                tmp_path = self.db_path + '.tmp'
+                with open(tmp_path, 'w') as f:
+                    json.dump(memory_db.storage.read(), f)
+                    f.flush()
+                    os.fsync(f.fileno())
+                file_db.close()
+                os.replace(tmp_path, self.db_path)
+                self.db = TinyDB(self.db_path)
+            finally:
+                self.in_transaction = False
 
     def insert(self, table_name, data):
-        table = self.db.table(table_name)
-        table.insert(data)
+        with self.lock:
+            table = self.db.table(table_name)
+            table.insert(data)
 
     def search(self, table_name, key, value):
-        table = self.db.table(table_name)
-        item_query = Query()
-        return table.search(item_query[key] == value)
+        with self.lock:
+            table = self.db.table(table_name)
+            item_query = Query()
+            return table.search(item_query[key] == value)
 
     def update(self, table_name, data, key, value):
-        table = self.db.table(table_name)
-        item_query = Query()
-        table.update(data, item_query[key] == value)
+        with self.lock:
+            table = self.db.table(table_name)
+            item_query = Query()
+            table.update(data, item_query[key] == value)
 
     def remove(self, table_name, key, value):
-        table = self.db.table(table_name)
-        item_query = Query()
-        table.remove(item_query[key] == value)
+        with self.lock:
+            table = self.db.table(table_name)
+            item_query = Query()
+            table.remove(item_query[key] == value)
+
+    def flush(self):
+        # Every write reaches the file before it returns
+        pass
+
+    def ensure_index(self, table_name, key):
+        # TinyDB has no secondary indexes, its queries always scan the table
+        pass
 
     def fetch_all(self, table_name):
-        table = self.db.table(table_name)
-        return table.all()
+        with self.lock:
+            table = self.db.table(table_name)
+            return table.all()
@@ -1,36 +1,101 @@
+import inspect
+from time import perf_counter
 from typing import List
+from core import metrics
+from core.admin_router import AdminRouter, is_admin_host
 from core.iflow import IFlow
 from core.plugin_base import PluginBase
+from core.plugin_loader import LazyPlugin
+
+
+def compile_hooks(plugins: List[PluginBase], hook_name: str) -> tuple:
+    """
+    Collect the bound hook methods of the plugins, in order,
+    skipping plugins that don't override the hook of PluginBase.
+    Each hook is paired with whether it is a coroutine function, so only async hooks are awaited,
+    and with the metrics of the plugin's hook.
+    The hooks of a plugin that is not loaded yet are taken from the plugin manifest.
+    """
+    base_hook = getattr(PluginBase, hook_name, None)
+    hooks = []
+    for plugin in plugins:
+        if isinstance(plugin, LazyPlugin):
+            lazy_hook = plugin.hook(hook_name)
+            if lazy_hook is None:
+                continue
+            hook, is_async = lazy_hook
+        elif getattr(type(plugin), hook_name, base_hook) is base_hook:
+            continue
+        else:
+            hook = getattr(plugin, hook_name)
+            is_async = inspect.iscoroutinefunction(hook)
+        hooks.append((hook, is_async, metrics.get_hook_stats(plugin.title(), hook_name)))
+    return tuple(hooks)
+
+
+async def run_hooks(hooks: tuple, flow: IFlow) -> bool:
+    """
+    Run the hooks in order, stopping at the first one that returns a falsy value.
+    Return False if a hook stopped the pipeline.
+    """
+    for hook, is_async, stats in hooks:
+        start = perf_counter()
+        result = hook(flow)
+        if is_async:
+            result = await result
+        stats.observe(perf_counter() - start, result)
+        if not result:
+            return False
+    return True
 
 
 class Manager():
+    """
+    Dispatch pipeline of a plugins list.
+    The hooks are compiled once when the list changes and the same Manager serves every flow.
+    """
+
+    def __init__(self,  plugins: List[PluginBase]):
+        self.plugins = tuple(plugins)
+        self.request_hooks = compile_hooks(self.plugins, 'on_request')
+        self.response_headers_hooks = compile_hooks(
+            self.plugins, 'on_response_headers')
+        self.response_hooks = compile_hooks(self.plugins, 'on_response')
 
-    def __init__(self,  plugins: List[PluginBase], flow: IFlow):
-        self.plugins = plugins
-        self.flow = flow
+        # The settings.it API handlers of all the plugins in the list
+        self.router = AdminRouter()
+        self.router.add("GET", "/api/metrics", metrics.handle_metrics)
+        for plugin in self.plugins:
+            plugin.register_routes(self.router)
 
         print('Starting with the following plugins')
         for plugin in self.plugins:
             print(plugin.title())
 
-    def on_request(self):
+    async def on_request(self, flow: IFlow):
         """
         Execute the onRequest method for each plugin in the list.
         Stops execution if a plugin's onRequest method returns False.
+        Requests to settings.it are dispatched to the admin router instead.
         """
-        for plugin in self.plugins:
-            if hasattr(plugin, 'on_request'):
-                flag = plugin.on_request(self.flow)
-                if (not flag):
-                    break
+        if is_admin_host(flow.get_host()):
+            if not await self.router.dispatch(flow):
+                flow.make_response(404, b"Not found", {
+                                   "Content-Type": "text/plain"})
+            return
+
+        metrics.count_verdict('on_request', await run_hooks(self.request_hooks, flow))
 
-    def on_response(self):
+    async def on_response(self, flow: IFlow):
         """
         Execute the onResponse method for each plugin in the list.
         Stops execution if a plugin's onResponse method returns False.
         """
-        for plugin in self.plugins:
-            if hasattr(plugin, 'on_response'):
-                flag = plugin.on_response(self.flow)
-                if (not flag):
-                    break
+        metrics.count_verdict('on_response', await run_hooks(self.response_hooks, flow))
+
+    async def on_response_headers(self, flow: IFlow):
+        """
+        Execute the onResponseHeaders method for each plugin in the list.
+        Stops execution if a plugin's onResponseHeaders method returns False.
+        """
+        metrics.count_verdict('on_response_headers', await run_hooks(self.response_headers_hooks, flow))
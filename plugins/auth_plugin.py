@@ -1,26 +1,26 @@
 import json
+import config
+from core.executor import run_blocking
 from core.iflow import IFlow
+from core.passwords import ClientLimiter, hash_password, needs_rehash, run_hashing, start_dummy_hash, verify_password
 from core.plugin_base import PluginBase
-import random
-import string
-import hashlib
+from core.session_store import SessionStore
 
-from dal_db import DalDB
+from dal import get_db
 
-
-def random_string(length: int):
-    # Generate a random string of specified length using letters and digits.
-    letters = string.ascii_letters + string.digits
-    return ''.join(random.choice(letters) for i in range(length))
-
-
-# Generate a random session string
-session = random_string(20)
+# Name of the cookie holding the session token
+SESSION_COOKIE = 'session'
 
 
 class AuthPlugin(PluginBase):
     def __init__(self) -> None:
-        self.db = DalDB()
+        self.db = get_db()
+        self.db.ensure_index('users', 'user-name')
+        self.hashing_limiter = ClientLimiter(config.PASSWORD_HASH_PER_CLIENT)
+        start_dummy_hash()
+        # Every login gets its own session, see core/session_store.py
+        self.sessions = SessionStore(config.SESSION_TTL, config.SESSION_MAX,
+                                     self.db if config.SESSION_PERSIST else None)
 
     def title(self):
         return 'Auth'
@@ -37,79 +37,103 @@ class AuthPlugin(PluginBase):
                                "Content-Type": "application/json"})
 
     def is_logged_in(self, flow: IFlow):
-        """Check if the user is logged in by comparing the current session to the cookie's settion."""
-        result = flow.get_cookie('session') == session
-        return result
+        """Check if the session of the request's cookie is live, extending it."""
+        return self.sessions.get(flow.get_cookie(SESSION_COOKIE)) is not None
 
-    def register(self, flow: IFlow, un: str, pw: str):
-        """Register a new user with username and hashed password."""
-        # Hash the password using SHA-256 and encode it in hexadecimal format
-        hashed_pw = hashlib.sha256(pw.encode()).hexdigest()
-        password_in_db = self.db.search('users', 'password', hashed_pw)
+    def session_cookie(self, token: str) -> str:
+        """The value of the Set-Cookie header carrying a session token."""
+        return f"{token}; Path=/; Max-Age={int(config.SESSION_TTL)}; HttpOnly; SameSite=Strict"
 
-        if password_in_db is not None:
-            response_content = json.dumps({'message': 'Try another password'})
+    async def register(self, flow: IFlow, un: str, pw: str):
+        """Register a new user with username and hashed password."""
+        if not un or not pw:
+            flow.make_response(400, json.dumps({'message': 'User name and password are required'}), {
+                               "Content-Type": "application/json"})
+            return
+        # The salted hashes of two equal passwords differ, the user name is what must be unique
+        if await run_blocking(self.db.search, 'users', 'user-name', un):
+            response_content = json.dumps({'message': 'Try another user name'})
             flow.make_response(
                 403, response_content, {"Content-Type": "application/json"})
+            return
 
-        self.db.insert('users', {'user-name': un, 'password': hashed_pw})
+        hashed_pw = await run_hashing(hash_password, pw)
+        await run_blocking(self.db.insert, 'users', {'user-name': un, 'password': hashed_pw})
         response_content = json.dumps({'message': 'You have registerd.'})
         flow.make_response(
             200, response_content, {"Content-Type": "application/json"})
 
-    def log_in(self, flow: IFlow, un: str, pw: str):
+    async def log_in(self, flow: IFlow, un: str, pw: str):
         """Log in a user with username and password."""
-        user = self.db.search('users', 'user-name', un)
-        if user is None:
-            response_content = json.dumps({'message': 'Invalid cridentials'})
-            flow.make_response(
-                403, response_content, {"Content-Type": "application/json"})
+        user = await run_blocking(self.db.search, 'users', 'user-name', un)
+        stored_hashed_password = user[0]['password'] if user else None
 
-        stored_hashed_password = user[0]['password']
         # Hash the inpute password to compare with the stored hashed password
-        hashed_input_password = hashlib.sha256(pw.encode()).hexdigest()
-
-        if hashed_input_password == stored_hashed_password:
+        if pw and await run_hashing(verify_password, pw, stored_hashed_password):
+            if needs_rehash(stored_hashed_password):
+                # A legacy SHA-256 hash, replaced now that the password is known
+                hashed_pw = await run_hashing(hash_password, pw)
+                await run_blocking(self.db.update, 'users', {'password': hashed_pw}, 'user-name', un)
+            token = await run_blocking(self.sessions.create, un)
             response_content = json.dumps({'message': 'You are logged in.'})
             flow.make_response_with_cookie(
-                200, response_content, {"Content-Type": "application/json"}, 'session', session)
+                200, response_content, {"Content-Type": "application/json"},
+                SESSION_COOKIE, self.session_cookie(token))
         else:
-            esponse_content = json.dumps({'message': 'Invalid cridentials.'})
+            response_content = json.dumps({'message': 'Invalid cridentials.'})
             flow.make_response(
-                403, esponse_content, {"Content-Type": "application/json"})
-
-    def on_request(self, flow: IFlow) -> bool:
-        host = flow.get_host()
-
-        # Handle authentication-related API requests for the "settings.it" host
-        if host == "settings.it":
-            req = flow.get_request()
-
-            # Habdle user is authenticated check
-            if req.path.endswith("api/auth/check"):
-                if self.is_logged_in(flow):
-                    response_content = json.dumps(
-                        {'authenticated': True, 'message': 'user is authenticated'})
-                    flow.make_response(200, response_content, {
-                                       "Content-Type": "application/json"})
-                else:
-                    response_content = json.dumps(
-                        {'authenticated': False, 'message': 'user is Not authenticated'})
-                    flow.make_response(403, response_content, {
-                                       "Content-Type": "application/json"})
-
-            # Handle login and registration requests
-            elif req.path.endswith("api/auth/login") or req.path.endswith("api/auth/register"):
-                un = json.loads(req.content.decode()).get('username')
-                pw = json.loads(req.content.decode()).get('password')
-
-                if req.path.endswith("api/auth/login"):
-                    self.log_in(flow, un, pw)
-                else:
-                    self.register(flow, un, pw)
-
-            # Handle user existence check
-            elif req.path.endswith("api/auth/any"):
-                self.user_exist(flow)
-
-        return True
+                403, response_content, {"Content-Type": "application/json"})
+
+    def check(self, flow: IFlow) -> None:
+        """Handle the user is authenticated check."""
+        if self.is_logged_in(flow):
+            response_content = json.dumps(
+                {'authenticated': True, 'message': 'user is authenticated'})
+            flow.make_response(200, response_content, {
+                               "Content-Type": "application/json"})
+        else:
+            response_content = json.dumps(
+                {'authenticated': False, 'message': 'user is Not authenticated'})
+            flow.make_response(403, response_content, {
+                               "Content-Type": "application/json"})
+
+    def log_out(self, flow: IFlow) -> None:
+        """End the session of the request's cookie."""
+        self.sessions.delete(flow.get_cookie(SESSION_COOKIE))
+        flow.make_response_with_cookie(
+            200, json.dumps({'message': 'You are logged out.'}), {"Content-Type": "application/json"},
+            SESSION_COOKIE, "; Path=/; Max-Age=0; HttpOnly; SameSite=Strict")
+
+    # The database access runs on the blocking pool and the password hashing on the hashing pool
+    # (see core/passwords.py), a client gets a 429 while it has too many hashes in progress
+
+    async def _handle_login(self, flow: IFlow) -> None:
+        await self._limit_client(flow, self.log_in)
+
+    async def _handle_register(self, flow: IFlow) -> None:
+        await self._limit_client(flow, self.register)
+
+    @staticmethod
+    def _client_key(flow: IFlow):
+        # Behind the supervisor's relay every client has the loopback address, limit each connection instead
+        return flow.get_connection_id() if config.BEHIND_RELAY else flow.get_client_ip()
+
+    async def _limit_client(self, flow: IFlow, handler) -> None:
+        client = self._client_key(flow)
+        if not self.hashing_limiter.acquire(client):
+            flow.make_response(429, json.dumps({'message': 'Too many attempts, try again shortly.'}), {
+                               "Content-Type": "application/json", "Retry-After": "1"})
+            return
+        try:
+            req = json.loads(flow.get_request().content.decode())
+            await handler(flow, req.get('username'), req.get('password'))
+        finally:
+            self.hashing_limiter.release(client)
+
+    def register_routes(self, router):
+        """Route the authentication-related API requests of the "settings.it" host."""
+        router.add("GET", "/api/auth/check", self.check)
+        router.add("POST", "/api/auth/login", self._handle_login)
+        router.add("POST", "/api/auth/register", self._handle_register)
+        router.add("POST", "/api/auth/logout", self.log_out)
+        router.add("GET", "/api/auth/any", self.user_exist)
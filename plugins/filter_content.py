@@ -1,11 +1,20 @@
 import json
+import os
 import re
+import threading
+import config
+from functools import lru_cache
+from core.domain_index import iter_suffixes, normalize_host
+from core.executor import run_blocking
 from core.iflow import IFlow
 from core.plugin_base import PluginBase
+from core.policy_snapshot import SnapshotWriter, open_snapshot
+from core.profiles import ProfileStore
+from core.verdict_cache import MISS, PolicyGeneration, VerdictCache
 from typing import Dict, Any
 from contenttype import ContentType
 
-from dal_db import DalDB
+from dal import get_db
 
 HTTP_OK = 200
 HTTP_BAD_REQUEST = 400
@@ -17,6 +26,72 @@ CONTENT_TYPE_TEXT = "text/plain"
 # this plugin is handling a list of allowed MIME contet types for each appreved domain
 # in case the user did not create a list of allowed content types the domain won't be restricted
 # and will pass with all content types.
+# The list is compiled into a dict keyed by domain with one combined regular expression
+# of the allowed types, so a response costs one dict lookup per label of its host and a single match.
+# The table is also compiled into a policy snapshot (see core/policy_snapshot.py) which is mapped
+# instead while it is up to date, its patterns are then compiled on demand.
+#
+# Every content rule is a regular expression matched case-insensitively against the whole "type/subtype" media type,
+# with two shortcuts:
+#   video      - a bare top-level type allows all of its subtypes ("video/mp4", "video/webm", ...)
+#   image/*    - a "*" at the start or right after "/" is a wildcard ("image/.*")
+#
+# A client whose profile (see core/profiles.py) has its own content rules is checked against those instead,
+# they are compiled the first time a client of the profile needs them.
+
+
+@lru_cache(maxsize=256)
+def parse_media_type(content_type_header: str) -> str:
+    """Return the "type/subtype" of a Content-Type header, memoized since there are few distinct values."""
+    content_type = ContentType.parse(content_type_header)
+    return content_type.value.split(';', 1)[0].strip()
+
+
+def translate_content_pattern(pattern: str) -> str:
+    """
+    Translate one content rule into a regular expression for the full media type, to compile with re.IGNORECASE.
+    Raises re.error if the rule is not a valid pattern.
+    """
+    # The rule keeps its case, lowering it would turn escapes like "\S" into "\s"
+    pattern = re.sub(r'(^|/)\*', r'\1.*', pattern.strip())
+    if '/' not in pattern:
+        pattern = f'(?:{pattern})/.*'
+    re.compile(pattern, re.IGNORECASE)
+    return pattern
+
+
+def compile_content_patterns(patterns):
+    """
+    Combine the rules of one domain into a single alternation.
+    A stored rule that is not a valid pattern (saved before the rules were validated) is matched as plain text,
+    so the media type it names stays allowed.
+    """
+    translated = []
+    for pattern in patterns:
+        try:
+            translated.append(translate_content_pattern(pattern))
+        except re.error as e:
+            print(f"Invalid content pattern {pattern!r} ({e}), matching it as plain text")
+            literal = pattern.strip()
+            translated.append(re.escape(literal) if '/' in literal else f'{re.escape(literal)}/.*')
+    return re.compile('|'.join(f'(?:{pattern})' for pattern in translated) or '(?!)', re.IGNORECASE)
+
+
+@lru_cache(maxsize=1024)
+def compile_snapshot_patterns(patterns: tuple):
+    """Compile the rules of one domain read from the snapshot, memoized since many domains share the same rules."""
+    return compile_content_patterns(patterns)
+
+
+class SnapshotContents:
+    """The compiled contents of a policy snapshot, with the get() of the in-memory dict."""
+
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+
+    def get(self, domain):
+        patterns = self.snapshot.lookup(domain)
+        return None if patterns is None else compile_snapshot_patterns(tuple(patterns))
 
 
 class FilterContent(PluginBase):
@@ -25,23 +100,91 @@ class FilterContent(PluginBase):
         Initialize the FilterContent plugin with a database connection
         and fetch the list of allowed content types of approved domains.
         """
-        self.db = DalDB()
-        result = self.db.fetch_all('contents')
-        self.contents = result if result is not None else []
+        self.db = get_db()
+        self.db.ensure_index('contents', 'domain_name')
+        self.verdict_cache = VerdictCache(
+            'filter_content', config.VERDICT_CACHE_SIZE, config.VERDICT_CACHE_TTL)
+        # Serializes the admin changes with swapping in a freshly written snapshot
+        self.policy_lock = threading.RLock()
+        self.profiles = ProfileStore()
+        # The table version the in-memory contents were fetched at
+        self.policy_version = None
+        self.snapshot_writer = None
+        if config.POLICY_SNAPSHOT_DIR:
+            self.snapshot_writer = SnapshotWriter(
+                os.path.join(config.POLICY_SNAPSHOT_DIR, 'filter_content.snapshot'),
+                self._build_snapshot, self._map_snapshot)
+        self.reload_policy()
+
+    def reload_policy(self):
+        self.profiles.reload()
+        with self.policy_lock:
+            if self._map_snapshot():
+                PolicyGeneration().bump()
+                return
+            self._replace_contents(*self._fetch_contents())
+
+    def _fetch_contents(self):
+        """Return the version of the contents table and its rows."""
+        # The version is read first, a change racing with the fetch only makes the snapshot look stale
+        version = self.db.version('contents')
+        return version, self.db.fetch_all('contents')
+
+    def _replace_contents(self, version, contents):
+        """Swap in the contents fetched at the version, the snapshot is stamped with that version."""
+        with self.policy_lock:
+            self.policy_version = version
+            self.contents = contents if contents is not None else []
+
+    def _build_snapshot(self):
+        # The contents and the version they were fetched at are taken together, the live table version
+        # may already count a change the contents don't have yet
+        with self.policy_lock:
+            table = {entry['domain_name'].lstrip('=*.'): list(entry['content']) for entry in self.contents}
+            return self.policy_version, (), table
+
+    def _map_snapshot(self):
+        """Look up the snapshot if it is up to date with the table, the list is then dropped until needed."""
+        if self.snapshot_writer is None:
+            return False
+        with self.policy_lock:
+            version = self.db.version('contents')
+            snapshot = open_snapshot(self.snapshot_writer.path, version)
+            if snapshot is None:
+                return False
+            self.policy_version = version
+            self.compiled_contents = SnapshotContents(snapshot)
+            self._contents = None
+            return True
+
+    @property
+    def contents(self):
+        if self._contents is None:
+            result = self.db.fetch_all('contents')
+            self._contents = result if result is not None else []
+        return self._contents
+
+    @contents.setter
+    def contents(self, contents):
+        """Replace the contents list and recompile the domain index and patterns from it."""
+        with self.policy_lock:
+            self._contents = contents
+            # Domain names may be written as white list rules ("=a.com", "*.a.com"), key them by the bare domain
+            self.compiled_contents = {
+                normalize_host(entry['domain_name'].lstrip('=*.')): compile_content_patterns(entry['content'])
+                for entry in contents}
+            PolicyGeneration().bump()
+            if self.snapshot_writer is not None:
+                self.snapshot_writer.schedule()
 
     def title(self) -> str:
         return "Filter Content"
 
-    def _handle_request(self, method: str, flow: Any):
-        """Handle HTTP requests based on the method type."""
-        if method == "GET":
-            self._handle_get(flow)
-        elif method == "POST":
-            self._handle_post(flow)
-        elif method == "PUT":
-            self.handle_put(flow)
-        elif method == "DELETE":
-            self._handle_delete(flow)
+    def register_routes(self, router):
+        """Route "settings.it/api/contents" to the CRUD operations for the allowed MIME content types list."""
+        router.add("GET", "/api/contents", self._handle_get)
+        router.add("POST", "/api/contents", self._handle_post)
+        router.add("DELETE", "/api/contents", self._handle_delete)
 
     def _handle_get(self, flow: Any):
         """Return list of all the domains with their allowed content types."""
@@ -49,7 +192,7 @@ class FilterContent(PluginBase):
         flow.make_response(HTTP_OK, response_content, {
                            "Content-Type": CONTENT_TYPE_JSON})
 
-    def _handle_post(self, flow: Any):
+    async def _handle_post(self, flow: Any):
         """Add allowed content type to one of the approved domains."""
         try:
             content_data = json.loads(flow.get_request().content.decode())
@@ -62,23 +205,15 @@ class FilterContent(PluginBase):
                                    "Content-Type": CONTENT_TYPE_TEXT})
                 return
 
-            existing_contents = self.db.search(
-                'contents', 'domain_name', domain_name)
-
-            if existing_contents:
-                existing_content = existing_contents[0]
-                content_list = existing_content['content']
-
-                if content not in content_list:
-                    content_list.append(content)
-                    self.db.update(
-                        'contents', {'content': content_list}, 'domain_name', domain_name)
-            else:
-                self.db.insert(
-                    'contents', {'domain_name': domain_name, 'content': [content]})
+            # Reject invalid patterns here instead of discovering them while filtering responses
+            try:
+                translate_content_pattern(content)
+            except re.error as e:
+                flow.make_response(HTTP_BAD_REQUEST, f"Invalid content pattern: {e}", {
+                                   "Content-Type": CONTENT_TYPE_TEXT})
+                return
 
-            result = self.db.fetch_all('contents')
-            self.contents = result
+            self._replace_contents(*await run_blocking(self._save_content, domain_name, content))
             flow.make_response(HTTP_OK, "Content added successfully", {
                 "Content-Type": CONTENT_TYPE_TEXT})
 
@@ -87,7 +222,26 @@ class FilterContent(PluginBase):
             flow.make_response(HTTP_BAD_REQUEST, "Something went wrong while updating the content-types list", {
                                "Content-Type": CONTENT_TYPE_TEXT})
 
-    def _handle_delete(self, flow: Any):
+    def _save_content(self, domain_name, content):
+        """Add the content type to the domain's entry in the database and return the version and rows of the table."""
+        existing_contents = self.db.search(
+            'contents', 'domain_name', domain_name)
+
+        if existing_contents:
+            existing_content = existing_contents[0]
+            content_list = existing_content['content']
+
+            if content not in content_list:
+                content_list.append(content)
+                self.db.update(
+                    'contents', {'content': content_list}, 'domain_name', domain_name)
+        else:
+            self.db.insert(
+                'contents', {'domain_name': domain_name, 'content': [content]})
+
+        return self._fetch_contents()
+
+    async def _handle_delete(self, flow: Any):
         """Delete one content type from the allowed content types list."""
         try:
             content_data = json.loads(flow.get_request().content.decode())
@@ -99,13 +253,12 @@ class FilterContent(PluginBase):
                     if content_to_delete in content['content']:
                         content['content'].remove(content_to_delete)
                         if len(content['content']) == 0:
-                            self.db.remove(
-                                "contents", "domain_name", domain_name)
+                            await run_blocking(self.db.remove,
+                                               "contents", "domain_name", domain_name)
                         else:
-                            self.db.update(
-                                'contents', {'content': content['content']}, 'domain_name', domain_name)
-                    result = self.db.fetch_all('contents')
-                    self.contents = result if result is not None else []
+                            await run_blocking(self.db.update,
+                                               'contents', {'content': content['content']}, 'domain_name', domain_name)
+                    self._replace_contents(*await run_blocking(self._fetch_contents))
 
                     flow.make_response(HTTP_OK, "Content deleted successfully", {
                                        "Content-Type": CONTENT_TYPE_TEXT})
@@ -116,38 +269,50 @@ class FilterContent(PluginBase):
             flow.make_response(HTTP_BAD_REQUEST, "Something went wrong while removing item from the content-types list", {
                                "Content-Type": CONTENT_TYPE_TEXT})
 
-    def on_request(self, flow: IFlow) -> bool:
-        host = flow.get_host()
-        normalized_host = host[len("www."):] if host.startswith(
-            "www.") else host
+    def _find_allowed_contents(self, normalized_host: str, compiled_contents=None):
+        """Return the allowed content types pattern of the most specific domain matching the host, or None."""
+        if compiled_contents is None:
+            compiled_contents = self.compiled_contents
+        for suffix in iter_suffixes(normalized_host):
+            allowed_contents = compiled_contents.get(suffix)
+            if allowed_contents is not None:
+                return allowed_contents
+        return None
 
-        # Redirect requests to "settings.it/api/contents" to the CRUD operations for the allowed MIME content types list
-        if normalized_host == "settings.it":
-            req = flow.get_request()
-            if req.path.endswith("/api/contents"):
-                self._handle_request(req.method, flow)
-
-            return True
+    @staticmethod
+    def _profile_contents(profile):
+        """Return the compiled content rules of a profile, compiling them on first use."""
+        if profile.compiled_contents is None:
+            profile.compiled_contents = {
+                normalize_host(domain.lstrip('=*.')): compile_content_patterns(patterns)
+                for domain, patterns in profile.contents.items()}
+        return profile.compiled_contents
 
-    def on_response(self, flow: IFlow) -> bool:
+    def on_response_headers(self, flow: IFlow) -> bool:
+        # Only the Content-Type header is needed, so blocked responses are rejected before their body is downloaded
         # Extracting the host to see if it is in the list as domain name
-        host = flow.get_host()
-        normalized_host = host[len("www."):] if host.startswith(
-            "www.") else host
-
-        for content_entry in self.contents:
-            # Check to see if there is an entry in the list with the current host name
-            if content_entry['domain_name'] in normalized_host:
-                # Getting the content type ot the response content
-                response_headers = flow.get_response().headers
-                content_type_header = response_headers.get('Content-Type', '')
-
-                if content_type_header:
-                    content_type = ContentType.parse(content_type_header)
-                    # If the content type is not in the allowed content type list the response will not pass
-                    if content_type.type not in content_entry['content']:
-                        flow.kill()
-                        return False
-
-                    break
+        normalized_host = normalize_host(flow.get_host())
+
+        profile = self.profiles.resolve(flow)
+        if profile is None or profile.contents is None:
+            key, compiled_contents = normalized_host, None
+        else:
+            key, compiled_contents = (profile.name, normalized_host), self._profile_contents(profile)
+
+        # Check to see if there is an entry in the list with the current host name
+        allowed_contents = self.verdict_cache.get(key)
+        if allowed_contents is MISS:
+            allowed_contents = self._find_allowed_contents(normalized_host, compiled_contents)
+            self.verdict_cache.put(key, allowed_contents)
+
+        if allowed_contents is not None:
+            # Getting the content type ot the response content
+            response_headers = flow.get_response().headers
+            content_type_header = response_headers.get('Content-Type', '')
+
+            if content_type_header:
+                # If the content type does not match the allowed content types the response will not pass
+                if not allowed_contents.fullmatch(parse_media_type(content_type_header)):
+                    flow.kill()
+                    return False
         return True
@@ -1,11 +1,14 @@
-import importlib
 import json
 import os
 import re
+import config
 from werkzeug.utils import secure_filename
-from core.iflow import IFlow
+from core.executor import run_blocking
 from core.plugin_base import PluginBase
-from dal_db import DalDB
+from core.plugin_loader import LazyPlugin, PluginManifest, get_plugin, plugin_changed
+from core.verdict_cache import PolicyGeneration
+from dal import get_db
+from manager import Manager
 
 # HTTP status codes and content types
 HTTP_OK = 200
@@ -24,16 +27,15 @@ def normalize_name(db_name):
     return file_name, class_name
 
 
-def load_plugins(plugin_names):
+def load_plugins(plugin_names, manifest=None):
     """
-    Dynamically load and instantiate plugins based on a plugins list.
+    Load the plugins of a plugins list.
+    With a manifest the plugins that it describes are returned as lazy proxies, imported on first use.
     """
     plugins = []
     for db_name in plugin_names:
         file_name, class_name = normalize_name(db_name)
-        module = importlib.import_module(f'plugins.{file_name}')
-        plugin_class = getattr(module, class_name)
-        plugins.append(plugin_class())
+        plugins.append(get_plugin(manifest, file_name, class_name, lazy=manifest is not None))
     return plugins
 
 # This plugin manages two types of lists the lists of the plugins names and the lists of the plugins instances
@@ -49,7 +51,7 @@ class PluginsManagement(PluginBase):
         """
         Initialize PluginsManagement with database access and plugin lists.
         """
-        self.db = DalDB()  # Initialize database access
+        self.db = get_db()  # Initialize database access
         # Fetch all plugins names from the database
         self.plugins_list = self.db.fetch_all('plugins')
 
@@ -59,6 +61,11 @@ class PluginsManagement(PluginBase):
         self.request_plugins_instances = []
         self.response_plugins_instances = []
 
+        # The dispatch pipelines compiled from the instances lists by set_plugins_instances,
+        # used by the runner for every flow
+        self.request_pipeline = None
+        self.response_pipeline = None
+
         # If no plugins are in the database, populate with all the existing plugins in the directory
         if not self.plugins_list:
             self.initialize_plugins_from_directory()
@@ -81,19 +88,88 @@ class PluginsManagement(PluginBase):
         formatted_plugins_list = [plugin.replace(
             '_', ' ').title() for plugin in plugins_list]
 
-        self.db.insert(
-            'plugins', {'request_plugins_list': formatted_plugins_list})
-        self.db.insert(
-            'plugins', {'response_plugins_list': formatted_plugins_list})
+        with self.db.transaction():
+            self.db.insert(
+                'plugins', {'request_plugins_list': formatted_plugins_list})
+            self.db.insert(
+                'plugins', {'response_plugins_list': formatted_plugins_list})
 
     def set_plugins_instances(self):
         """
         Load and set instances of request and response plugins.
+        Only the plugins whose module changed on disk are reloaded, the others keep their instance and caches.
+        The new pipelines replace the old ones at once, flows already running finish on the old ones.
+        Raises if a plugin fails to load, the running pipelines are then left as they were.
+        """
+        self.install_pipelines(self.build_pipelines(self.request_plugins_list, self.response_plugins_list))
+
+    def build_pipelines(self, request_plugins_list, response_plugins_list):
+        """Load the plugins of the given lists and compile their pipelines, without running them yet. Raises."""
+        manifest = PluginManifest(config.PLUGIN_MANIFEST_PATH) if config.LAZY_PLUGINS else None
+        request_plugins_instances = load_plugins(request_plugins_list, manifest)
+        response_plugins_instances = load_plugins(response_plugins_list, manifest)
+        if manifest is not None:
+            manifest.save()
+        return (request_plugins_instances, response_plugins_instances,
+                Manager(request_plugins_instances), Manager(response_plugins_instances))
+
+    def install_pipelines(self, pipelines):
+        (self.request_plugins_instances, self.response_plugins_instances,
+         self.request_pipeline, self.response_pipeline) = pipelines
+        # A different set of plugins is a different policy
+        PolicyGeneration().bump()
+
+    async def apply_plugins_lists(self, flow, new_request_plugins_list, new_response_plugins_list) -> bool:
         """
-        self.request_plugins_instances = load_plugins(
-            self.request_plugins_list)
-        self.response_plugins_instances = load_plugins(
-            self.response_plugins_list)
+        Switch to new plugins lists: their plugins are loaded first, and the lists are only saved once they all load,
+        so the database never holds a list the proxy can't start with. Responds with a 400 and returns False otherwise.
+        """
+        try:
+            # The lazy plugins are only instantiated on first use, the new and changed ones are loaded here
+            # so a plugin that fails to start is refused now instead of on every flow
+            current = set(self.request_plugins_list + self.response_plugins_list)
+            to_load = {normalize_name(name) for name in new_request_plugins_list + new_response_plugins_list
+                       if name not in current or plugin_changed(*normalize_name(name))}
+            pipelines = self.build_pipelines(new_request_plugins_list, new_response_plugins_list)
+            for plugin in pipelines[0] + pipelines[1]:
+                if isinstance(plugin, LazyPlugin) and (plugin.module_name, plugin.class_name) in to_load:
+                    plugin.load()
+        except Exception as e:
+            flow.make_response(HTTP_BAD_REQUEST, f"Failed to load the plugins: {e}", {
+                               "Content-Type": CONTENT_TYPE_TEXT})
+            return False
+
+        await run_blocking(self.update_and_refresh_plugins,
+                           new_request_plugins_list, new_response_plugins_list)
+        self.install_pipelines(pipelines)
+        return True
+
+    def plugins_changed(self) -> bool:
+        """Check if the module of any listed plugin changed on disk since it was loaded."""
+        return any(plugin_changed(*normalize_name(name))
+                   for name in set(self.request_plugins_list + self.response_plugins_list))
+
+    def reload_policy(self):
+        """
+        Pick up the changes another proxy process made to the database:
+        rebuild the pipelines if the plugins lists or a plugin's code changed,
+        and reload the state of every running plugin.
+        """
+        plugins_lists = (self.request_plugins_list, self.response_plugins_list)
+        self.fetch_plugins_list()
+        if (self.request_plugins_list, self.response_plugins_list) != plugins_lists or self.plugins_changed():
+            self.set_plugins_instances()
+
+        # The plugins are singletons, a plugin in both lists is reloaded once.
+        # Plugins that are not loaded yet will read the current policy when they load
+        reloaded = {id(self)}
+        for plugin in self.request_plugins_instances + self.response_plugins_instances:
+            if isinstance(plugin, LazyPlugin):
+                plugin = plugin.instance
+            if plugin is not None and id(plugin) not in reloaded:
+                reloaded.add(id(plugin))
+                plugin.reload_policy()
+        PolicyGeneration().bump()
 
     def fetch_plugins_list(self):
         """
@@ -112,22 +188,20 @@ class PluginsManagement(PluginBase):
         """
         Update the plugin lists in the database and refresh the request_plugins_list and response_plugins_list.
         """
-        self.db.update('plugins', {
-            'request_plugins_list': new_request_plugins_list}, 'request_plugins_list', self.request_plugins_list)
-        self.db.update('plugins', {'response_plugins_list': new_response_plugins_list},
-                       'response_plugins_list', self.response_plugins_list)
+        with self.db.transaction():
+            self.db.update('plugins', {
+                'request_plugins_list': new_request_plugins_list}, 'request_plugins_list', self.request_plugins_list)
+            self.db.update('plugins', {'response_plugins_list': new_response_plugins_list},
+                           'response_plugins_list', self.response_plugins_list)
 
         self.fetch_plugins_list()
 
-    def _handle_request(self, method: str, flow: IFlow):
-        if method == "GET":
-            self._handle_get(flow)
-        elif method == "POST":
-            self._handle_post(flow)
-        elif method == "PUT":
-            self._handle_put(flow)
-        elif method == "DELETE":
-            self._handle_delete(flow)
+    def register_routes(self, router):
+        """Route "settings.it/api/plugins" to the plugins management operations."""
+        router.add("GET", "/api/plugins", self._handle_get)
+        router.add("POST", "/api/plugins", self._handle_post)
+        router.add("PUT", "/api/plugins", self._handle_put)
+        router.add("DELETE", "/api/plugins", self._handle_delete)
 
     def _handle_get(self, flow):
         """Handles GET requests."""
@@ -136,7 +210,7 @@ class PluginsManagement(PluginBase):
         flow.make_response(HTTP_OK, response_content, {
                            "Content-Type": CONTENT_TYPE_JSON})
 
-    def _handle_post(self, flow):
+    async def _handle_post(self, flow):
         """Handles POST requests with file upload.
         Adding new plugins."""
         # Decode the raw content of the request and extract the filename and its content using a regex pattern
@@ -149,6 +223,11 @@ class PluginsManagement(PluginBase):
             filename = match.group(1)
             file_content = match.group(2).strip()
             file_path = os.path.join(os.path.dirname(__file__), filename)
+            try:
+                with open(file_path) as file:
+                    previous_content = file.read()
+            except FileNotFoundError:
+                previous_content = None
 
             # Write the extracted content to a file
             with open(file_path, 'w') as file:
@@ -158,18 +237,23 @@ class PluginsManagement(PluginBase):
             # Create a plugin name from the filename
             plugin_name = filename[:-3].replace('_', ' ').title()
 
-            # Update the request and response plugin lists with the new plugin
-            new_request_plugins_list = self.request_plugins_list + \
-                [plugin_name]
-            new_response_plugins_list = self.response_plugins_list + \
-                [plugin_name]
-
-            # Update the lists in the database
-            self.update_and_refresh_plugins(
-                new_request_plugins_list, new_response_plugins_list)
-
-            # Reload the instances to include the new plugin
-            self.set_plugins_instances()
+            # Update the request and response plugin lists with the new plugin,
+            # a new version of a listed plugin keeps its place
+            new_request_plugins_list = list(self.request_plugins_list)
+            new_response_plugins_list = list(self.response_plugins_list)
+            for plugins_list in (new_request_plugins_list, new_response_plugins_list):
+                if plugin_name not in plugins_list:
+                    plugins_list.append(plugin_name)
+
+            # Load the new plugin, or reload the changed one, the other plugins are kept
+            if not await self.apply_plugins_lists(flow, new_request_plugins_list, new_response_plugins_list):
+                # Put the previous version back, so a restart doesn't pick up the broken one
+                if previous_content is None:
+                    os.remove(file_path)
+                else:
+                    with open(file_path, 'w') as file:
+                        file.write(previous_content)
+                return
 
             response_content = "File uploaded successfully."
             flow.make_response(HTTP_OK, response_content, {
@@ -179,7 +263,7 @@ class PluginsManagement(PluginBase):
             flow.make_response(HTTP_BAD_REQUEST, "Invalid file", {
                 "Content-Type": CONTENT_TYPE_TEXT})
 
-    def _handle_put(self, flow):
+    async def _handle_put(self, flow):
         """Handles PUT requests.
         Updating the plugins lists"""
         new_plugins_list = json.loads(
@@ -188,15 +272,13 @@ class PluginsManagement(PluginBase):
         request_plugins_list = new_plugins_list.get('request_plugins_list')
         response_plugins_list = new_plugins_list.get('response_plugins_list')
 
-        self.update_and_refresh_plugins(
-            request_plugins_list, response_plugins_list)
-
-        self.set_plugins_instances()
+        if not await self.apply_plugins_lists(flow, request_plugins_list, response_plugins_list):
+            return
 
         flow.make_response(HTTP_OK, "Plugins list updated successfully", {
                            "Content-Type": CONTENT_TYPE_TEXT})
 
-    def _handle_delete(self, flow):
+    async def _handle_delete(self, flow):
         """Handles DELETE requests to remove a plugin."""
         request_data = json.loads(flow.get_request().content.decode())
         plugin_name = request_data.get('plugin_name')
@@ -211,32 +293,18 @@ class PluginsManagement(PluginBase):
                                "Content-Type": CONTENT_TYPE_TEXT})
             return
 
-        # Remove the plugin file
-        os.remove(file_path)
-
         # Update plugin lists and database
         new_request_plugins_list = [
             plugin for plugin in self.request_plugins_list if plugin != plugin_name]
         new_response_plugins_list = [
             plugin for plugin in self.response_plugins_list if plugin != plugin_name]
 
-        self.update_and_refresh_plugins(
-            new_request_plugins_list, new_response_plugins_list)
-
         # Reload the instances to exclude the removed plugin
-        self.set_plugins_instances()
+        if not await self.apply_plugins_lists(flow, new_request_plugins_list, new_response_plugins_list):
+            return
+
+        # Remove the plugin file once no list refers to it
+        os.remove(file_path)
 
         flow.make_response(HTTP_OK, f"Plugin '{plugin_name}' removed successfully.", {
                            "Content-Type": CONTENT_TYPE_TEXT})
-
-    def on_request(self, flow: IFlow) -> bool:
-        host = flow.get_host()
-        normalized_host = host[len("www."):] if host.startswith(
-            "www.") else host
-
-        if normalized_host == "settings.it":
-            req = flow.get_request()
-            if req.path.endswith("/api/plugins"):
-                self._handle_request(req.method, flow)
-
-            return True
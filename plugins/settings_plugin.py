@@ -1,8 +1,10 @@
 import json
 import os
+import config
 from .auth_plugin import AuthPlugin
 from core.iflow import IFlow
 from core.plugin_base import PluginBase
+from core.static_assets import MIME_TYPES, StaticAssets
 
 HTTP_OK = 200
 HTTP_BAD_REQUEST = 400
@@ -10,51 +12,42 @@ CONTENT_TYPE_JSON = "application/json"
 CONTENT_TYPE_TEXT = "text/plain"
 
 
+# The built React UI, served from memory (see core/static_assets.py)
+UI_ROOT = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'assets', 'settings_ui', 'build')
+
+
 def is_static_file(path):
     """Check if the requested path is for a static file."""
-    static_extensions = ['.html', '.css', '.js', '.png', '.jpg',
-                         '.gif', '.woff', '.woff2', '.ttf', '.eot', '.json', '.ico']
-    return any(path.endswith(ext) for ext in static_extensions)
+    return os.path.splitext(path)[1].lower() in MIME_TYPES
 
 
 class SettingsPlugin(PluginBase):
 
     def __init__(self) -> None:
         self.auth = AuthPlugin()
+        self.assets = StaticAssets(UI_ROOT, config.STATIC_ASSETS_CHECK_INTERVAL)
 
     def title(self):
         return 'Settings'
 
     def _serve_files(self, flow: IFlow, path: str):
-        """Serve static files"""
-
-        # Determine the root directory for static files
-        root = os.path.join(os.path.dirname(
-            os.path.realpath(__file__)), 'assets/settings_ui/build')
-        file_path = os.path.join(root, path)
-
-        # Check if the requested file exists and serve it
-        if os.path.exists(file_path):
-            with open(file_path, 'rb') as f:
-                content = f.read()
-            # Extract the file extension
-            ext = os.path.splitext(path)[1]
-            # Define a dictionary to map file extensions to their respective MIME types
-            types = {'.html': 'text/html',
-                     '.js': 'application/javascript', '.css': 'text/css'}
-            flow.make_response(
-                200, content, {"Content-Type": types.get(ext, 'application/octet-stream')})
-        else:
+        """Serve static files from the in-memory cache, answering conditional requests with 304."""
+        response = self.assets.response(path, flow.get_request().headers)
+        if response is None:
             flow.make_response(404, b"File not found!", {
                 "Content-Type": "text/plain"})
-
-    def on_request(self, flow: IFlow) -> bool:
-        host = flow.get_host()
-        path = flow.get_request().path
-
+            return
+        status, content, headers = response
+        flow.make_response(status, content, headers)
+
+    def _serve_static(self, flow: IFlow) -> bool:
+        """Serve the static files of the UI for any settings.it path that is not an API route."""
+        path = flow.get_request().path.split('?', 1)[0]
+        if path == "/" or is_static_file(path):
+            self._serve_files(flow, path.lstrip("/") or "index.html")
+            return True
+        return False
+
+    def register_routes(self, router):
         # If the user trys to reach "setting.it" the plugin will return the static files of the UI
-        if host == "settings.it":
-            if path == "/" or is_static_file(path):
-                self._serve_files(flow, path.lstrip("/") or "index.html")
-
-        return True
+        router.add_fallback(self._serve_static)
@@ -0,0 +1,270 @@
+import asyncio
+import json
+import posixpath
+import re
+import threading
+import config
+from core.aho_corasick import AhoCorasick
+from core.domain_index import SUBTREE, iter_suffixes, normalize_host, parse_rule
+from core.executor import run_blocking
+from core.iflow import IFlow
+from core.plugin_base import PluginBase
+from core.verdict_cache import MISS, PolicyGeneration, VerdictCache
+from dal import get_db
+
+HTTP_OK = 200
+HTTP_BAD_REQUEST = 400
+CONTENT_TYPE_JSON = "application/json"
+CONTENT_TYPE_TEXT = "text/plain"
+
+# This plugin allows or blocks requests by the path and query of their URL, per domain.
+# A rule is a row of the "url_rules" table: {"domain": "youtube.com", "pattern": "/edu/*", "action": "allow"}
+# The pattern is matched, case-insensitively, against the whole path with its query ("/watch?v=..."),
+# a "*" matches any run of characters. The rules of the most specific domain matching the host apply:
+#   - a request matching a "block" rule is blocked
+#   - else, if the domain has "allow" rules, a request matching none of them is blocked
+#   - else the request passes
+# Hosts without rules are left to the other plugins.
+# The path is normalized before it is matched, so "/edu/../watch" or "/edu/%2e%2e/watch" is matched as "/watch".
+#
+# The rules of each domain are compiled once, when they change, so a request is matched in one pass:
+# the rules with "*" only at their ends ("/edu/*", "*.mp4", "*ads*") are literal strings found by an
+# Aho-Corasick automaton (see core/aho_corasick.py), and the few others are combined into one regular expression.
+
+URL_RULES_TABLE = 'url_rules'
+ALLOW = 'allow'
+BLOCK = 'block'
+ACTIONS = (ALLOW, BLOCK)
+
+# Where the literal of a rule must be found in the URL
+EXACT, PREFIX, SUFFIX, ANYWHERE = range(4)
+
+
+def parse_url_pattern(pattern: str):
+    """
+    Return (kind, literal) of a rule the automaton decides alone, or (None, regular expression) of the others.
+    Raises ValueError for a rule that doesn't match from the start of the path.
+    """
+    pattern = pattern.strip().lower()
+    if not pattern.startswith(('/', '*')):
+        raise ValueError(f"A URL pattern starts with / or *: {pattern!r}")
+    literal = pattern.strip('*')
+    if literal and '*' not in literal:
+        starts_anywhere, ends_anywhere = pattern.startswith('*'), pattern.endswith('*')
+        if starts_anywhere:
+            return (ANYWHERE if ends_anywhere else SUFFIX), literal
+        return (PREFIX if ends_anywhere else EXACT), literal
+    return None, '.*'.join(re.escape(part) for part in pattern.split('*'))
+
+
+_UNRESERVED_ESCAPE = re.compile(r'%(2[dD]|2[eE]|5[fF]|7[eE]|3[0-9]|[46][1-9a-fA-F]|[57][0-9aA])')
+
+
+def normalize_url_path(url: str) -> str:
+    """
+    Return the path and query of a request as the server resolves the path: the escaped unreserved characters
+    ("%2e", "%41", ...) are decoded and the "." and ".." segments are resolved. The query is kept as is.
+    """
+    path, separator, query = url.partition('?')
+    if not path.startswith('/'):
+        return url
+    path = _UNRESERVED_ESCAPE.sub(lambda match: chr(int(match.group(1), 16)), path)
+    normalized = posixpath.normpath(path)
+    # normpath keeps a leading "//" and drops the trailing slash, neither changes the resource a rule means
+    normalized = '/' + normalized.lstrip('/')
+    if path.endswith(('/', '/.', '/..')) and normalized != '/':
+        normalized += '/'
+    return normalized + separator + query
+
+
+def validate_url_rule(rule) -> str:
+    """Return an error message for a malformed rule, or None."""
+    if not isinstance(rule, dict) or not all(isinstance(rule.get(key), str) for key in ('domain', 'pattern', 'action')):
+        return "A rule needs a domain, a pattern and an action"
+    if rule['action'] not in ACTIONS:
+        return f"The action is one of {', '.join(ACTIONS)}"
+    try:
+        _, flag = parse_rule(rule['domain'])
+        parse_url_pattern(rule['pattern'])
+    except ValueError as e:
+        return str(e)
+    if flag != SUBTREE:
+        # The rules of a domain always apply to its subdomains too, "=a.com" and "*.a.com" would mean otherwise
+        return "The rules of a domain apply to all of its subdomains, write the domain without \"=\" or \"*.\""
+    return None
+
+
+def _combine(regexes):
+    return re.compile('|'.join(f'(?:{regex})' for regex in regexes)) if regexes else None
+
+
+class DomainRules:
+    """The compiled rules of one domain."""
+    __slots__ = ('automaton', 'allow_regex', 'block_regex', 'has_allow')
+
+    def __init__(self, rules):
+        literals, regexes = [], {ALLOW: [], BLOCK: []}
+        for pattern, action in rules:
+            kind, compiled = parse_url_pattern(pattern)
+            if kind is None:
+                regexes[action].append(compiled)
+            else:
+                literals.append((compiled, (kind, action == BLOCK)))
+        self.automaton = AhoCorasick(literals) if literals else None
+        self.allow_regex = _combine(regexes[ALLOW])
+        self.block_regex = _combine(regexes[BLOCK])
+        self.has_allow = any(action == ALLOW for _, action in rules)
+
+    def allows(self, url: str) -> bool:
+        url = url.lower()
+        allowed = not self.has_allow
+        if self.automaton is not None:
+            size = len(url)
+            for start, end, (kind, blocks) in self.automaton.iter_matches(url):
+                if (kind == PREFIX and start) or (kind == SUFFIX and end != size) or \
+                        (kind == EXACT and (start or end != size)):
+                    continue
+                if blocks:
+                    return False
+                allowed = True
+        if self.block_regex is not None and self.block_regex.fullmatch(url):
+            return False
+        return allowed or (self.allow_regex is not None and self.allow_regex.fullmatch(url) is not None)
+
+
+def rule_domain(domain: str) -> str:
+    return normalize_host(domain.strip())
+
+
+class UrlFilter(PluginBase):
+    def __init__(self) -> None:
+        """
+        Initialize the UrlFilter plugin with a database connection
+        and compile the URL rules of every domain.
+        """
+        self.db = get_db()
+        self.db.ensure_index(URL_RULES_TABLE, 'domain')
+        # Host -> the DomainRules applying to it, or None
+        self.verdict_cache = VerdictCache(
+            'url_filter', config.VERDICT_CACHE_SIZE, config.VERDICT_CACHE_TTL)
+        self.policy_lock = threading.RLock()
+        # Serializes the admin changes with each other while they await their database write
+        self.admin_lock = asyncio.Lock()
+        self.version = None
+        self.rules = []
+        self.compiled_rules = {}
+        self.reload_policy()
+
+    def reload_policy(self):
+        """Recompile the rules if the table changed since they were compiled."""
+        with self.policy_lock:
+            version = self.db.version(URL_RULES_TABLE)
+            if version == self.version:
+                return
+            self.rules = self.db.fetch_all(URL_RULES_TABLE)
+            by_domain = {}
+            for rule in self.rules:
+                by_domain.setdefault(rule['domain'], []).append((rule['pattern'], rule['action']))
+            self.compiled_rules = {domain: DomainRules(rules) for domain, rules in by_domain.items()}
+            self.version = version
+        PolicyGeneration().bump()
+
+    def _domain_changed(self, domain, rules):
+        """Swap in the rules of one domain after an admin change, the other domains are not recompiled."""
+        with self.policy_lock:
+            self.rules = [rule for rule in self.rules if rule['domain'] != domain] + rules
+            if rules:
+                self.compiled_rules[domain] = DomainRules([(rule['pattern'], rule['action']) for rule in rules])
+            else:
+                self.compiled_rules.pop(domain, None)
+            self.version = self.db.version(URL_RULES_TABLE)
+        PolicyGeneration().bump()
+
+    def _save_domain_rules(self, domain, rules):
+        """Replace the rules of a domain in the database. Blocking."""
+        with self.db.transaction():
+            self.db.remove(URL_RULES_TABLE, 'domain', domain)
+            for rule in rules:
+                self.db.insert(URL_RULES_TABLE, rule)
+
+    def title(self) -> str:
+        return "Url Filter"
+
+    def register_routes(self, router):
+        """Route "settings.it/api/url-rules" to the CRUD operations for the URL rules."""
+        router.add("GET", "/api/url-rules", self._handle_get)
+        router.add("POST", "/api/url-rules", self._handle_post)
+        router.add("DELETE", "/api/url-rules", self._handle_delete)
+
+    def _handle_get(self, flow):
+        """Handles GET requests. Pass to the user the URL rules"""
+        flow.make_response(HTTP_OK, json.dumps(self.rules), {
+                           "Content-Type": CONTENT_TYPE_JSON})
+
+    async def _handle_post(self, flow):
+        """
+        Handles POST requests.
+        Adds a rule, or changes the action of the domain's rule with the same pattern
+        """
+        try:
+            rule = json.loads(flow.get_request().content.decode())
+        except ValueError:
+            rule = None
+        error = validate_url_rule(rule)
+        if error is not None:
+            flow.make_response(HTTP_BAD_REQUEST, f"Bad Request: {error}", {
+                               "Content-Type": CONTENT_TYPE_TEXT})
+            return
+
+        domain = rule_domain(rule['domain'])
+        rule = {'domain': domain, 'pattern': rule['pattern'].strip(), 'action': rule['action']}
+        async with self.admin_lock:
+            rules = [existing for existing in self.rules
+                     if existing['domain'] == domain and existing['pattern'] != rule['pattern']] + [rule]
+            await run_blocking(self._save_domain_rules, domain, rules)
+            self._domain_changed(domain, rules)
+        flow.make_response(HTTP_OK, "Rule saved successfully", {
+                           "Content-Type": CONTENT_TYPE_TEXT})
+
+    async def _handle_delete(self, flow):
+        """
+        Handles DELETE requests.
+        Deletes the rule of the domain with the pattern sent by the user
+        """
+        rule = json.loads(flow.get_request().content.decode())
+        domain = rule_domain(rule.get('domain') or '')
+        pattern = (rule.get('pattern') or '').strip()
+
+        async with self.admin_lock:
+            rules = [existing for existing in self.rules if existing['domain'] == domain]
+            remaining = [existing for existing in rules if existing['pattern'] != pattern]
+            if len(remaining) == len(rules):
+                flow.make_response(HTTP_BAD_REQUEST, "Rule not found", {
+                                   "Content-Type": CONTENT_TYPE_TEXT})
+                return
+            await run_blocking(self._save_domain_rules, domain, remaining)
+            self._domain_changed(domain, remaining)
+        flow.make_response(HTTP_OK, "Rule deleted successfully", {
+                           "Content-Type": CONTENT_TYPE_TEXT})
+
+    def _find_domain_rules(self, normalized_host: str):
+        """Return the rules of the most specific domain matching the host, or None."""
+        for suffix in iter_suffixes(normalized_host):
+            domain_rules = self.compiled_rules.get(suffix)
+            if domain_rules is not None:
+                return domain_rules
+        return None
+
+    def on_request(self, flow: IFlow) -> bool:
+        """Block the requests whose path and query the rules of their domain don't allow."""
+        normalized_host = normalize_host(flow.get_host())
+
+        domain_rules = self.verdict_cache.get(normalized_host)
+        if domain_rules is MISS:
+            domain_rules = self._find_domain_rules(normalized_host)
+            self.verdict_cache.put(normalized_host, domain_rules)
+
+        if domain_rules is not None and not domain_rules.allows(normalize_url_path(flow.get_request().path)):
+            flow.kill()
+            return False
+        return True
@@ -1,7 +1,18 @@
+import asyncio
+import io
+import ipaddress
 import json
+import os
+import threading
+import config
+from core.domain_index import DomainIndex, normalize_host, parse_rule
+from core.executor import run_blocking
 from core.iflow import IFlow
 from core.plugin_base import PluginBase
-from dal_db import DalDB
+from core.policy_snapshot import SnapshotWriter, open_snapshot
+from core.profiles import ProfileStore, validate_profile
+from core.verdict_cache import MISS, PolicyGeneration, VerdictCache
+from dal import get_db
 
 HTTP_OK = 200
 HTTP_BAD_REQUEST = 400
@@ -9,29 +20,166 @@ CONTENT_TYPE_JSON = "application/json"
 CONTENT_TYPE_TEXT = "text/plain"
 
 
+def iter_import_domains(content: bytes):
+    """
+    Yield the domains of an uploaded list, line by line.
+    Accepts hosts files ("0.0.0.0 a.com b.com"), CSV (first column) and newline-delimited lists,
+    blank lines, "#" comments and a "domain" CSV header are skipped.
+    """
+    for raw_line in io.BytesIO(content):
+        line = raw_line.decode('utf-8', 'replace').split('#', 1)[0].strip()
+        if not line:
+            continue
+        if ',' in line:
+            domain = line.split(',', 1)[0].strip().strip('"')
+            if domain.lower() != 'domain':
+                yield domain
+            continue
+
+        fields = line.split()
+        try:
+            # A hosts file line starts with the address the names resolve to
+            ipaddress.ip_address(fields[0])
+            yield from fields[1:]
+        except ValueError:
+            yield from fields
+
+
+def parse_import(content: bytes):
+    """Return the distinct valid domains of an uploaded list, the number of repeated ones and of invalid ones."""
+    domains, duplicates, invalid = [], 0, 0
+    seen = set()
+    for domain in iter_import_domains(content):
+        if domain in seen:
+            duplicates += 1
+            continue
+        seen.add(domain)
+        try:
+            parse_rule(domain)
+        except ValueError:
+            invalid += 1
+            continue
+        domains.append(domain)
+    return domains, duplicates, invalid
+
+
+def build_domain_index(domains):
+    """
+    Build the domain index of the stored list.
+    A stored domain that is not a valid rule (saved before the domains were validated) is skipped,
+    it stays in the list so it can still be removed.
+    """
+    domain_index = DomainIndex()
+    for domain in domains:
+        try:
+            domain_index.add(domain)
+        except ValueError as e:
+            print(f"Skipping the invalid approved domain {domain!r}: {e}")
+    return domain_index
+
+
 # This plugin manages the approved domains list
 # also, this plugin responsible for blocking unapproved domains
+# The list is mirrored into a suffix index (see core/domain_index.py) so checking a host
+# costs O(number of labels in the host) instead of a scan over the whole list.
+# The list is also compiled into a policy snapshot (see core/policy_snapshot.py) which is mapped
+# instead while it is up to date with the table, then the list itself is only loaded for the admin API.
+# A client with a profile (see core/profiles.py) is checked against the profile's domains instead,
+# the profiles are managed through "settings.it/api/profiles".
 class WhiteListPlugin(PluginBase):
     def __init__(self) -> None:
         """
         Initialize the WhiteListPlugin with a database connection
         and fetch the list of approved domains.
         """
-        self.db = DalDB()
-        domains_list = self.db.fetch_all('approved_domains')
-        self.approved_domains = [item['domain'] for item in domains_list]
+        self.db = get_db()
+        self.db.ensure_index('approved_domains', 'domain')
+        self.verdict_cache = VerdictCache(
+            'white_list', config.VERDICT_CACHE_SIZE, config.VERDICT_CACHE_TTL)
+        # Guards the list and the index while they are read or changed in memory, never held across an await:
+        # a reload or a snapshot swap can run while an admin change awaits its database write
+        self.policy_lock = threading.RLock()
+        # Serializes the admin changes with each other while they await their database write
+        self.admin_lock = asyncio.Lock()
+        # The table version the in-memory list was last updated to
+        self.policy_version = None
+        self.profiles = ProfileStore()
+        self.snapshot_writer = None
+        if config.POLICY_SNAPSHOT_DIR:
+            self.snapshot_writer = SnapshotWriter(
+                os.path.join(config.POLICY_SNAPSHOT_DIR, 'white_list.snapshot'),
+                self._build_snapshot, self._map_snapshot)
+        self.reload_policy()
+
+    def reload_policy(self):
+        self.profiles.reload()
+        with self.policy_lock:
+            if self._map_snapshot():
+                PolicyGeneration().bump()
+                return
+            # The version is read first, a change racing with the fetch only makes the snapshot look stale
+            version = self.db.version('approved_domains')
+            domains_list = self.db.fetch_all('approved_domains')
+            self.policy_version = version
+            self.approved_domains = [item['domain'] for item in domains_list]
+
+    @property
+    def approved_domains(self):
+        if self._approved_domains is None:
+            self._approved_domains = [item['domain'] for item in self.db.fetch_all('approved_domains')]
+        return self._approved_domains
+
+    @approved_domains.setter
+    def approved_domains(self, domains):
+        """Replace the whole list and rebuild the domain index from scratch."""
+        self._approved_domains = list(domains)
+        self.domain_index = build_domain_index(self._approved_domains)
+        self._policy_changed()
+
+    def _policy_changed(self):
+        PolicyGeneration().bump()
+        if self.snapshot_writer is not None:
+            self.snapshot_writer.schedule()
+
+    def _build_snapshot(self):
+        # The list and the version it was last updated at are taken together, the live table version
+        # may already count a change the list doesn't have yet
+        with self.policy_lock:
+            return self.policy_version, list(self.approved_domains), None
+
+    def _map_snapshot(self):
+        """Match against the snapshot if it is up to date with the table, the list is then dropped until needed."""
+        if self.snapshot_writer is None:
+            return False
+        with self.policy_lock:
+            version = self.db.version('approved_domains')
+            snapshot = open_snapshot(self.snapshot_writer.path, version)
+            if snapshot is None:
+                return False
+            self.policy_version = version
+            self.domain_index = snapshot
+            self._approved_domains = None
+            return True
+
+    def _editable_index(self):
+        """Return the in-memory domain index, rebuilding it from the list if the snapshot is mapped."""
+        if not isinstance(self.domain_index, DomainIndex):
+            self.domain_index = build_domain_index(self.approved_domains)
+        return self.domain_index
 
     def title(self) -> str:
         return "White List"
 
-    def _handle_request(self, method: str, flow: IFlow):
-        """Handle HTTP requests based on the method type."""
-        if method == "GET":
-            self._handle_get(flow)
-        elif method == "POST":
-            self._handle_post(flow)
-        elif method == "DELETE":
-            self._handle_delete(flow)
+    def register_routes(self, router):
+        """Route "settings.it/api/approved-domains" to the CRUD operations for the approved domains list."""
+        router.add("GET", "/api/approved-domains", self._handle_get)
+        router.add("POST", "/api/approved-domains", self._handle_post)
+        router.add("DELETE", "/api/approved-domains", self._handle_delete)
+        router.add("POST", "/api/approved-domains/import", self._handle_import)
+        router.add("GET", "/api/approved-domains/export", self._handle_export)
+        router.add("GET", "/api/profiles", self._handle_get_profiles)
+        router.add("POST", "/api/profiles", self._handle_post_profile)
+        router.add("DELETE", "/api/profiles", self._handle_delete_profile)
 
     def _handle_get(self, flow):
         """Handles GET requests. Pass to the user the approved domain list"""
@@ -39,7 +187,7 @@ class WhiteListPlugin(PluginBase):
         flow.make_response(HTTP_OK, response_content, {
                            "Content-Type": CONTENT_TYPE_JSON})
 
-    def _handle_post(self, flow):
+    async def _handle_post(self, flow):
         """
         Handles POST requests.
         Adding a new approved domain to the list
@@ -52,18 +200,31 @@ class WhiteListPlugin(PluginBase):
                                "Content-Type": CONTENT_TYPE_TEXT})
             return
 
-        if new_domain in self.approved_domains:
+        async with self.admin_lock:
+            await self._add_domain(flow, new_domain)
+
+    async def _add_domain(self, flow, new_domain):
+        """Validate the domain, save it and respond to the flow. Runs under the admin lock."""
+        with self.policy_lock:
+            exists = new_domain in self._editable_index()
+        if exists:
             flow.make_response(HTTP_BAD_REQUEST, "Domain already exists", {
                                "Content-Type": CONTENT_TYPE_TEXT})
             return
 
-        self.db.insert('approved_domains', {'domain': new_domain})
-        domains_list = self.db.fetch_all('approved_domains')
-        self.approved_domains = [item['domain'] for item in domains_list]
+        try:
+            parse_rule(new_domain)
+        except ValueError:
+            flow.make_response(HTTP_BAD_REQUEST, "Bad Request: Invalid domain", {
+                               "Content-Type": CONTENT_TYPE_TEXT})
+            return
+
+        version = await run_blocking(self._insert_domains, [new_domain])
+        self._add_to_policy([new_domain], version)
         flow.make_response(HTTP_OK, "Domain added successfully", {
                            "Content-Type": CONTENT_TYPE_TEXT})
 
-    def _handle_delete(self, flow):
+    async def _handle_delete(self, flow):
         """
         Handles DELETE requests.
         Deletes from the list the approved domain sent by the user 
@@ -71,30 +232,155 @@ class WhiteListPlugin(PluginBase):
         domain_to_remove = json.loads(
             flow.get_request().content.decode()).get('domain')
 
-        if domain_to_remove in self.approved_domains:
-            self.db.remove('approved_domains', 'domain', domain_to_remove)
-            domains_list = self.db.fetch_all('approved_domains')
-            self.approved_domains = [item['domain'] for item in domains_list]
+        async with self.admin_lock:
+            with self.policy_lock:
+                # An invalid stored domain is only in the list, not in the index
+                exists = domain_to_remove in self._editable_index() or domain_to_remove in self.approved_domains
+            if exists:
+                version = await run_blocking(self._remove_domain, domain_to_remove)
+                with self.policy_lock:
+                    # A reload while the write was awaited may already have dropped the domain
+                    domain_index = self._editable_index()
+                    if domain_to_remove in self.approved_domains:
+                        self.approved_domains.remove(domain_to_remove)
+                        domain_index.remove(domain_to_remove)
+                    self.policy_version = version
+                    self._policy_changed()
 
         response_content = json.dumps(self.approved_domains)
         flow.make_response(HTTP_OK, response_content, {
                            "Content-Type": CONTENT_TYPE_JSON})
 
+    async def _handle_import(self, flow):
+        """
+        Handles bulk uploads of approved domains.
+        New domains are deduplicated against the list and saved as one batch.
+        """
+        # Parsing a large upload would stall the other connections, only the dedupe against the list is locked
+        domains, duplicates, invalid = await run_blocking(parse_import, flow.get_request().content)
+        async with self.admin_lock:
+            with self.policy_lock:
+                domain_index = self._editable_index()
+                added = [domain for domain in domains if domain not in domain_index]
+            duplicates += len(domains) - len(added)
+
+            if added:
+                version = await run_blocking(self._insert_domains, added)
+                self._add_to_policy(added, version)
+
+        response_content = json.dumps(
+            {'added': len(added), 'duplicates': duplicates, 'invalid': invalid})
+        flow.make_response(HTTP_OK, response_content, {
+                           "Content-Type": CONTENT_TYPE_JSON})
+
+    def _add_to_policy(self, domains, version):
+        """Add domains saved at the table version to the list and the index in place instead of rebuilding them."""
+        with self.policy_lock:
+            domain_index = self._editable_index()
+            for domain in domains:
+                # A reload while the write was awaited may already have picked the domain up
+                if domain not in domain_index:
+                    self.approved_domains.append(domain)
+                    domain_index.add(domain)
+            self.policy_version = version
+            self._policy_changed()
+
+    def _insert_domains(self, domains):
+        """Save the domains as one batch and return the version of the table with them."""
+        with self.db.transaction():
+            for domain in domains:
+                self.db.insert('approved_domains', {'domain': domain})
+            return self.db.version('approved_domains')
+
+    def _remove_domain(self, domain):
+        """Remove the domain from the table and return the version of the table without it."""
+        with self.db.transaction():
+            self.db.remove('approved_domains', 'domain', domain)
+            return self.db.version('approved_domains')
+
+    def _handle_export(self, flow):
+        """
+        Handles GET requests for the whole list as newline-delimited text.
+        The body is written straight into one buffer, without building a JSON document of the list.
+        """
+        buffer = io.BytesIO()
+        for domain in self.approved_domains:
+            buffer.write(domain.encode())
+            buffer.write(b'\n')
+        flow.make_response(HTTP_OK, buffer.getvalue(), {
+                           "Content-Type": CONTENT_TYPE_TEXT,
+                           "Content-Disposition": 'attachment; filename="approved-domains.txt"'})
+
+    def _handle_get_profiles(self, flow):
+        """Handles GET requests. Pass to the user the profiles"""
+        flow.make_response(HTTP_OK, json.dumps(self.profiles.rows()), {
+                           "Content-Type": CONTENT_TYPE_JSON})
+
+    async def _handle_post_profile(self, flow):
+        """
+        Handles POST requests.
+        Adds a profile, or replaces the profile of the same name
+        """
+        try:
+            profile = json.loads(flow.get_request().content.decode())
+        except ValueError:
+            profile = None
+        error = validate_profile(profile)
+        if error is not None:
+            flow.make_response(HTTP_BAD_REQUEST, f"Bad Request: {error}", {
+                               "Content-Type": CONTENT_TYPE_TEXT})
+            return
+
+        async with self.admin_lock:
+            await run_blocking(self.profiles.save, profile)
+            await run_blocking(self.profiles.reload)
+        flow.make_response(HTTP_OK, "Profile saved successfully", {
+                           "Content-Type": CONTENT_TYPE_TEXT})
+
+    async def _handle_delete_profile(self, flow):
+        """
+        Handles DELETE requests.
+        Deletes the profile named by the user
+        """
+        try:
+            request_data = json.loads(flow.get_request().content.decode())
+        except ValueError:
+            request_data = None
+        name = request_data.get('name') if isinstance(request_data, dict) else None
+        if not isinstance(name, str) or not name:
+            flow.make_response(HTTP_BAD_REQUEST, "Bad Request: Missing profile name", {
+                               "Content-Type": CONTENT_TYPE_TEXT})
+            return
+
+        async with self.admin_lock:
+            deleted = await run_blocking(self.profiles.delete, name)
+            await run_blocking(self.profiles.reload)
+        if not deleted:
+            flow.make_response(HTTP_BAD_REQUEST, "Profile not found", {
+                               "Content-Type": CONTENT_TYPE_TEXT})
+            return
+        flow.make_response(HTTP_OK, "Profile deleted successfully", {
+                           "Content-Type": CONTENT_TYPE_TEXT})
+
     def on_request(self, flow: IFlow) -> bool:
         """Handle incoming requests and manage access based on approved domains."""
-        host = flow.get_host()
-        normalized_host = host[len("www."):] if host.startswith(
-            "www.") else host
+        normalized_host = normalize_host(flow.get_host())
 
-        # Redirect requests to "settings.it/api/approved-domains" to the CRUD operations for the approved domains list
-        if normalized_host == "settings.it":
-            req = flow.get_request()
-            if req.path.endswith("/api/approved-domains"):
-                self._handle_request(req.method, flow)
+        profile = self.profiles.resolve(flow)
+        if profile is None:
+            key, domain_index = normalized_host, self.domain_index
+        else:
+            key, domain_index = (profile.name, normalized_host), profile.domain_index
 
-            return True
+        # Check if the host is in the approved domains list, reusing the verdict of earlier flows
+        approved = self.verdict_cache.get(key)
+        if approved is MISS:
+            approved = domain_index.match(normalized_host)
+            self.verdict_cache.put(key, approved)
 
-        # Check if the host is in the approved domains list
-        if not any(approved_domain in normalized_host for approved_domain in self.approved_domains):
+        if not approved:
             flow.kill()  # Kill the flow if the host is not approved
             return False
+
+        return True
+
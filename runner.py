@@ -1,34 +1,105 @@
+from core.startup_timer import StartupTimer
+startup_timer = StartupTimer()
+import asyncio
+import config
+from core import reuse_port
+from core.executor import run_blocking
 from core.mitm_flow import MitmFlow
-from manager import Manager
+from core.profiles import ProfileStore
 from plugins.plugins_management import PluginsManagement
-import debugpy
+startup_timer.mark('imports')
 
-# Setting mitmproxy to listen to debug connection
-debugpy.listen(("127.0.0.1", 5678))
-print("Waiting for debugger attach")
-debugpy.wait_for_client()
+# Setting mitmproxy to listen to debug connection, only when asked for with SAFEBROWSE_DEBUG=1
+# (the workers started by supervisor.py can't share the debugger port)
+if config.DEBUG:
+    import debugpy
+    debugpy.listen(("127.0.0.1", config.DEBUG_PORT))
+    print("Waiting for debugger attach")
+    debugpy.wait_for_client()
+    startup_timer.mark('debugger')
+
+# Workers started by supervisor.py share the proxy port, mitmproxy binds it once the addons are loaded
+if config.REUSE_PORT:
+    reuse_port.enable_reuse_port()
 
 # Initialize the plugin management
 plugin_management = PluginsManagement()
-# Initialize and setting the plugin instances in the plugin management
+startup_timer.mark('database')
+# Initialize and setting the plugin instances in the plugin management,
+# the plugins described by the plugin manifest are only imported on their first use
 plugin_management.set_plugins_instances()
+startup_timer.mark('plugins')
+
+
+def is_large_response(response):
+    """
+    Check if the response body is too big to be buffered in the proxy.
+    A body of unknown size is buffered, so the plugins see it, unless STREAM_UNKNOWN_LENGTH_RESPONSES is set.
+    """
+    content_length = response.headers.get('Content-Length')
+    if content_length is None or not content_length.isdigit():
+        return config.STREAM_UNKNOWN_LENGTH_RESPONSES
+    return int(content_length) >= config.STREAM_RESPONSE_MIN_BYTES
+
+
+async def watch_policy():
+    """Reload the plugins whenever another proxy worker changes the database."""
+    while True:
+        await asyncio.sleep(config.POLICY_POLL_INTERVAL)
+        try:
+            if await run_blocking(plugin_management.db.refresh):
+                await run_blocking(plugin_management.reload_policy)
+        except Exception as e:
+            print(f"Failed to reload the policy: {e}")
 
 
 class Runner():
+    # The pipelines are read from the plugin management on every flow,
+    # so a plugins list change is picked up by the next flow without rebuilding anything here
+
+    def __init__(self):
+        self.policy_watcher = None
+
+    def running(self):
+        startup_timer.mark('mitmproxy')
+        print(startup_timer.report())
+        # Workers started by supervisor.py share the database, poll it for the changes made through the others
+        if config.POLICY_POLL_INTERVAL > 0:
+            self.policy_watcher = asyncio.get_running_loop().create_task(watch_policy())
+
+    def done(self):
+        if self.policy_watcher is not None:
+            self.policy_watcher.cancel()
+        # Persist the mutations still pending in write-behind mode before the proxy exits
+        plugin_management.db.flush()
+
+    def client_disconnected(self, client):
+        # The profile resolved for the connection is not needed anymore
+        ProfileStore().forget_connection(client.id)
+
+    # The hooks are coroutines, mitmproxy keeps serving other connections while a plugin awaits
+
+    async def request(self, flow):
+        # Wrap the mitmproxy flow object and run it through the compiled request pipeline
+        await plugin_management.request_pipeline.on_request(MitmFlow(flow))
+
+    async def responseheaders(self, flow):
+        # Runs before mitmproxy reads the body, plugins that only need the headers can reject here
+        upstream_response = flow.response
+        mitm_flow = MitmFlow(flow)
+        await plugin_management.response_pipeline.on_response_headers(mitm_flow)
+
+        if flow.response is not upstream_response:
+            # A plugin replaced the response, send it without ever buffering the upstream body
+            flow.metadata['safebrowse_rejected'] = True
+            mitm_flow.discard_response_body()
+        elif is_large_response(flow.response):
+            mitm_flow.stream_response()
 
-    def request(self, flow):
-        # Create a MitmFlow instance with the mitmproxy flow object
-        self.mitm_flow = MitmFlow(flow)
-        # Initialize the Manager with request plugins and the current MitmFlow
-        self.manager = Manager(
-            plugin_management.request_plugins_instances, self.mitm_flow)
-        self.manager.on_request()
-
-    def response(self, flow):
-        self.mitm_flow = MitmFlow(flow)
-        self.manager = Manager(
-            plugin_management.response_plugins_instances, self.mitm_flow)
-        self.manager.on_response()
+    async def response(self, flow):
+        if flow.metadata.get('safebrowse_rejected'):
+            return
+        await plugin_management.response_pipeline.on_response(MitmFlow(flow))
 
 
 # Add an instance of Runner to the mitmproxy addons list
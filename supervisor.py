@@ -0,0 +1,213 @@
+import argparse
+import asyncio
+import os
+import signal
+import sys
+import config
+from core import reuse_port
+
+# Runs several mitmproxy workers with the Runner addon behind a single proxy port,
+# so the TLS interception is spread over all the CPU cores instead of one.
+#
+# Where the platform has SO_REUSEPORT (Linux, BSD, macOS) every worker listens on the public port itself
+# (see core/reuse_port.py) and the kernel hands each client connection to one of them, the supervisor
+# only starts the workers and restarts the ones that die.
+#
+# Elsewhere, or with --relay, every worker listens on its own loopback port and the supervisor accepts
+# the client connections on the public port and relays each one to the worker with the fewest open
+# connections. The relay copies every byte through the supervisor's single process, and the workers
+# see all the clients connecting from 127.0.0.1: the per-client login limit then applies per connection,
+# and profiles selecting clients by network are refused (SAFEBROWSE_BEHIND_RELAY, see config.py).
+#
+# The workers share the database files, and each one polls them every POLICY_POLL_INTERVAL
+# seconds to pick up the changes made through the settings.it admin API of any other.
+#
+# Usage: python supervisor.py [--workers N] [--listen-host HOST] [--listen-port PORT] [--relay] [-- extra mitmdump args]
+
+RUNNER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'runner.py')
+# Seconds between two checks of the workers' processes
+WORKER_CHECK_INTERVAL = 1.0
+# Seconds to wait for a worker to open its port
+WORKER_START_TIMEOUT = 30.0
+RELAY_BUFFER_SIZE = 64 * 1024
+
+
+class Worker:
+    def __init__(self, index, host, port, command, env):
+        self.index = index
+        self.host = host
+        self.port = port
+        self.command = command
+        self.env = env
+        self.process = None
+        # Client connections currently relayed to this worker
+        self.connections = 0
+
+    def is_alive(self):
+        return self.process is not None and self.process.returncode is None
+
+    async def start(self):
+        env = dict(os.environ, SAFEBROWSE_WORKER_ID=str(self.index), **self.env)
+        self.process = await asyncio.create_subprocess_exec(*self.command, env=env)
+        print(f"Worker {self.index} started on port {self.port} (pid {self.process.pid})")
+
+    async def wait_until_listening(self):
+        """Wait for the worker to accept connections, it has to load mitmproxy and the plugins first."""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + WORKER_START_TIMEOUT
+        while self.is_alive() and loop.time() < deadline:
+            try:
+                _, writer = await asyncio.open_connection(self.host, self.port)
+            except OSError:
+                await asyncio.sleep(0.2)
+                continue
+            writer.close()
+            return True
+        return False
+
+    def stop(self):
+        if self.is_alive():
+            self.process.terminate()
+
+
+async def relay(reader, writer):
+    """Copy one direction of a connection until EOF, then half-close the other side."""
+    try:
+        while True:
+            data = await reader.read(RELAY_BUFFER_SIZE)
+            if not data:
+                break
+            writer.write(data)
+            await writer.drain()
+        if writer.can_write_eof():
+            writer.write_eof()
+    except (ConnectionError, OSError):
+        writer.close()
+
+
+class Supervisor:
+    def __init__(self, listen_host, listen_port, workers_count, base_port, mitmdump, extra_args, relay_mode):
+        self.listen_host = listen_host
+        self.listen_port = listen_port
+        self.relay_mode = relay_mode
+        if relay_mode:
+            self.workers = [
+                Worker(index, '127.0.0.1', base_port + index, [
+                    mitmdump, '-s', RUNNER_PATH,
+                    '--listen-host', '127.0.0.1', '--listen-port', str(base_port + index), *extra_args],
+                    {'SAFEBROWSE_BEHIND_RELAY': '1'})
+                for index in range(workers_count)]
+        else:
+            # Only the first worker's readiness is checked, before the others start it is the only one listening
+            self.workers = [
+                Worker(index, listen_host or '127.0.0.1', listen_port, [
+                    mitmdump, '-s', RUNNER_PATH,
+                    '--listen-host', listen_host or '', '--listen-port', str(listen_port), *extra_args],
+                    {'SAFEBROWSE_REUSE_PORT': '1'})
+                for index in range(workers_count)]
+        self.stopping = False
+        # Rotates the starting point of the worker choice so ties are broken round-robin
+        self.next_worker = 0
+
+    def pick_worker(self):
+        """Return the live worker with the fewest open connections, or None if all are down."""
+        start = self.next_worker
+        self.next_worker = (start + 1) % len(self.workers)
+        workers = [worker for worker in self.workers[start:] + self.workers[:start] if worker.is_alive()]
+        return min(workers, key=lambda worker: worker.connections, default=None)
+
+    async def handle_client(self, client_reader, client_writer):
+        worker = self.pick_worker()
+        if worker is None:
+            client_writer.close()
+            return
+
+        worker.connections += 1
+        try:
+            try:
+                worker_reader, worker_writer = await asyncio.open_connection('127.0.0.1', worker.port)
+            except OSError:
+                client_writer.close()
+                return
+            await asyncio.gather(relay(client_reader, worker_writer), relay(worker_reader, client_writer))
+            worker_writer.close()
+            client_writer.close()
+        finally:
+            worker.connections -= 1
+
+    async def watch_workers(self):
+        while not self.stopping:
+            await asyncio.sleep(WORKER_CHECK_INTERVAL)
+            for worker in self.workers:
+                if not worker.is_alive() and not self.stopping:
+                    print(f"Worker {worker.index} exited with code {worker.process.returncode}, restarting it")
+                    await worker.start()
+
+    async def run(self):
+        # The first worker creates the mitmproxy CA if it does not exist yet, the others reuse it
+        await self.workers[0].start()
+        if not await self.workers[0].wait_until_listening():
+            self.stop()
+            sys.exit("The first worker failed to start")
+        for worker in self.workers[1:]:
+            await worker.start()
+
+        loop = asyncio.get_running_loop()
+        stopped = asyncio.Event()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, stopped.set)
+            except NotImplementedError:  # Windows, Ctrl+C raises KeyboardInterrupt instead
+                pass
+
+        server = None
+        if self.relay_mode:
+            server = await asyncio.start_server(self.handle_client, self.listen_host, self.listen_port)
+        print(f"Proxy listening on {self.listen_host or '*'}:{self.listen_port} with {len(self.workers)} workers"
+              f"{' behind the relay' if self.relay_mode else ''}")
+        watcher = asyncio.create_task(self.watch_workers())
+        try:
+            await stopped.wait()
+        finally:
+            self.stop()
+            watcher.cancel()
+            if server is not None:
+                server.close()
+            for worker in self.workers:
+                if worker.process is not None:
+                    await worker.process.wait()
+
+    def stop(self):
+        self.stopping = True
+        for worker in self.workers:
+            worker.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run several proxy workers behind one port.")
+    parser.add_argument('--workers', type=int, default=config.WORKERS or os.cpu_count() or 1)
+    parser.add_argument('--listen-host', default='')
+    parser.add_argument('--listen-port', type=int, default=8080)
+    parser.add_argument('--relay', action='store_true',
+                        help="relay the connections to the workers instead of sharing the port with SO_REUSEPORT")
+    parser.add_argument('--base-port', type=int, default=config.WORKER_BASE_PORT,
+                        help="loopback port of the first worker in relay mode, the others use the next ones")
+    parser.add_argument('--mitmdump', default='mitmdump', help="path of the mitmdump executable")
+    parser.add_argument('extra_args', nargs=argparse.REMAINDER,
+                        help="arguments passed to every worker after --")
+    args = parser.parse_args()
+    extra_args = args.extra_args[1:] if args.extra_args[:1] == ['--'] else args.extra_args
+
+    relay_mode = args.relay or not reuse_port.is_supported()
+    if relay_mode and not args.relay:
+        print("SO_REUSEPORT is not available, relaying the connections to the workers")
+    supervisor = Supervisor(args.listen_host or None, args.listen_port, max(args.workers, 1),
+                            args.base_port, args.mitmdump, extra_args, relay_mode)
+    try:
+        asyncio.run(supervisor.run())
+    except KeyboardInterrupt:
+        supervisor.stop()
+
+
+if __name__ == '__main__':
+    main()
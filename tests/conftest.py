@@ -0,0 +1,16 @@
+import atexit
+import os
+import shutil
+import tempfile
+
+# The plugins open the database, the policy snapshots and the plugin manifest at the paths of config.py,
+# point them at a temporary directory so running the tests leaves the working tree untouched.
+# This runs before the test modules import config.
+
+_runtime_dir = tempfile.mkdtemp(prefix='safebrowse-tests-')
+atexit.register(shutil.rmtree, _runtime_dir, True)
+
+os.environ['SAFEBROWSE_DB_PATH'] = os.path.join(_runtime_dir, 'db.json')
+os.environ['SAFEBROWSE_SQLITE_DB_PATH'] = os.path.join(_runtime_dir, 'db.sqlite3')
+os.environ['SAFEBROWSE_POLICY_SNAPSHOT_DIR'] = os.path.join(_runtime_dir, 'policy_snapshots')
+os.environ['SAFEBROWSE_PLUGIN_MANIFEST_PATH'] = os.path.join(_runtime_dir, 'plugins_manifest.json')
@@ -0,0 +1,114 @@
+from plugins.auth_plugin import AuthPlugin
+from core import passwords
+from core.passwords import hash_password, needs_rehash, verify_password
+from core.session_store import SessionStore
+import asyncio
+import hashlib
+import json
+import unittest
+from unittest.mock import Mock, patch
+import os
+import sys
+sys.path.insert(0, os.path.abspath(
+    os.path.join(os.path.dirname(__file__), '..')))
+
+
+class TestPasswords(unittest.TestCase):
+    def test_scrypt_hash_is_salted_and_verifies(self):
+        hashed = hash_password('secret')
+
+        self.assertTrue(hashed.startswith('scrypt$'))
+        self.assertNotEqual(hashed, hash_password('secret'))
+        self.assertTrue(verify_password('secret', hashed))
+        self.assertFalse(verify_password('wrong', hashed))
+        self.assertFalse(needs_rehash(hashed))
+
+    def test_legacy_sha256_hash_verifies_and_needs_rehash(self):
+        legacy = hashlib.sha256(b'secret').hexdigest()
+
+        self.assertTrue(verify_password('secret', legacy))
+        self.assertFalse(verify_password('wrong', legacy))
+        self.assertTrue(needs_rehash(legacy))
+        self.assertFalse(verify_password('secret', None))
+
+    def test_dummy_hash_is_computed_once_on_the_hashing_pool(self):
+        passwords.start_dummy_hash()
+        self.assertIs(passwords.dummy_hash(), passwords.dummy_hash())
+        self.assertTrue(passwords.dummy_hash().startswith('scrypt$'))
+
+
+class TestAuthPlugin(unittest.TestCase):
+    def setUp(self):
+        self.plugin = AuthPlugin()
+        self.plugin.db = Mock()
+        self.plugin.sessions = SessionStore(ttl=60, max_sessions=10)
+        self.mock_flow = Mock()
+        self.mock_flow.get_client_ip.return_value = '10.0.0.1'
+
+    def post(self, handler, username, password):
+        self.mock_flow.get_request.return_value.content = json.dumps(
+            {'username': username, 'password': password}).encode()
+        asyncio.run(handler(self.mock_flow))
+
+    def test_login_upgrades_legacy_hash(self):
+        self.plugin.db.search.return_value = [
+            {'user-name': 'admin', 'password': hashlib.sha256(b'secret').hexdigest()}]
+
+        self.post(self.plugin._handle_login, 'admin', 'secret')
+
+        status, _, _, key, cookie = self.mock_flow.make_response_with_cookie.call_args[0]
+        self.assertEqual((status, key), (200, 'session'))
+        self.assertEqual(self.plugin.sessions.get(cookie.split(';')[0]), 'admin')
+        table, fields, key, value = self.plugin.db.update.call_args[0]
+        self.assertEqual((table, key, value), ('users', 'user-name', 'admin'))
+        self.assertTrue(verify_password('secret', fields['password']))
+        self.assertFalse(needs_rehash(fields['password']))
+
+    def test_login_with_unknown_user_or_wrong_password_is_refused(self):
+        self.plugin.db.search.return_value = []
+        self.post(self.plugin._handle_login, 'nobody', 'secret')
+        self.assertEqual(self.mock_flow.make_response.call_args[0][0], 403)
+
+        self.plugin.db.search.return_value = [{'user-name': 'admin', 'password': hash_password('secret')}]
+        self.post(self.plugin._handle_login, 'admin', 'wrong')
+        self.assertEqual(self.mock_flow.make_response.call_args[0][0], 403)
+        self.mock_flow.make_response_with_cookie.assert_not_called()
+        self.plugin.db.update.assert_not_called()
+
+    def test_register_refuses_existing_user_name(self):
+        self.plugin.db.search.return_value = [{'user-name': 'admin', 'password': 'x'}]
+        self.post(self.plugin._handle_register, 'admin', 'secret')
+        self.assertEqual(self.mock_flow.make_response.call_args[0][0], 403)
+        self.plugin.db.insert.assert_not_called()
+
+        self.plugin.db.search.return_value = []
+        self.post(self.plugin._handle_register, 'other', 'secret')
+        self.assertEqual(self.mock_flow.make_response.call_args[0][0], 200)
+        self.assertTrue(verify_password('secret', self.plugin.db.insert.call_args[0][1]['password']))
+
+    def test_client_with_a_hash_in_progress_gets_429(self):
+        self.plugin.hashing_limiter.acquire('10.0.0.1')
+        self.addCleanup(self.plugin.hashing_limiter.release, '10.0.0.1')
+
+        with patch.object(passwords, 'hashing_executor') as hashing_executor:
+            self.post(self.plugin._handle_login, 'admin', 'secret')
+
+        hashing_executor.submit.assert_not_called()
+        self.assertEqual(self.mock_flow.make_response.call_args[0][0], 429)
+        self.plugin.db.search.assert_not_called()
+
+    def test_clients_behind_the_relay_are_limited_per_connection(self):
+        self.mock_flow.get_client_ip.return_value = '127.0.0.1'
+        self.mock_flow.get_connection_id.return_value = 'connection-2'
+        self.plugin.hashing_limiter.acquire('127.0.0.1')
+        self.addCleanup(self.plugin.hashing_limiter.release, '127.0.0.1')
+        self.plugin.db.search.return_value = []
+
+        with patch('config.BEHIND_RELAY', True):
+            self.post(self.plugin._handle_login, 'admin', 'secret')
+
+        self.assertEqual(self.mock_flow.make_response.call_args[0][0], 403)
+
+
+if __name__ == '__main__':
+    unittest.main()
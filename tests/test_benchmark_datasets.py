@@ -0,0 +1,45 @@
+import unittest
+import os
+import sys
+sys.path.insert(0, os.path.abspath(
+    os.path.join(os.path.dirname(__file__), '..')))
+from benchmarks import datasets
+from benchmarks.fake_flow import FakeFlow
+from core.domain_index import DomainIndex
+
+
+class TestBenchmarkDatasets(unittest.TestCase):
+    def test_traffic_is_reproducible_and_mostly_approved(self):
+        rules = [row['domain'] for row in datasets.approved_domains(1000)]
+        flows = datasets.traffic(2000, 1000, datasets.UNIFORM, blocked_ratio=0.2, hosts_count=500)
+
+        self.assertEqual(flows, datasets.traffic(2000, 1000, datasets.UNIFORM, blocked_ratio=0.2, hosts_count=500))
+        index = DomainIndex(rules)
+        approved = sum(index.match(host) for host, _ in flows)
+        self.assertGreater(approved, len(flows) * 0.7)
+        self.assertLess(approved, len(flows))
+
+    def test_percentile_is_nearest_rank(self):
+        values = list(range(1, 101))
+
+        self.assertEqual(datasets.percentile(values, 0.5), 50)
+        self.assertEqual(datasets.percentile(values, 0.99), 99)
+        self.assertEqual(datasets.percentile([7], 0.99), 7)
+        self.assertEqual(datasets.percentile([], 0.5), 0.0)
+
+
+class TestFakeFlow(unittest.TestCase):
+    def test_response_headers_are_a_dict(self):
+        flow = FakeFlow('a.com')
+        headers = {"Content-Type": "application/json"}
+        flow.make_response_with_cookie(200, b"{}", headers, 'session', 'token')
+
+        self.assertEqual(flow.get_response().headers,
+                         {"Content-Type": "application/json", "set-cookie": "session=token"})
+        self.assertEqual(headers, {"Content-Type": "application/json"})
+        flow.make_response(404, b"Not found", "text/plain")
+        self.assertEqual(flow.get_response().headers, {"Content-Type": "text/plain"})
+
+
+if __name__ == '__main__':
+    unittest.main()
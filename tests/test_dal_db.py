@@ -0,0 +1,292 @@
+import json
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest.mock import patch
+import os
+import sys
+sys.path.insert(0, os.path.abspath(
+    os.path.join(os.path.dirname(__file__), '..')))
+import config
+from core.singleton_pattern import Singleton
+from dal_db import DalDB
+
+
+class TestDalDB(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.tmp_dir, 'db.json')
+        self.db = self.open_db()
+
+    def tearDown(self):
+        Singleton._instances.pop(DalDB, None)
+        shutil.rmtree(self.tmp_dir)
+
+    def open_db(self):
+        # DalDB is a singleton, drop the instance to simulate a restart
+        Singleton._instances.pop(DalDB, None)
+        return DalDB(self.db_path)
+
+    def record_threads(self):
+        """
+        Return the list the background threads DalDB starts from now on are added to.
+        DalDB forgets its thread when the thread ends, which may be before the test reads it.
+        """
+        threads = []
+
+        class RecordedThread(threading.Thread):
+            def start(self):
+                threads.append(self)
+                super().start()
+
+        patcher = patch('dal_db.threading.Thread', RecordedThread)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return threads
+
+    def journal_records(self):
+        # The id record written when the database was created is left out
+        with open(self.db_path + '.journal') as f:
+            return [record for record in map(json.loads, f) if record['op'] != 'meta']
+
+    def open_other_process(self):
+        # A second instance on the same files, as another proxy worker would hold
+        dal = DalDB.__new__(DalDB)
+        dal.__init__(self.db_path)
+        return dal
+
+    def test_writes_append_to_journal(self):
+        self.db.insert('approved_domains', {'domain': 'example.com'})
+        self.db.insert('approved_domains', {'domain': 'test.com'})
+
+        self.assertEqual(os.path.getsize(self.db_path), 0)
+        self.assertEqual(len(self.journal_records()), 2)
+
+    def test_recovery_replays_journal(self):
+        self.db.insert('approved_domains', {'domain': 'example.com'})
+        self.db.insert('approved_domains', {'domain': 'test.com'})
+        self.db.update('approved_domains', {
+                       'domain': 'new.com'}, 'domain', 'test.com')
+        self.db.remove('approved_domains', 'domain', 'example.com')
+
+        db = self.open_db()
+
+        self.assertEqual(db.fetch_all('approved_domains'),
+                         [{'domain': 'new.com'}])
+
+    def test_recovery_drops_torn_record(self):
+        self.db.insert('approved_domains', {'domain': 'example.com'})
+        with open(self.db_path + '.journal', 'a') as f:
+            f.write('{"op": "insert", "table": "approved_do')
+
+        db = self.open_db()
+        db.insert('approved_domains', {'domain': 'test.com'})
+        db = self.open_db()
+
+        self.assertEqual(db.fetch_all('approved_domains'), [
+                         {'domain': 'example.com'}, {'domain': 'test.com'}])
+
+    def test_compact_writes_snapshot_and_empties_journal(self):
+        self.db.insert('approved_domains', {'domain': 'example.com'})
+        self.db.compact()
+        self.db.insert('approved_domains', {'domain': 'test.com'})
+
+        with open(self.db_path) as f:
+            self.assertEqual(json.load(f)['approved_domains'], [
+                             {'domain': 'example.com'}])
+        with open(self.db_path + '.journal') as f:
+            self.assertEqual(len(f.readlines()), 1)
+        self.assertEqual(len(self.open_db().fetch_all('approved_domains')), 2)
+
+    def test_journal_compacted_in_background_past_threshold(self):
+        threads = self.record_threads()
+        with patch.object(config, 'DB_JOURNAL_COMPACT_BYTES', 1):
+            self.db.insert('approved_domains', {'domain': 'example.com'})
+            compaction_thread, = threads
+            compaction_thread.join()
+
+        with open(self.db_path) as f:
+            self.assertEqual(json.load(f)['approved_domains'], [
+                             {'domain': 'example.com'}])
+        self.assertEqual(os.path.getsize(self.db_path + '.journal'), 0)
+
+    def test_interrupted_compaction_is_not_replayed_twice(self):
+        self.db.insert('approved_domains', {'domain': 'example.com'})
+        self.db.compact()
+        # Simulate a crash after the snapshot was written but before the old journal was deleted
+        with open(self.db_path + '.journal.compacting', 'w') as f:
+            f.write(json.dumps({'op': 'insert', 'table': 'approved_domains',
+                    'data': {'domain': 'example.com'}, 'seq': 1}) + '\n')
+
+        db = self.open_db()
+
+        self.assertEqual(db.fetch_all('approved_domains'),
+                         [{'domain': 'example.com'}])
+
+    def test_index_stays_consistent_across_mutations(self):
+        self.db.ensure_index('users', 'user-name')
+        self.db.insert('users', {'user-name': 'admin', 'password': 'a'})
+        self.db.insert('users', {'user-name': 'guest', 'password': 'b'})
+
+        self.db.update('users', {'user-name': 'root'}, 'password', 'a')
+        self.db.remove('users', 'user-name', 'guest')
+
+        self.assertEqual(self.db.search('users', 'user-name', 'admin'), [])
+        self.assertEqual(self.db.search('users', 'user-name', 'root'), [
+                         {'user-name': 'root', 'password': 'a'}])
+        self.assertEqual(self.db.search('users', 'user-name', 'guest'), [])
+        self.assertEqual(self.db.indexes[('users', 'user-name')], {
+                         'root': self.db.fetch_all('users')})
+
+    def test_index_rebuilt_on_load(self):
+        self.db.ensure_index('approved_domains', 'domain')
+        self.db.insert('approved_domains', {'domain': 'example.com'})
+
+        self.db.load_db()
+
+        self.assertIs(self.db.search('approved_domains', 'domain', 'example.com')[0],
+                      self.db.fetch_all('approved_domains')[0])
+
+    def test_transaction_writes_one_record(self):
+        with self.db.transaction():
+            for i in range(10):
+                self.db.insert('approved_domains', {'domain': f'{i}.com'})
+            self.db.remove('approved_domains', 'domain', '0.com')
+
+        self.assertEqual(len(self.journal_records()), 1)
+        self.assertEqual(
+            len(self.open_db().fetch_all('approved_domains')), 9)
+
+    def test_transaction_rolls_back_on_exception(self):
+        self.db.ensure_index('users', 'user-name')
+        self.db.insert('users', {'user-name': 'admin', 'password': 'a'})
+
+        with self.assertRaises(RuntimeError):
+            with self.db.transaction():
+                self.db.update('users', {'password': 'b'}, 'user-name', 'admin')
+                self.db.insert('users', {'user-name': 'guest', 'password': 'c'})
+                self.db.insert('contents', {'domain_name': 'a.com', 'content': ['video']})
+                raise RuntimeError()
+
+        self.assertEqual(self.db.fetch_all('users'), [
+                         {'user-name': 'admin', 'password': 'a'}])
+        self.assertEqual(self.db.search('users', 'user-name', 'guest'), [])
+        self.assertNotIn('contents', self.db.db)
+        self.assertEqual(
+            self.open_db().fetch_all('users'), [{'user-name': 'admin', 'password': 'a'}])
+
+    def test_transaction_rolls_back_when_its_write_fails(self):
+        self.db.insert('users', {'user-name': 'admin', 'password': 'a'})
+
+        with patch('os.fsync', side_effect=OSError("disk full")):
+            with self.assertRaises(OSError):
+                with self.db.transaction():
+                    self.db.update('users', {'password': 'b'}, 'user-name', 'admin')
+                    self.db.insert('users', {'user-name': 'guest', 'password': 'c'})
+
+        self.assertEqual(self.db.fetch_all('users'), [{'user-name': 'admin', 'password': 'a'}])
+        self.assertEqual(len(self.journal_records()), 1)
+        self.db.insert('users', {'user-name': 'other', 'password': 'd'})
+        self.assertEqual(self.open_db().fetch_all('users'), [
+                         {'user-name': 'admin', 'password': 'a'}, {'user-name': 'other', 'password': 'd'}])
+
+    def test_refresh_applies_other_process_writes(self):
+        other = self.open_other_process()
+        other.insert('approved_domains', {'domain': 'example.com'})
+
+        self.assertTrue(self.db.refresh())
+        self.assertEqual(self.db.fetch_all('approved_domains'),
+                         [{'domain': 'example.com'}])
+        self.assertFalse(self.db.refresh())
+
+    def test_write_catches_up_before_appending(self):
+        other = self.open_other_process()
+        other.insert('approved_domains', {'domain': 'example.com'})
+        self.db.insert('approved_domains', {'domain': 'test.com'})
+        other.update('approved_domains', {'domain': 'new.com'}, 'domain', 'test.com')
+
+        self.assertTrue(self.db.refresh())
+        expected = [{'domain': 'example.com'}, {'domain': 'new.com'}]
+        self.assertEqual(self.db.fetch_all('approved_domains'), expected)
+        self.assertEqual(self.open_db().fetch_all('approved_domains'), expected)
+
+    def test_refresh_after_other_process_compaction(self):
+        self.db.insert('approved_domains', {'domain': 'example.com'})
+        other = self.open_other_process()
+        other.insert('approved_domains', {'domain': 'test.com'})
+        other.compact()
+
+        self.assertTrue(self.db.refresh())
+        self.assertEqual(self.db.fetch_all('approved_domains'), [
+                         {'domain': 'example.com'}, {'domain': 'test.com'}])
+
+    def test_table_version_changes_with_the_table_only(self):
+        self.db.insert('approved_domains', {'domain': 'example.com'})
+        version = self.db.version('approved_domains')
+
+        self.db.insert('users', {'user-name': 'admin'})
+        self.assertEqual(self.db.version('approved_domains'), version)
+        self.db.remove('approved_domains', 'domain', 'example.com')
+        self.assertNotEqual(self.db.version('approved_domains'), version)
+
+        version = self.db.version('approved_domains')
+        self.db.compact()
+        self.assertEqual(self.open_db().version('approved_domains'), version)
+
+    def test_version_does_not_write(self):
+        journal_size = os.path.getsize(self.db.journal_path)
+        self.db.version('approved_domains')
+        self.assertEqual(os.path.getsize(self.db.journal_path), journal_size)
+
+    def test_write_behind_coalesces_mutations_into_one_write(self):
+        with patch.object(config, 'DB_WRITE_BEHIND_INTERVAL', 60):
+            db = self.open_db()
+        db.insert('approved_domains', {'domain': 'example.com'})
+        db.insert('approved_domains', {'domain': 'test.com'})
+        db.remove('approved_domains', 'domain', 'example.com')
+
+        self.assertEqual(self.journal_records(), [])
+        self.assertEqual(db.fetch_all('approved_domains'), [{'domain': 'test.com'}])
+
+        db.flush()
+
+        self.assertEqual(db.coalesced_writes, 2)
+        self.assertEqual(self.open_db().fetch_all('approved_domains'), [{'domain': 'test.com'}])
+
+    def test_write_behind_flushes_in_background(self):
+        threads = self.record_threads()
+        with patch.object(config, 'DB_WRITE_BEHIND_INTERVAL', 0.01):
+            db = self.open_db()
+        db.insert('approved_domains', {'domain': 'example.com'})
+        flush_thread, = threads
+        flush_thread.join()
+
+        self.assertEqual(len(self.journal_records()), 1)
+
+    def test_write_behind_compaction_writes_pending_records_once(self):
+        with patch.object(config, 'DB_WRITE_BEHIND_INTERVAL', 60):
+            db = self.open_db()
+        db.insert('approved_domains', {'domain': 'example.com'})
+        db.compact()
+        db.insert('approved_domains', {'domain': 'test.com'})
+        db.flush()
+
+        self.assertEqual(self.open_db().fetch_all('approved_domains'), [
+                         {'domain': 'example.com'}, {'domain': 'test.com'}])
+
+    def test_write_behind_orders_records_after_other_process_writes(self):
+        with patch.object(config, 'DB_WRITE_BEHIND_INTERVAL', 60):
+            db = self.open_db()
+        db.insert('approved_domains', {'domain': 'example.com'})
+        other = self.open_other_process()
+        other.insert('approved_domains', {'domain': 'test.com'})
+        db.flush()
+
+        expected = [{'domain': 'test.com'}, {'domain': 'example.com'}]
+        self.assertEqual(db.fetch_all('approved_domains'), expected)
+        self.assertEqual(self.open_db().fetch_all('approved_domains'), expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,123 @@
+import json
+import shutil
+import tempfile
+import unittest
+import os
+import sys
+sys.path.insert(0, os.path.abspath(
+    os.path.join(os.path.dirname(__file__), '..')))
+from core.singleton_pattern import Singleton
+from dal_sqlite import DalSQLite
+
+
+class TestDalSQLite(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.tmp_dir, 'db.sqlite3')
+        self.json_db_path = os.path.join(self.tmp_dir, 'db.json')
+        Singleton._instances.pop(DalSQLite, None)
+        self.db = DalSQLite(self.db_path, self.json_db_path)
+
+    def tearDown(self):
+        self.db.conn.close()
+        Singleton._instances.pop(DalSQLite, None)
+        shutil.rmtree(self.tmp_dir)
+
+    def test_insert_and_search(self):
+        self.db.insert('users', {'user-name': 'admin', 'password': 'hash'})
+        self.db.insert('users', {'user-name': 'other', 'password': 'hash2'})
+
+        self.assertEqual(self.db.search('users', 'user-name', 'admin'), [
+                         {'user-name': 'admin', 'password': 'hash'}])
+        self.assertEqual(self.db.search('users', 'user-name', 'nobody'), [])
+        self.assertEqual(self.db.search('missing', 'key', 'value'), [])
+
+    def test_search_uses_index(self):
+        self.db.insert('approved_domains', {'domain': 'example.com'})
+        self.db.search('approved_domains', 'domain', 'example.com')
+
+        plan = self.db.conn.execute(
+            "EXPLAIN QUERY PLAN SELECT data FROM approved_domains "
+            "WHERE json_extract(data, '$.\"domain\"') IS 'example.com'").fetchall()
+        self.assertIn('INDEX', ' '.join(str(row) for row in plan))
+
+    def test_update_with_list_value(self):
+        self.db.insert('plugins', {'request_plugins_list': ['Auth', 'White List']})
+        self.db.insert('plugins', {'response_plugins_list': ['Filter Content']})
+
+        self.db.update('plugins', {'request_plugins_list': ['Auth']},
+                       'request_plugins_list', ['Auth', 'White List'])
+
+        self.assertEqual(self.db.fetch_all('plugins'), [
+                         {'request_plugins_list': ['Auth']},
+                         {'response_plugins_list': ['Filter Content']}])
+
+    def test_remove(self):
+        self.db.insert('approved_domains', {'domain': 'example.com'})
+        self.db.insert('approved_domains', {'domain': 'test.com'})
+
+        self.db.remove('approved_domains', 'domain', 'example.com')
+
+        self.assertEqual(self.db.fetch_all('approved_domains'),
+                         [{'domain': 'test.com'}])
+
+    def test_migrates_json_database(self):
+        self.db.conn.close()
+        Singleton._instances.pop(DalSQLite, None)
+        os.remove(self.db_path)
+        with open(self.json_db_path, 'w') as f:
+            json.dump({'approved_domains': [{'domain': 'example.com'}]}, f)
+        journal = json.dumps({'op': 'insert', 'table': 'approved_domains',
+                              'data': {'domain': 'test.com'}, 'seq': 1}) + '\n'
+        with open(self.json_db_path + '.journal', 'w') as f:
+            f.write(journal)
+
+        self.db = DalSQLite(self.db_path, self.json_db_path)
+
+        self.assertEqual(self.db.fetch_all('approved_domains'),
+                         [{'domain': 'example.com'}, {'domain': 'test.com'}])
+        # The source is only read, no record or lock file is written next to it
+        with open(self.json_db_path + '.journal') as f:
+            self.assertEqual(f.read(), journal)
+        self.assertEqual({name for name in os.listdir(self.tmp_dir) if name.startswith('db.json')},
+                         {'db.json', 'db.json.journal'})
+
+    def test_transaction_rolls_back_on_exception(self):
+        self.db.insert('approved_domains', {'domain': 'example.com'})
+
+        with self.assertRaises(RuntimeError):
+            with self.db.transaction():
+                self.db.insert('approved_domains', {'domain': 'test.com'})
+                self.db.insert('contents', {'domain_name': 'test.com', 'content': ['video']})
+                raise RuntimeError()
+
+        self.assertEqual(self.db.fetch_all('approved_domains'),
+                         [{'domain': 'example.com'}])
+        self.assertEqual(self.db.fetch_all('contents'), [])
+
+    def test_refresh_sees_other_process_commits(self):
+        # A second instance on the same file, as another proxy worker would hold
+        other = DalSQLite.__new__(DalSQLite)
+        other.__init__(self.db_path, self.json_db_path)
+        self.assertFalse(self.db.refresh())
+
+        other.insert('approved_domains', {'domain': 'example.com'})
+
+        self.assertTrue(self.db.refresh())
+        self.assertEqual(self.db.fetch_all('approved_domains'),
+                         [{'domain': 'example.com'}])
+        self.assertFalse(self.db.refresh())
+        other.conn.close()
+
+    def test_table_version_changes_with_the_table_only(self):
+        self.db.insert('approved_domains', {'domain': 'example.com'})
+        version = self.db.version('approved_domains')
+
+        self.db.insert('users', {'user-name': 'admin'})
+        self.assertEqual(self.db.version('approved_domains'), version)
+        self.db.remove('approved_domains', 'domain', 'example.com')
+        self.assertNotEqual(self.db.version('approved_domains'), version)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+import re
+import unittest
+from unittest.mock import Mock, patch
+import os
+import sys
+sys.path.insert(0, os.path.abspath(
+    os.path.join(os.path.dirname(__file__), '..')))
+
+try:
+    from plugins.filter_content import FilterContent, compile_content_patterns, translate_content_pattern
+except ImportError:  # The contenttype package is not installed
+    FilterContent = None
+
+
+@unittest.skipIf(FilterContent is None, "contenttype is not installed")
+class TestContentPatterns(unittest.TestCase):
+    def test_bare_type_allows_its_subtypes(self):
+        pattern = re.compile(translate_content_pattern('Video'), re.IGNORECASE)
+        self.assertTrue(pattern.fullmatch('video/mp4'))
+        self.assertTrue(pattern.fullmatch('video/webm'))
+        self.assertFalse(pattern.fullmatch('audio/mp4'))
+        self.assertFalse(pattern.fullmatch('videos/mp4'))
+
+    def test_wildcard_subtype(self):
+        pattern = re.compile(translate_content_pattern('image/*'), re.IGNORECASE)
+        self.assertTrue(pattern.fullmatch('image/png'))
+        self.assertFalse(pattern.fullmatch('text/html'))
+
+    def test_pattern_matches_the_whole_media_type(self):
+        pattern = compile_content_patterns(['text/html', 'application/(json|xml)'])
+        self.assertTrue(pattern.fullmatch('text/html'))
+        self.assertTrue(pattern.fullmatch('application/json'))
+        self.assertFalse(pattern.fullmatch('text/html5'))
+        self.assertFalse(pattern.fullmatch('application/javascript'))
+
+    def test_pattern_keeps_the_case_of_its_escapes(self):
+        pattern = compile_content_patterns([r'Application/\S+\+json', r'text/\D'])
+        self.assertTrue(pattern.fullmatch('application/ld+json'))
+        self.assertFalse(pattern.fullmatch('application/ +json'))
+        self.assertTrue(pattern.fullmatch('TEXT/x'))
+        self.assertFalse(pattern.fullmatch('text/1'))
+
+    def test_no_patterns_allow_nothing(self):
+        self.assertFalse(compile_content_patterns([]).fullmatch('text/html'))
+
+    def test_invalid_pattern(self):
+        with self.assertRaises(re.error):
+            translate_content_pattern('application/vnd.a(')
+
+        with patch('builtins.print') as mock_print:
+            pattern = compile_content_patterns(['application/vnd.a(', 'text/(', 'image/png'])
+
+        # Kept as plain text instead of dropped, and reported
+        self.assertTrue(pattern.fullmatch('application/vnd.a('))
+        self.assertFalse(pattern.fullmatch('application/vnd.ab'))
+        self.assertTrue(pattern.fullmatch('image/png'))
+        self.assertEqual(mock_print.call_count, 2)
+
+
+@unittest.skipIf(FilterContent is None, "contenttype is not installed")
+class TestFilterContent(unittest.TestCase):
+    def setUp(self):
+        self.plugin = FilterContent()
+        self.plugin.snapshot_writer = None
+        self.plugin.contents = [
+            {'domain_name': 'example.com', 'content': ['text']},
+            {'domain_name': '*.media.example.com', 'content': ['video', 'image/*']},
+            {'domain_name': 'WWW.Other.com', 'content': ['application/json']},
+        ]
+
+    def test_contents_are_keyed_by_bare_domain(self):
+        self.assertEqual(set(self.plugin.compiled_contents), {'example.com', 'media.example.com', 'other.com'})
+        self.assertTrue(self.plugin.compiled_contents['other.com'].fullmatch('application/json'))
+
+    def test_most_specific_domain_wins(self):
+        find = self.plugin._find_allowed_contents
+        self.assertIs(find('a.media.example.com'), self.plugin.compiled_contents['media.example.com'])
+        self.assertIs(find('media.example.com'), self.plugin.compiled_contents['media.example.com'])
+        self.assertIs(find('www2.example.com'), self.plugin.compiled_contents['example.com'])
+        self.assertIsNone(find('example.org'))
+
+    def test_on_response_headers(self):
+        flow = Mock()
+        flow.get_host.return_value = 'cdn.media.example.com'
+        flow.get_response.return_value.headers = {'Content-Type': 'video/mp4'}
+        self.assertTrue(self.plugin.on_response_headers(flow))
+
+        flow.get_host.return_value = 'www.example.com'
+        self.assertFalse(self.plugin.on_response_headers(flow))
+        flow.kill.assert_called_once()
+
+        flow.get_host.return_value = 'unrestricted.org'
+        self.assertTrue(self.plugin.on_response_headers(flow))
+
+
+    def test_snapshot_takes_the_version_the_contents_were_fetched_at(self):
+        self.plugin.db = Mock()
+        self.plugin.db.version.return_value = '1'
+        self.plugin.db.fetch_all.return_value = [{'domain_name': '=a.com', 'content': ['text']}]
+        self.plugin.reload_policy()
+
+        # A write the contents don't have yet has moved the table on
+        self.plugin.db.version.return_value = '2'
+        self.assertEqual(self.plugin._build_snapshot(), ('1', (), {'a.com': ['text']}))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,181 @@
+import asyncio
+import unittest
+from unittest.mock import Mock
+import os
+import sys
+sys.path.insert(0, os.path.abspath(
+    os.path.join(os.path.dirname(__file__), '..')))
+from core import metrics
+from core.plugin_base import PluginBase
+from manager import Manager
+
+
+class RequestOnlyPlugin(PluginBase):
+    def __init__(self) -> None:
+        self.calls = []
+
+    def title(self):
+        return 'Request Only'
+
+    def on_request(self, flow):
+        self.calls.append(flow)
+        return flow.allow
+
+
+class ResponsePlugin(PluginBase):
+    def __init__(self) -> None:
+        self.calls = []
+
+    def title(self):
+        return 'Response'
+
+    def on_request(self, flow):
+        self.calls.append(flow)
+        return True
+
+    def on_response(self, flow):
+        self.calls.append(flow)
+        return True
+
+
+class AsyncPlugin(PluginBase):
+    def __init__(self) -> None:
+        self.calls = []
+
+    def title(self):
+        return 'Async'
+
+    async def on_request(self, flow):
+        await asyncio.sleep(0)
+        self.calls.append(flow)
+        return flow.allow
+
+
+class HeadersPlugin(PluginBase):
+    def __init__(self) -> None:
+        self.calls = []
+
+    def title(self):
+        return 'Headers'
+
+    async def on_response_headers(self, flow):
+        self.calls.append(flow)
+        return flow.allow
+
+
+class OtherHeadersPlugin(HeadersPlugin):
+    def title(self):
+        return 'Other Headers'
+
+
+class TestManager(unittest.TestCase):
+    def setUp(self):
+        self.first = RequestOnlyPlugin()
+        self.second = ResponsePlugin()
+        self.first.calls.clear()
+        self.second.calls.clear()
+        metrics.reset()
+        self.manager = Manager([self.first, self.second])
+        self.mock_flow = Mock()
+
+    def test_pipeline_skips_plugins_without_hook(self):
+        self.assertEqual(len(self.manager.request_hooks), 2)
+        self.assertEqual(len(self.manager.response_hooks), 1)
+        self.assertEqual(len(self.manager.response_headers_hooks), 0)
+
+    def test_on_request_runs_plugins_in_order(self):
+        self.mock_flow.allow = True
+
+        asyncio.run(self.manager.on_request(self.mock_flow))
+
+        self.assertEqual(self.first.calls, [self.mock_flow])
+        self.assertEqual(self.second.calls, [self.mock_flow])
+
+    def test_on_request_stops_when_plugin_returns_false(self):
+        self.mock_flow.allow = False
+
+        asyncio.run(self.manager.on_request(self.mock_flow))
+
+        self.assertEqual(self.first.calls, [self.mock_flow])
+        self.assertEqual(self.second.calls, [])
+
+    def test_admin_request_skips_filtering_plugins(self):
+        self.mock_flow.get_host.return_value = "settings.it"
+        self.mock_flow.get_request.return_value.path = "/api/unknown"
+        self.mock_flow.get_request.return_value.method = "GET"
+
+        asyncio.run(self.manager.on_request(self.mock_flow))
+
+        self.assertEqual(self.first.calls, [])
+        self.mock_flow.make_response.assert_called_once()
+        self.assertEqual(self.mock_flow.make_response.call_args[0][0], 404)
+
+    def test_async_hook_is_awaited_and_can_stop_the_pipeline(self):
+        async_plugin = AsyncPlugin()
+        async_plugin.calls.clear()
+        manager = Manager([async_plugin, self.second])
+        self.mock_flow.allow = False
+
+        asyncio.run(manager.on_request(self.mock_flow))
+
+        self.assertEqual(async_plugin.calls, [self.mock_flow])
+        self.assertEqual(self.second.calls, [])
+
+        self.mock_flow.allow = True
+        asyncio.run(manager.on_request(self.mock_flow))
+        self.assertEqual(self.second.calls, [self.mock_flow])
+
+    def test_on_response_headers_runs_only_the_plugins_with_the_hook(self):
+        headers_plugin = HeadersPlugin()
+        second_headers_plugin = OtherHeadersPlugin()
+        headers_plugin.calls.clear()
+        second_headers_plugin.calls.clear()
+        manager = Manager([self.first, headers_plugin, second_headers_plugin])
+        self.assertEqual(len(manager.response_headers_hooks), 2)
+
+        self.mock_flow.allow = False
+        asyncio.run(manager.on_response_headers(self.mock_flow))
+
+        self.assertEqual(self.first.calls, [])
+        self.assertEqual(headers_plugin.calls, [self.mock_flow])
+        self.assertEqual(second_headers_plugin.calls, [])
+        self.assertEqual(metrics.verdicts, {('on_response_headers', 'block'): 1})
+
+        self.mock_flow.allow = True
+        asyncio.run(manager.on_response_headers(self.mock_flow))
+        self.assertEqual(second_headers_plugin.calls, [self.mock_flow])
+
+    def test_hooks_record_metrics_and_verdicts(self):
+        self.mock_flow.allow = True
+        asyncio.run(self.manager.on_request(self.mock_flow))
+        self.mock_flow.allow = False
+        asyncio.run(self.manager.on_request(self.mock_flow))
+
+        first = metrics.hook_stats[('Request Only', 'on_request')]
+        second = metrics.hook_stats[('Response', 'on_request')]
+        self.assertEqual((first.calls, first.short_circuits), (2, 1))
+        self.assertEqual((second.calls, second.short_circuits), (1, 0))
+        self.assertEqual(sum(first.buckets), 2)
+        self.assertEqual(metrics.verdicts, {('on_request', 'allow'): 1, ('on_request', 'block'): 1})
+
+    def test_metrics_endpoint_serves_prometheus_text(self):
+        self.mock_flow.allow = True
+        asyncio.run(self.manager.on_request(self.mock_flow))
+        admin_flow = Mock()
+        admin_flow.get_host.return_value = "settings.it"
+        admin_flow.get_request.return_value.path = "/api/metrics"
+        admin_flow.get_request.return_value.method = "GET"
+
+        asyncio.run(self.manager.on_request(admin_flow))
+
+        status, body, headers = admin_flow.make_response.call_args[0]
+        self.assertEqual(status, 200)
+        self.assertTrue(headers["Content-Type"].startswith("text/plain; version=0.0.4"))
+        self.assertIn('safebrowse_hook_calls_total{plugin="Request Only",hook="on_request"} 1', body)
+        self.assertIn('safebrowse_hook_duration_seconds_bucket{plugin="Request Only",hook="on_request",le="+Inf"} 1',
+                      body)
+        self.assertIn('safebrowse_verdicts_total{hook="on_request",verdict="allow"} 1', body)
+
+
+if __name__ == '__main__':
+    unittest.main()
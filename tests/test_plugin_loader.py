@@ -0,0 +1,182 @@
+import asyncio
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest.mock import Mock, patch
+sys.path.insert(0, os.path.abspath(
+    os.path.join(os.path.dirname(__file__), '..')))
+import plugins
+from core.plugin_base import PluginBase
+from core import plugin_loader
+from core.plugin_loader import LazyPlugin, PluginManifest, get_plugin, import_plugin, inspect_plugin_source
+from manager import Manager
+
+PLUGIN_SOURCE = '''
+class Blocker(PluginBase):
+    def title(self):
+        return "Blocker"
+
+    async def on_request(self, flow):
+        return False
+
+    def on_response(self, flow):
+        return True
+
+
+class DerivedBlocker(Blocker):
+    def title(self):
+        return "Derived"
+'''
+
+RELOAD_SOURCE = '''from core.plugin_base import PluginBase
+
+
+class ReloadTestPlugin(PluginBase):
+    version = %d
+
+    def title(self):
+        return "Reload Test"
+
+    def on_request(self, flow):
+        flow.versions.append(self.version)
+        return True
+'''
+
+
+class LoadedPlugin(PluginBase):
+    def __init__(self) -> None:
+        self.calls = []
+
+    def title(self):
+        return 'Loaded'
+
+    def register_routes(self, router):
+        router.add("GET", "/api/loaded", lambda flow: flow.make_response(200, b"ok", {}))
+
+    def on_request(self, flow):
+        self.calls.append(flow)
+        return True
+
+
+class TestPluginLoader(unittest.TestCase):
+    def test_inspect_plugin_source(self):
+        classes = inspect_plugin_source(PLUGIN_SOURCE)
+
+        self.assertEqual(classes['Blocker'], {
+            'title': 'Blocker', 'hooks': {'on_request': True, 'on_response': False}, 'lazy': True})
+        # Its hooks are inherited, only importing it tells which ones
+        self.assertFalse(classes['DerivedBlocker']['lazy'])
+
+    def test_manifest_is_cached_per_module_file(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'manifest.json')
+            manifest = PluginManifest(path)
+            info = manifest.lookup('white_list_plugin', 'WhiteListPlugin')
+            self.assertEqual((info['title'], info['hooks']), ('White List', {'on_request': False}))
+            manifest.save()
+
+            cached = PluginManifest(path)
+            with patch('core.plugin_loader.inspect_plugin_source') as inspect_source:
+                self.assertEqual(cached.lookup('white_list_plugin', 'WhiteListPlugin'), info)
+            inspect_source.assert_not_called()
+            self.assertIsNone(cached.lookup('white_list_plugin', 'NoSuchPlugin'))
+
+    def test_lazy_plugin_is_loaded_on_first_use(self):
+        plugin = LoadedPlugin()
+        plugin.calls.clear()
+        lazy = LazyPlugin('loaded', 'LoadedPlugin', {'title': 'Loaded', 'hooks': {'on_request': False}, 'lazy': True})
+
+        with patch('core.plugin_loader.import_plugin', return_value=plugin) as import_plugin:
+            manager = Manager([lazy])
+            self.assertEqual(len(manager.request_hooks), 1)
+            self.assertEqual(len(manager.response_hooks), 0)
+            import_plugin.assert_not_called()
+
+            flow = Mock()
+            asyncio.run(manager.on_request(flow))
+            self.assertEqual(plugin.calls, [flow])
+
+            admin_flow = Mock()
+            admin_flow.get_host.return_value = "settings.it"
+            admin_flow.get_request.return_value.path = "/api/loaded"
+            admin_flow.get_request.return_value.method = "GET"
+            asyncio.run(manager.on_request(admin_flow))
+
+        import_plugin.assert_called_once()
+        self.assertEqual(admin_flow.make_response.call_args[0][0], 200)
+
+    def test_lazy_plugin_that_fails_to_load_blocks_the_flow(self):
+        lazy = LazyPlugin('failing', 'FailingPlugin', {
+            'title': 'Failing', 'hooks': {'on_request': True, 'on_response': False}, 'lazy': True})
+
+        with patch('core.plugin_loader.import_plugin', side_effect=ValueError("bad rule")):
+            manager = Manager([lazy])
+            flow = Mock()
+            asyncio.run(manager.on_request(flow))
+            flow.kill.assert_called_once()
+
+            flow = Mock()
+            asyncio.run(manager.on_response(flow))
+            flow.kill.assert_called_once()
+        self.assertIsNone(lazy.instance)
+
+
+class TestPluginReload(unittest.TestCase):
+    module_name = '_reload_test_plugin'
+
+    def setUp(self):
+        # The test plugin lives in a temporary directory added to the plugins package, not in plugins/
+        plugins_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, plugins_dir)
+        patcher = patch.object(plugin_loader, 'PLUGINS_DIR', plugins_dir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = patch.object(plugins, '__path__', [plugins_dir, *plugins.__path__])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.path = os.path.join(plugins_dir, self.module_name + '.py')
+        self.write_version(1)
+
+    def tearDown(self):
+        sys.modules.pop('plugins.' + self.module_name, None)
+        plugin_loader._module_signatures.pop(self.module_name, None)
+        plugin_loader._lazy_plugins.pop((self.module_name, 'ReloadTestPlugin'), None)
+
+    def write_version(self, version):
+        with open(self.path, 'w') as f:
+            f.write(RELOAD_SOURCE % version + '\n' * version)
+
+    def test_changed_module_is_reloaded_and_old_pipeline_keeps_old_plugin(self):
+        old_plugin = import_plugin(self.module_name, 'ReloadTestPlugin')
+        self.assertIs(import_plugin(self.module_name, 'ReloadTestPlugin'), old_plugin)
+        old_pipeline = Manager([old_plugin])
+
+        self.write_version(2)
+        new_plugin = import_plugin(self.module_name, 'ReloadTestPlugin')
+        new_pipeline = Manager([new_plugin])
+
+        self.assertIsNot(new_plugin, old_plugin)
+        flow = Mock(versions=[])
+        asyncio.run(old_pipeline.on_request(flow))
+        asyncio.run(new_pipeline.on_request(flow))
+        self.assertEqual(flow.versions, [1, 2])
+
+    def test_lazy_plugin_is_replaced_when_its_module_changes(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            manifest = PluginManifest(os.path.join(tmp, 'manifest.json'))
+            proxy = get_plugin(manifest, self.module_name, 'ReloadTestPlugin')
+            self.assertIsInstance(proxy, LazyPlugin)
+            self.assertIs(get_plugin(manifest, self.module_name, 'ReloadTestPlugin'), proxy)
+
+            self.write_version(2)
+            new_proxy = get_plugin(manifest, self.module_name, 'ReloadTestPlugin')
+
+        self.assertIsNot(new_proxy, proxy)
+        self.assertEqual(new_proxy.load().version, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+import asyncio
+import json
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest.mock import MagicMock, Mock, patch
+import os
+sys.path.insert(0, os.path.abspath(
+    os.path.join(os.path.dirname(__file__), '..')))
+import config
+import plugins
+from core import plugin_loader
+
+try:
+    from plugins.plugins_management import PluginsManagement
+except ImportError:  # werkzeug is not installed
+    PluginsManagement = None
+
+FAILING_SOURCE = '''from core.plugin_base import PluginBase
+
+
+class FailingTestPlugin(PluginBase):
+    def __init__(self):
+        raise ValueError("Invalid domain rule")
+
+    def title(self):
+        return "Failing Test"
+
+    def on_request(self, flow):
+        return True
+'''
+
+
+@unittest.skipIf(PluginsManagement is None, "werkzeug is not installed")
+class TestPluginsListsUpdate(unittest.TestCase):
+    def setUp(self):
+        # The test plugin lives in a temporary directory added to the plugins package, not in plugins/
+        plugins_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, plugins_dir)
+        for patcher in (patch.object(plugin_loader, 'PLUGINS_DIR', plugins_dir),
+                        patch.object(plugins, '__path__', [plugins_dir, *plugins.__path__]),
+                        patch.object(config, 'LAZY_PLUGINS', True),
+                        patch.object(config, 'PLUGIN_MANIFEST_PATH', os.path.join(plugins_dir, 'manifest.json'))):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        with open(os.path.join(plugins_dir, 'failing_test_plugin.py'), 'w') as f:
+            f.write(FAILING_SOURCE)
+        self.addCleanup(sys.modules.pop, 'plugins.failing_test_plugin', None)
+        self.addCleanup(plugin_loader._module_signatures.pop, 'failing_test_plugin', None)
+        self.addCleanup(plugin_loader._lazy_plugins.pop, ('failing_test_plugin', 'FailingTestPlugin'), None)
+
+        self.management = PluginsManagement.__new__(PluginsManagement)
+        self.management.db = MagicMock()
+        self.management.fetch_plugins_list = Mock()
+        self.management.request_plugins_list = []
+        self.management.response_plugins_list = []
+        self.management.request_pipeline = self.request_pipeline = Mock()
+
+    def put(self, request_plugins_list):
+        flow = Mock()
+        flow.get_request.return_value.content = json.dumps(
+            {'request_plugins_list': request_plugins_list, 'response_plugins_list': []}).encode()
+        asyncio.run(self.management._handle_put(flow))
+        return flow.make_response.call_args[0][0]
+
+    def test_new_lazy_plugin_that_fails_to_start_is_refused(self):
+        self.assertEqual(self.put(['Failing Test Plugin']), 400)
+
+        self.management.db.update.assert_not_called()
+        self.assertEqual(self.management.request_plugins_list, [])
+        self.assertIs(self.management.request_pipeline, self.request_pipeline)
+
+    def test_lists_are_saved_once_their_plugins_load(self):
+        self.assertEqual(self.put([]), 200)
+
+        self.management.db.update.assert_any_call(
+            'plugins', {'request_plugins_list': []}, 'request_plugins_list', [])
+        self.assertIsNot(self.management.request_pipeline, self.request_pipeline)
+
+
+if __name__ == '__main__':
+    unittest.main()
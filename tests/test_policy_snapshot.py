@@ -0,0 +1,52 @@
+import shutil
+import tempfile
+import unittest
+import os
+import sys
+sys.path.insert(0, os.path.abspath(
+    os.path.join(os.path.dirname(__file__), '..')))
+from core.domain_index import DomainIndex
+from core.policy_snapshot import PolicySnapshot, open_snapshot, write_snapshot
+
+
+class TestPolicySnapshot(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'policy.snapshot')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_match_agrees_with_domain_index(self):
+        rules = ['example.com', '=exact.com', '*.wild.com', 'www.Upper.com', 'not valid..com']
+        write_snapshot(self.path, '1', rules)
+        snapshot = PolicySnapshot(self.path)
+        index = DomainIndex(rules[:-1])
+
+        for host in ['example.com', 'a.b.example.com', 'exact.com', 'a.exact.com', 'wild.com',
+                     'a.wild.com', 'upper.com', 'www.upper.com', 'other.com', 'com']:
+            self.assertEqual(snapshot.match(host), index.match(host), host)
+        self.assertEqual(len(snapshot), 4)
+
+    def test_lookup_table(self):
+        write_snapshot(self.path, '1', table={
+            'example.com': ['video', 'image/*'], 'www.test.com': ['text/html']})
+        snapshot = PolicySnapshot(self.path)
+
+        self.assertEqual(snapshot.lookup('example.com'), ['video', 'image/*'])
+        self.assertEqual(snapshot.lookup('test.com'), ['text/html'])
+        self.assertIsNone(snapshot.lookup('other.com'))
+
+    def test_open_snapshot_rejects_stale_or_invalid_files(self):
+        self.assertIsNone(open_snapshot(self.path, '1'))
+        write_snapshot(self.path, '1', ['example.com'])
+        self.assertIsNotNone(open_snapshot(self.path, '1'))
+        self.assertIsNone(open_snapshot(self.path, '2'))
+
+        with open(self.path, 'wb') as f:
+            f.write(b'not a snapshot')
+        self.assertIsNone(open_snapshot(self.path, '1'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,110 @@
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+import os
+import sys
+sys.path.insert(0, os.path.abspath(
+    os.path.join(os.path.dirname(__file__), '..')))
+from benchmarks.fake_flow import FakeFlow
+from core.profiles import CidrTable, ProfileStore, validate_profile
+from core.singleton_pattern import Singleton
+from core.verdict_cache import PolicyGeneration
+from dal_db import DalDB
+from plugins.white_list_plugin import WhiteListPlugin
+
+KIDS = {'name': 'kids', 'networks': ['10.0.0.0/8'], 'users': [],
+        'approved_domains': ['school.org']}
+LAB = {'name': 'lab', 'networks': ['10.1.0.0/16', 'fd00::/64'], 'users': ['alice'],
+       'approved_domains': ['*.lab.net']}
+
+
+class TestCidrTable(unittest.TestCase):
+    def test_longest_prefix_wins(self):
+        table = CidrTable([('10.0.0.0/8', 'wide'), ('10.1.0.0/16', 'narrow'), ('10.1.2.3/32', 'host')])
+        self.assertEqual(table.lookup('10.9.9.9'), 'wide')
+        self.assertEqual(table.lookup('10.1.9.9'), 'narrow')
+        self.assertEqual(table.lookup('10.1.2.3'), 'host')
+        self.assertIsNone(table.lookup('192.168.1.1'))
+
+    def test_ipv6_and_mapped_ipv4(self):
+        table = CidrTable([('fd00::/64', 'v6'), ('10.0.0.0/8', 'v4')])
+        self.assertEqual(table.lookup('fd00::1'), 'v6')
+        self.assertIsNone(table.lookup('fd00:0:0:1::1'))
+        self.assertEqual(table.lookup('::ffff:10.0.0.1'), 'v4')
+
+    def test_invalid_address(self):
+        with self.assertRaises(ValueError):
+            CidrTable().lookup('not-an-ip')
+
+
+class TestProfileStore(unittest.TestCase):
+    def setUp(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        # Both are singletons, drop their instances so the store reads the temporary database
+        Singleton._instances.pop(DalDB, None)
+        self.addCleanup(Singleton._instances.pop, DalDB, None)
+        self.db = DalDB(os.path.join(tmp_dir, 'db.json'))
+        Singleton._instances.pop(ProfileStore, None)
+        self.addCleanup(Singleton._instances.pop, ProfileStore, None)
+        self.store = ProfileStore(self.db)
+        self.store.save(KIDS)
+        self.store.save(LAB)
+        self.store.reload()
+
+    def test_validate_profile(self):
+        self.assertIsNone(validate_profile(KIDS))
+        self.assertIsNotNone(validate_profile({'name': ''}))
+        self.assertIsNotNone(validate_profile({'name': 'x', 'networks': ['10.0.0.0/33']}))
+        self.assertIsNotNone(validate_profile({'name': 'x', 'approved_domains': ['a..com']}))
+        self.assertIsNotNone(validate_profile({'name': 'x', 'contents': {'a.com': 'text'}}))
+
+    def test_networks_refused_behind_relay(self):
+        with mock.patch('config.BEHIND_RELAY', True):
+            self.assertIsNotNone(validate_profile(KIDS))
+            self.assertIsNone(validate_profile({'name': 'x', 'users': ['alice']}))
+
+    def test_user_before_network(self):
+        self.assertEqual(self.store.resolve(FakeFlow('a.com', client_ip='10.2.0.1', connection_id=1)).name, 'kids')
+        self.assertEqual(self.store.resolve(FakeFlow('a.com', client_ip='10.1.0.1', connection_id=2)).name, 'lab')
+        self.assertEqual(self.store.resolve(
+            FakeFlow('a.com', client_ip='192.168.0.1', connection_id=3, proxy_user='alice')).name, 'lab')
+        self.assertIsNone(self.store.resolve(FakeFlow('a.com', client_ip='192.168.0.1', connection_id=4)))
+
+    def test_resolved_once_per_connection(self):
+        flow = FakeFlow('a.com', client_ip='10.2.0.1', connection_id=1)
+        self.assertEqual(self.store.resolve(flow).name, 'kids')
+        # The address is not looked up again for the same connection
+        flow.client_ip = '192.168.0.1'
+        self.assertEqual(self.store.resolve(flow).name, 'kids')
+        self.store.forget_connection(1)
+        self.assertIsNone(self.store.resolve(flow))
+
+    def test_reload_invalidates_connections(self):
+        flow = FakeFlow('a.com', client_ip='10.2.0.1', connection_id=1)
+        self.assertEqual(self.store.resolve(flow).name, 'kids')
+        generation = PolicyGeneration().value
+        self.assertTrue(self.store.delete('kids'))
+        self.assertTrue(self.store.reload())
+        self.assertGreater(PolicyGeneration().value, generation)
+        self.assertIsNone(self.store.resolve(flow))
+        self.assertFalse(self.store.reload())
+
+    def test_white_list_uses_the_profile_domains(self):
+        # A plugin of its own, the shared instance keeps the global store
+        plugin = WhiteListPlugin.__new__(WhiteListPlugin)
+        WhiteListPlugin.__init__(plugin)
+        plugin.snapshot_writer = None
+        plugin.approved_domains = ['example.com']
+
+        self.assertTrue(plugin.on_request(FakeFlow('example.com', client_ip='192.168.0.1', connection_id=1)))
+        kids_flow = FakeFlow('example.com', client_ip='10.2.0.1', connection_id=2)
+        self.assertFalse(plugin.on_request(kids_flow))
+        self.assertTrue(kids_flow.killed)
+        self.assertTrue(plugin.on_request(FakeFlow('www.school.org', client_ip='10.2.0.1', connection_id=2)))
+        self.assertTrue(plugin.on_request(FakeFlow('x.lab.net', proxy_user='alice', connection_id=3)))
+
+
+if __name__ == '__main__':
+    unittest.main()
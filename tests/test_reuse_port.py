@@ -0,0 +1,34 @@
+import asyncio
+import socket
+import unittest
+import os
+import sys
+sys.path.insert(0, os.path.abspath(
+    os.path.join(os.path.dirname(__file__), '..')))
+from core import reuse_port
+
+
+@unittest.skipUnless(reuse_port.is_supported(), "SO_REUSEPORT is not available")
+class TestReusePort(unittest.TestCase):
+    def setUp(self):
+        create_server = asyncio.base_events.BaseEventLoop.create_server
+        self.addCleanup(setattr, asyncio.base_events.BaseEventLoop, 'create_server', create_server)
+
+    def test_servers_share_the_port(self):
+        reuse_port.enable_reuse_port()
+        reuse_port.enable_reuse_port()
+
+        async def start_two_servers():
+            first = await asyncio.start_server(lambda reader, writer: None, '127.0.0.1', 0)
+            port = first.sockets[0].getsockname()[1]
+            second = await asyncio.start_server(lambda reader, writer: None, '127.0.0.1', port)
+            reuse = second.sockets[0].getsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT)
+            first.close()
+            second.close()
+            return reuse
+
+        self.assertTrue(asyncio.run(start_two_servers()))
+
+
+if __name__ == '__main__':
+    unittest.main()
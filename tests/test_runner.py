@@ -0,0 +1,115 @@
+import asyncio
+import threading
+import unittest
+from unittest.mock import AsyncMock, Mock, patch
+import os
+import sys
+sys.path.insert(0, os.path.abspath(
+    os.path.join(os.path.dirname(__file__), '..')))
+import config
+
+try:
+    from mitmproxy import http
+    from mitmproxy.test import tflow
+    from core.mitm_flow import MitmFlow
+    import runner
+except ImportError:  # The proxy's dependencies are not installed
+    runner = None
+
+
+def make_flow(content_length):
+    flow = tflow.tflow(resp=True)
+    flow.response.headers.pop('Content-Length', None)
+    if content_length is not None:
+        flow.response.headers['Content-Length'] = str(content_length)
+    return flow
+
+
+@unittest.skipIf(runner is None, "mitmproxy is not installed")
+class TestResponseStreaming(unittest.TestCase):
+    def setUp(self):
+        self.pipeline = Mock()
+        self.pipeline.on_response_headers = AsyncMock()
+        self.pipeline.on_response = AsyncMock()
+        patcher = patch.object(runner.plugin_management, 'response_pipeline', self.pipeline)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_is_large_response(self):
+        self.assertFalse(runner.is_large_response(make_flow(10).response))
+        self.assertTrue(runner.is_large_response(make_flow(config.STREAM_RESPONSE_MIN_BYTES).response))
+        # Chunked bodies are buffered for the plugins unless asked otherwise
+        self.assertFalse(runner.is_large_response(make_flow(None).response))
+        with patch.object(config, 'STREAM_UNKNOWN_LENGTH_RESPONSES', True):
+            self.assertTrue(runner.is_large_response(make_flow(None).response))
+
+    def test_stream_response(self):
+        flow = make_flow(10)
+        MitmFlow(flow).stream_response()
+        self.assertIs(flow.response.stream, True)
+
+    def test_discard_response_body_sends_the_replacement_once(self):
+        flow = make_flow(None)
+        flow.response = http.Response.make(403, b"blocked", {"Content-Type": "text/plain"})
+        MitmFlow(flow).discard_response_body()
+
+        self.assertEqual(flow.response.stream(b"upstream 1"), b"blocked")
+        self.assertEqual(flow.response.stream(b"upstream 2"), b"")
+
+    def test_small_and_chunked_responses_are_buffered(self):
+        for content_length in (10, None):
+            flow = make_flow(content_length)
+            asyncio.run(runner.Runner().responseheaders(flow))
+
+            self.assertFalse(flow.response.stream)
+            asyncio.run(runner.Runner().response(flow))
+        self.assertEqual(self.pipeline.on_response.await_count, 2)
+
+    def test_large_response_is_streamed(self):
+        flow = make_flow(config.STREAM_RESPONSE_MIN_BYTES)
+        asyncio.run(runner.Runner().responseheaders(flow))
+
+        self.pipeline.on_response_headers.assert_awaited_once()
+        self.assertIs(flow.response.stream, True)
+
+    def test_response_replaced_at_the_headers_skips_the_body(self):
+        def reject(mitm_flow):
+            mitm_flow.kill()
+        self.pipeline.on_response_headers.side_effect = reject
+        flow = make_flow(10)
+
+        asyncio.run(runner.Runner().responseheaders(flow))
+        asyncio.run(runner.Runner().response(flow))
+
+        self.assertEqual(flow.response.status_code, 403)
+        self.assertTrue(flow.metadata['safebrowse_rejected'])
+        self.assertTrue(callable(flow.response.stream))
+        self.pipeline.on_response.assert_not_awaited()
+
+
+
+@unittest.skipIf(runner is None, "mitmproxy is not installed")
+class TestWatchPolicy(unittest.TestCase):
+    def test_reload_runs_off_the_event_loop(self):
+        reload_threads = []
+
+        async def watch():
+            reloaded = asyncio.Event()
+            loop = asyncio.get_running_loop()
+
+            def reload_policy():
+                reload_threads.append(threading.current_thread())
+                loop.call_soon_threadsafe(reloaded.set)
+
+            with patch.object(config, 'POLICY_POLL_INTERVAL', 0), \
+                    patch.object(runner.plugin_management.db, 'refresh', return_value=True), \
+                    patch.object(runner.plugin_management, 'reload_policy', reload_policy):
+                watcher = asyncio.create_task(runner.watch_policy())
+                await asyncio.wait_for(reloaded.wait(), 5)
+                watcher.cancel()
+
+        asyncio.run(watch())
+        self.assertIsNot(reload_threads[0], threading.main_thread())
+
+if __name__ == '__main__':
+    unittest.main()
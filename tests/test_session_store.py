@@ -0,0 +1,100 @@
+import shutil
+import tempfile
+import unittest
+from unittest.mock import Mock, patch
+import os
+import sys
+sys.path.insert(0, os.path.abspath(
+    os.path.join(os.path.dirname(__file__), '..')))
+from core.session_store import SessionStore, token_key
+from core.singleton_pattern import Singleton
+from dal_db import DalDB
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+class TestSessionStore(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        time_patch = patch('core.session_store.time', self.clock)
+        time_patch.start()
+        self.addCleanup(time_patch.stop)
+        # Run the background database writes right away
+        executor_patch = patch('core.session_store.executor', Mock(submit=lambda func, *args: func(*args)))
+        executor_patch.start()
+        self.addCleanup(executor_patch.stop)
+
+    def open_db(self, tmp_dir):
+        # DalDB is a singleton, drop the instance to simulate a restart
+        Singleton._instances.pop(DalDB, None)
+        self.addCleanup(Singleton._instances.pop, DalDB, None)
+        return DalDB(os.path.join(tmp_dir, 'db.json'))
+
+    def test_sessions_are_per_login(self):
+        store = SessionStore(ttl=60, max_sessions=10)
+        alice = store.create('alice')
+        bob = store.create('bob')
+
+        self.assertNotEqual(alice, bob)
+        self.assertEqual(store.get(alice), 'alice')
+        self.assertEqual(store.get(bob), 'bob')
+        self.assertIsNone(store.get('forged'))
+        self.assertIsNone(store.get(None))
+
+        store.delete(alice)
+        self.assertIsNone(store.get(alice))
+
+    def test_expiry_slides_with_use(self):
+        store = SessionStore(ttl=60, max_sessions=10)
+        used = store.create('alice')
+        idle = store.create('bob')
+
+        self.clock.now += 50
+        self.assertEqual(store.get(used), 'alice')
+        self.clock.now += 50
+
+        self.assertEqual(store.get(used), 'alice')
+        self.assertIsNone(store.get(idle))
+        self.assertEqual(len(store), 1)
+
+    def test_store_is_bounded(self):
+        store = SessionStore(ttl=60, max_sessions=2)
+        first = store.create('a')
+        self.clock.now += 1
+        second = store.create('b')
+        self.clock.now += 1
+        # Using the first session makes the second one the closest to expiring
+        store.get(first)
+        third = store.create('c')
+
+        self.assertEqual(len(store), 2)
+        self.assertEqual([store.get(token) for token in (first, second, third)], ['a', None, 'c'])
+
+    def test_persisted_sessions_survive_a_restart(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        store = SessionStore(ttl=60, max_sessions=10, db=self.open_db(tmp_dir))
+        token = store.create('alice')
+        expired = store.create('bob')
+        self.clock.now += 30
+        store.get(token)
+        self.clock.now += 40
+
+        db = self.open_db(tmp_dir)
+        # Only the hash of the token is stored
+        self.assertEqual([row['token'] for row in db.fetch_all('sessions')], [token_key(token), token_key(expired)])
+        restarted = SessionStore(ttl=60, max_sessions=10, db=db)
+
+        self.assertEqual(restarted.get(token), 'alice')
+        self.assertIsNone(restarted.get(expired))
+        self.assertEqual(len(db.fetch_all('sessions')), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,4 +1,9 @@
 from plugins.settings_plugin import SettingsPlugin
+from core.admin_router import AdminRouter
+from core.static_assets import StaticAssets
+import asyncio
+import gzip
+import tempfile
 import unittest
 from unittest.mock import Mock, patch
 import os
@@ -12,37 +17,83 @@ class TestSettingsPlugin(unittest.TestCase):
     def setUp(self):
         # The singleton instance of SettingsPlugin
         self.plugin = SettingsPlugin()
+        # Serve the files of a temporary build directory, checked for changes on every request
+        self.assets_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.assets_dir.cleanup)
+        self.plugin.assets = StaticAssets(self.assets_dir.name, check_interval=0)
         # A mock for IFlow
         self.mock_flow = Mock()
 
-    def test_onRequest_valid_host(self):
-        # Setup the mock to simulate a request to 'settings.it'
-        self.mock_flow.get_host.return_value = 'settings.it'
-        # Mock the get_request method to return a request object with path set to 'index.html'
-        self.mock_flow.get_request.return_value.path = 'index.html'
+    def test_router_serves_static_file(self):
+        # Mock the get_request method to return a request object with path set to '/index.html'
+        self.mock_flow.get_request.return_value.path = '/index.html'
+        self.mock_flow.get_request.return_value.method = 'GET'
+        router = AdminRouter()
+        self.plugin.register_routes(router)
 
-        with patch.object(self.plugin, 'serve_files') as mock_serve_files:
-            self.plugin.on_request(self.mock_flow)
+        with patch.object(self.plugin, '_serve_files') as mock_serve_files:
+            asyncio.run(router.dispatch(self.mock_flow))
             mock_serve_files.assert_called_once_with(
                 self.mock_flow, 'index.html')
 
+    def serve(self, path, **headers):
+        self.mock_flow.make_response.reset_mock()
+        self.mock_flow.get_request.return_value.headers = headers
+        self.plugin._serve_files(self.mock_flow, path)
+        self.mock_flow.make_response.assert_called_once()
+        return self.mock_flow.make_response.call_args[0]
+
+    def write_asset(self, name, content):
+        path = os.path.join(self.assets_dir.name, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(content)
+
     def test_serve_files_existing_file(self):
-        # Mock os.path.exists to return True for existing file
-        with patch('os.path.exists', return_value=True), \
-                patch('builtins.open', unittest.mock.mock_open(read_data='data')), \
-                patch('os.path.join', return_value="path/to/an/existing/file"):
-            self.plugin._serve_files(self.mock_flow, 'index.html')
-            # Check response was made with correct status and content-type
-            self.mock_flow.make_response.assert_called_once_with(
-                200, 'data', {'Content-Type': 'text/html'})
+        self.write_asset('index.html', b'data')
+
+        status, content, headers = self.serve('index.html')
+
+        self.assertEqual((status, content), (200, b'data'))
+        self.assertEqual(headers['Content-Type'], 'text/html; charset=utf-8')
+        self.assertEqual(headers['Cache-Control'], 'no-cache')
+        self.assertIn('ETag', headers)
+        self.assertIn('Last-Modified', headers)
 
     def test_serve_files_non_existing_file(self):
-        # Setup non-existing file scenario
-        self.mock_flow.make_response.reset_mock()
-        with patch('os.path.exists', return_value=False):
-            self.plugin._serve_files(self.mock_flow, 'nonexistent.html')
-            self.mock_flow.make_response.assert_called_once_with(
-                404, b"File not found!", {"Content-Type": "text/plain"})
+        self.assertEqual(self.serve('nonexistent.html'), (404, b"File not found!", {"Content-Type": "text/plain"}))
+        # Paths outside the build directory are not served
+        self.assertEqual(self.serve('../settings_plugin.py')[0], 404)
+
+    def test_conditional_request_gets_304(self):
+        self.write_asset('index.html', b'data')
+        etag = self.serve('index.html')[2]['ETag']
+
+        status, content, headers = self.serve('index.html', **{'If-None-Match': etag})
+        self.assertEqual((status, content, headers['ETag']), (304, b'', etag))
+
+        last_modified = headers['Last-Modified']
+        self.assertEqual(self.serve('index.html', **{'If-Modified-Since': last_modified})[0], 304)
+        self.assertEqual(self.serve('index.html', **{'If-None-Match': '"other"'})[0], 200)
+
+    def test_compressed_variant_is_chosen_by_accept_encoding(self):
+        bundle = b'console.log("settings");\n' * 100
+        self.write_asset('static/js/main.1a2b3c4d.js', bundle)
+
+        status, content, headers = self.serve('static/js/main.1a2b3c4d.js', **{'Accept-Encoding': 'gzip, deflate'})
+
+        self.assertEqual(headers['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(content), bundle)
+        self.assertEqual(headers['Vary'], 'Accept-Encoding')
+        self.assertEqual(headers['Cache-Control'], 'public, max-age=31536000, immutable')
+        self.assertEqual(self.serve('static/js/main.1a2b3c4d.js', **{'Accept-Encoding': 'gzip;q=0'})[1], bundle)
+
+    def test_changed_file_is_reloaded(self):
+        self.write_asset('index.html', b'old')
+        self.serve('index.html')
+        self.write_asset('index.html', b'new version')
+
+        self.assertEqual(self.serve('index.html')[1], b'new version')
 
 
 # This allows running the tests from the command line
@@ -0,0 +1,107 @@
+import asyncio
+import unittest
+from unittest.mock import Mock, patch
+import os
+import sys
+sys.path.insert(0, os.path.abspath(
+    os.path.join(os.path.dirname(__file__), '..')))
+import supervisor
+from supervisor import Supervisor
+
+SLEEPING_WORKER = [sys.executable, '-c', 'import time; time.sleep(30)']
+
+
+def make_supervisor(workers_count, relay_mode=True):
+    return Supervisor('127.0.0.1', 0, workers_count, 0, 'mitmdump', [], relay_mode)
+
+
+def set_alive(worker, alive=True):
+    worker.process = Mock(returncode=None if alive else 1)
+
+
+class TestPickWorker(unittest.TestCase):
+    def setUp(self):
+        self.supervisor = make_supervisor(3)
+        for worker in self.supervisor.workers:
+            set_alive(worker)
+
+    def test_fewest_connections(self):
+        first, second, third = self.supervisor.workers
+        first.connections, second.connections, third.connections = 2, 0, 1
+        self.assertIs(self.supervisor.pick_worker(), second)
+        self.assertIs(self.supervisor.pick_worker(), second)
+
+    def test_ties_are_broken_round_robin(self):
+        picked = [self.supervisor.pick_worker().index for _ in range(4)]
+        self.assertEqual(picked, [0, 1, 2, 0])
+
+    def test_dead_workers_are_skipped(self):
+        first, second, third = self.supervisor.workers
+        set_alive(first, False)
+        first.connections, second.connections, third.connections = 0, 5, 3
+        self.assertIs(self.supervisor.pick_worker(), third)
+
+        for worker in self.supervisor.workers:
+            set_alive(worker, False)
+        self.assertIsNone(self.supervisor.pick_worker())
+
+
+class TestSupervisor(unittest.TestCase):
+    def test_relays_to_the_least_loaded_worker(self):
+        async def relay_one():
+            async def echo(reader, writer):
+                writer.write(await reader.read())
+                await writer.drain()
+                writer.close()
+
+            # One fake worker answering on a loopback port, the other one busy
+            echo_server = await asyncio.start_server(echo, '127.0.0.1', 0)
+            sup = make_supervisor(2)
+            busy, idle = sup.workers
+            for worker in sup.workers:
+                set_alive(worker)
+            busy.connections = 1
+            idle.port = echo_server.sockets[0].getsockname()[1]
+
+            relay_server = await asyncio.start_server(sup.handle_client, '127.0.0.1', 0)
+            reader, writer = await asyncio.open_connection(
+                '127.0.0.1', relay_server.sockets[0].getsockname()[1])
+            writer.write(b'ping')
+            writer.write_eof()
+            answer = await asyncio.wait_for(reader.read(), 5)
+            writer.close()
+            relay_server.close()
+            echo_server.close()
+            return answer, idle.connections
+
+        answer, connections = asyncio.run(relay_one())
+        self.assertEqual(answer, b'ping')
+        self.assertEqual(connections, 0)
+
+    @patch.object(supervisor, 'WORKER_CHECK_INTERVAL', 0.01)
+    def test_dead_worker_is_restarted(self):
+        async def restart():
+            sup = make_supervisor(1, relay_mode=False)
+            worker = sup.workers[0]
+            worker.command = SLEEPING_WORKER
+            await worker.start()
+            first_process = worker.process
+            worker.stop()
+            await first_process.wait()
+
+            watcher = asyncio.create_task(sup.watch_workers())
+            try:
+                while worker.process is first_process:
+                    await asyncio.sleep(0.01)
+                restarted = worker.is_alive()
+            finally:
+                sup.stop()
+                watcher.cancel()
+                await worker.process.wait()
+            return restarted
+
+        self.assertTrue(asyncio.run(asyncio.wait_for(restart(), 10)))
+
+
+if __name__ == '__main__':
+    unittest.main()
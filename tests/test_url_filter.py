@@ -0,0 +1,130 @@
+import asyncio
+import json
+import shutil
+import tempfile
+import unittest
+from unittest.mock import Mock
+import os
+import sys
+sys.path.insert(0, os.path.abspath(
+    os.path.join(os.path.dirname(__file__), '..')))
+from benchmarks.fake_flow import FakeFlow
+from core.aho_corasick import AhoCorasick
+from core.singleton_pattern import Singleton
+from dal_db import DalDB
+from plugins.url_filter import DomainRules, UrlFilter, validate_url_rule
+
+HTTP_OK = 200
+HTTP_BAD_REQUEST = 400
+
+
+class TestAhoCorasick(unittest.TestCase):
+    def test_finds_overlapping_matches(self):
+        automaton = AhoCorasick([('he', 1), ('she', 2), ('his', 3), ('hers', 4)])
+        self.assertEqual(list(automaton.iter_matches('ushers')),
+                         [(1, 4, 2), (2, 4, 1), (2, 6, 4)])
+
+    def test_shared_strings(self):
+        automaton = AhoCorasick([('ab', 'x'), ('ab', 'y')])
+        self.assertEqual([value for _, _, value in automaton.iter_matches('cab')], ['x', 'y'])
+
+    def test_empty_string(self):
+        with self.assertRaises(ValueError):
+            AhoCorasick([('', 1)])
+
+
+class TestDomainRules(unittest.TestCase):
+    def test_allow_only_listed_paths(self):
+        rules = DomainRules([('/edu/*', 'allow'), ('/', 'allow')])
+        self.assertTrue(rules.allows('/edu/physics?t=10'))
+        self.assertTrue(rules.allows('/'))
+        self.assertFalse(rules.allows('/watch?v=1'))
+        self.assertFalse(rules.allows('/x/edu/'))
+
+    def test_block_wins(self):
+        rules = DomainRules([('/edu/*', 'allow'), ('*ads*', 'block'), ('*.MP4', 'block')])
+        self.assertFalse(rules.allows('/edu/ads/1'))
+        self.assertFalse(rules.allows('/edu/clip.mp4'))
+        self.assertTrue(rules.allows('/edu/clip.mp4?x=1'))
+
+    def test_block_only_passes_the_rest(self):
+        rules = DomainRules([('/watch*list=*', 'block')])
+        self.assertFalse(rules.allows('/watch?v=1&list=2'))
+        self.assertTrue(rules.allows('/watch?v=1'))
+
+    def test_inner_wildcard_allow(self):
+        rules = DomainRules([('/u/*/public/*', 'allow')])
+        self.assertTrue(rules.allows('/u/bob/public/a'))
+        self.assertFalse(rules.allows('/u/bob/private/a'))
+
+    def test_validate_url_rule(self):
+        self.assertIsNone(validate_url_rule({'domain': 'a.com', 'pattern': '/x/*', 'action': 'allow'}))
+        self.assertIsNotNone(validate_url_rule({'domain': 'a.com', 'pattern': 'x', 'action': 'allow'}))
+        self.assertIsNotNone(validate_url_rule({'domain': 'a.com', 'pattern': '/x', 'action': 'skip'}))
+        self.assertIsNotNone(validate_url_rule({'domain': 'a..com', 'pattern': '/x', 'action': 'block'}))
+        # Exact-only and subdomains-only domains are refused, a domain's rules apply to its whole subtree
+        self.assertIsNotNone(validate_url_rule({'domain': '=a.com', 'pattern': '/x', 'action': 'block'}))
+        self.assertIsNotNone(validate_url_rule({'domain': '*.a.com', 'pattern': '/x', 'action': 'block'}))
+
+
+class TestUrlFilter(unittest.TestCase):
+    def setUp(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        Singleton._instances.pop(DalDB, None)
+        self.addCleanup(Singleton._instances.pop, DalDB, None)
+        self.db = DalDB(os.path.join(tmp_dir, 'db.json'))
+        # A plugin of its own, reading the temporary database
+        self.plugin = UrlFilter.__new__(UrlFilter)
+        UrlFilter.__init__(self.plugin)
+
+    def send(self, handler, body):
+        flow = Mock()
+        flow.get_request.return_value.content = json.dumps(body).encode()
+        asyncio.run(handler(flow))
+        return flow.make_response.call_args[0][0]
+
+    def test_rules_edited_through_the_api(self):
+        self.assertEqual(self.send(self.plugin._handle_post,
+                                   {'domain': 'youtube.com', 'pattern': '/edu/*', 'action': 'allow'}), HTTP_OK)
+        self.assertTrue(self.plugin.on_request(FakeFlow('www.youtube.com', '/edu/math')))
+        self.assertFalse(self.plugin.on_request(FakeFlow('www.youtube.com', '/watch?v=1')))
+        self.assertTrue(self.plugin.on_request(FakeFlow('example.com', '/watch?v=1')))
+
+        self.assertEqual(self.send(self.plugin._handle_delete,
+                                   {'domain': 'youtube.com', 'pattern': '/edu/*'}), HTTP_OK)
+        self.assertTrue(self.plugin.on_request(FakeFlow('www.youtube.com', '/watch?v=1')))
+        self.assertEqual(self.db.fetch_all('url_rules'), [])
+        self.assertEqual(self.send(self.plugin._handle_delete,
+                                   {'domain': 'youtube.com', 'pattern': '/edu/*'}), HTTP_BAD_REQUEST)
+
+    def test_dot_segments_do_not_escape_an_allowed_path(self):
+        self.send(self.plugin._handle_post, {'domain': 'youtube.com', 'pattern': '/edu/*', 'action': 'allow'})
+        self.assertFalse(self.plugin.on_request(FakeFlow('youtube.com', '/edu/../watch?v=1')))
+        self.assertFalse(self.plugin.on_request(FakeFlow('youtube.com', '/edu/%2e%2e/watch')))
+        self.assertTrue(self.plugin.on_request(FakeFlow('youtube.com', '/edu/./math/%61lgebra?q=../x')))
+
+    def test_post_replaces_the_action_of_a_pattern(self):
+        self.send(self.plugin._handle_post, {'domain': 'a.com', 'pattern': '/x*', 'action': 'allow'})
+        self.send(self.plugin._handle_post, {'domain': 'a.com', 'pattern': '/x*', 'action': 'block'})
+        self.assertEqual([rule['action'] for rule in self.db.fetch_all('url_rules')], ['block'])
+        self.assertFalse(self.plugin.on_request(FakeFlow('a.com', '/x')))
+
+    def test_post_invalid_rule(self):
+        self.assertEqual(self.send(self.plugin._handle_post,
+                                   {'domain': 'a.com', 'pattern': 'x', 'action': 'allow'}), HTTP_BAD_REQUEST)
+
+    def test_reload_only_when_the_table_changed(self):
+        self.send(self.plugin._handle_post, {'domain': 'a.com', 'pattern': '/x*', 'action': 'block'})
+        compiled_rules = self.plugin.compiled_rules
+        self.plugin.reload_policy()
+        self.assertIs(self.plugin.compiled_rules, compiled_rules)
+
+        self.db.insert('url_rules', {'domain': 'b.com', 'pattern': '/y', 'action': 'block'})
+        self.plugin.reload_policy()
+        self.assertIsNot(self.plugin.compiled_rules, compiled_rules)
+        self.assertFalse(self.plugin.on_request(FakeFlow('b.com', '/y')))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,7 +1,12 @@
 from plugins.white_list_plugin import WhiteListPlugin
+from core.admin_router import AdminRouter
+from core.policy_snapshot import PolicySnapshot, SnapshotWriter
+import asyncio
 import json
+import shutil
+import tempfile
 import unittest
-from unittest.mock import Mock, patch
+from unittest.mock import MagicMock, Mock, patch
 import os
 import sys
 sys.path.insert(0, os.path.abspath(
@@ -17,34 +22,36 @@ class TestWhiteListPlugin(unittest.TestCase):
     def setUp(self):
         self.plugin = WhiteListPlugin()
         self.mock_flow = Mock()
-        self.plugin.db = Mock()
+        self.plugin.db = MagicMock()
+        # Snapshots are only written by the tests that check them
+        self.plugin.snapshot_writer = None
         self.plugin.approved_domains = ["example.com", "test.com"]
 
     ### tests onRequest function ###
-    def test_on_request_with_approved_host_and_specific_path(self):
-        self.mock_flow.get_host.return_value = "www.settings.it"
+    def test_register_routes(self):
         self.mock_flow.get_request.return_value.path = "/api/approved-domains"
+        self.mock_flow.get_request.return_value.method = "GET"
 
-        # Mocking handle_request to chek if called
-        self.plugin._handle_request = Mock()
+        with patch.object(self.plugin, '_handle_get') as mock_handle_get:
+            router = AdminRouter()
+            self.plugin.register_routes(router)
+            result = asyncio.run(router.dispatch(self.mock_flow))
 
-        result = self.plugin.on_request(self.mock_flow)
-
-        self.plugin._handle_request.assert_called_once()
+        mock_handle_get.assert_called_once_with(self.mock_flow)
         self.assertTrue(
-            result, "onRequest should return True when host and path are correct")
+            result, "The router should handle the approved domains path")
 
-    def test_on_request_with_unapproved_host_name(self):
-        self.mock_flow.get_host.return_value = "www.settings.it"
+    def test_router_ignores_other_path(self):
+        router = AdminRouter()
+        self.plugin.register_routes(router)
         self.mock_flow.get_request.return_value.path = "/not/interesting/path"
+        self.mock_flow.get_request.return_value.method = "GET"
 
-        self.plugin._handle_request = Mock()
-
-        result = self.plugin.on_request(self.mock_flow)
+        result = asyncio.run(router.dispatch(self.mock_flow))
 
-        self.plugin._handle_request.assert_not_called()
-        self.assertTrue(
-            result, "onRequest should still return True for handled host regardless of path")
+        self.mock_flow.make_response.assert_not_called()
+        self.assertFalse(
+            result, "The router should not handle paths without a route")
 
     def test_on_request_with_unapproved_domain(self):
         self.mock_flow.get_host.return_value = "unapproved.domain.com"
@@ -56,6 +63,44 @@ class TestWhiteListPlugin(unittest.TestCase):
         self.assertFalse(
             result, "onRequest should return False and kill the flow for unapproved domains")
 
+    def test_on_request_with_approved_subdomain(self):
+        self.mock_flow.get_host.return_value = "www.mail.example.com"
+
+        result = self.plugin.on_request(self.mock_flow)
+
+        self.mock_flow.kill.assert_not_called()
+        self.assertTrue(
+            result, "onRequest should return True for subdomains of an approved domain")
+
+    def test_on_request_does_not_match_substring(self):
+        self.mock_flow.get_host.return_value = "notexample.com"
+
+        result = self.plugin.on_request(self.mock_flow)
+
+        self.mock_flow.kill.assert_called_once()
+        self.assertFalse(result)
+
+    def test_on_request_with_exact_and_wildcard_rules(self):
+        self.plugin.approved_domains = ["=exact.com", "*.wild.com"]
+
+        for host, allowed in [("exact.com", True), ("sub.exact.com", False),
+                              ("a.b.wild.com", True), ("wild.com", False)]:
+            self.mock_flow.reset_mock()
+            self.mock_flow.get_host.return_value = host
+            self.assertEqual(self.plugin.on_request(self.mock_flow), allowed, host)
+
+    def test_on_request_cached_verdict_dropped_after_post(self):
+        self.mock_flow.get_host.return_value = "newdomain.com"
+        self.assertFalse(self.plugin.on_request(self.mock_flow))
+        self.assertFalse(self.plugin.on_request(self.mock_flow))
+        self.assertGreaterEqual(self.plugin.verdict_cache.hits, 1)
+
+        self.mock_flow.get_request.return_value.content.decode.return_value = json.dumps({
+                                                                                         "domain": "newdomain.com"})
+        asyncio.run(self.plugin._handle_post(self.mock_flow))
+
+        self.assertTrue(self.plugin.on_request(self.mock_flow))
+
     ### test for handle_get method ###
     def test_handle_get(self):
         self.plugin._handle_get(self.mock_flow)
@@ -70,7 +115,7 @@ class TestWhiteListPlugin(unittest.TestCase):
         self.mock_flow.get_request.return_value.content.decode.return_value = json.dumps({
         })
 
-        self.plugin._handle_post(self.mock_flow)
+        asyncio.run(self.plugin._handle_post(self.mock_flow))
 
         self.mock_flow.make_response.assert_called_once_with(
             HTTP_BAD_REQUEST, "Bad Request: Missing domain", {
@@ -81,7 +126,7 @@ class TestWhiteListPlugin(unittest.TestCase):
         self.mock_flow.get_request.return_value.content.decode.return_value = json.dumps({
                                                                                          "domain": "example.com"})
 
-        self.plugin._handle_post(self.mock_flow)
+        asyncio.run(self.plugin._handle_post(self.mock_flow))
 
         self.mock_flow.make_response.assert_called_once_with(
             HTTP_BAD_REQUEST, "Domain already exists", {
@@ -95,7 +140,7 @@ class TestWhiteListPlugin(unittest.TestCase):
         self.plugin.db.fetch_all.return_value = [
             {"domain": d} for d in self.plugin.approved_domains + [new_domain]]
 
-        self.plugin._handle_post(self.mock_flow)
+        asyncio.run(self.plugin._handle_post(self.mock_flow))
 
         self.plugin.db.insert.assert_called_once_with(
             'approved_domains', {'domain': new_domain})
@@ -104,6 +149,30 @@ class TestWhiteListPlugin(unittest.TestCase):
                 "Content-Type": CONTENT_TYPE_TEXT}
         )
         self.assertIn(new_domain, self.plugin.approved_domains)
+        self.assertTrue(self.plugin.domain_index.match("www." + new_domain))
+
+    def test_handle_post_with_reload_during_the_write(self):
+        new_domain = "newdomain.com"
+        self.mock_flow.get_request.return_value.content.decode.return_value = json.dumps({
+                                                                                         "domain": new_domain})
+        self.plugin.db.fetch_all.return_value = [
+            {"domain": d} for d in self.plugin.approved_domains + [new_domain]]
+        # Another worker's change is picked up while the handler awaits its write
+        self.plugin.db.insert.side_effect = lambda *args: self.plugin.reload_policy()
+
+        asyncio.run(self.plugin._handle_post(self.mock_flow))
+
+        self.assertEqual(self.plugin.approved_domains, ["example.com", "test.com", new_domain])
+        self.assertTrue(self.plugin.domain_index.match("www." + new_domain))
+
+    def test_handle_delete_profile_with_invalid_body(self):
+        for body in (b"not json", b"[]", b'{"name": 1}'):
+            self.mock_flow.reset_mock()
+            self.mock_flow.get_request.return_value.content = body
+
+            asyncio.run(self.plugin._handle_delete_profile(self.mock_flow))
+
+            self.assertEqual(self.mock_flow.make_response.call_args[0][0], HTTP_BAD_REQUEST)
 
     ### tests for handle_delete method ###
     def test_handle_delete_with_existing_domain(self):
@@ -113,7 +182,7 @@ class TestWhiteListPlugin(unittest.TestCase):
         self.plugin.db.fetch_all.return_value = [
             {"domain": d} for d in ["test.com"]]
 
-        self.plugin._handle_delete(self.mock_flow)
+        asyncio.run(self.plugin._handle_delete(self.mock_flow))
 
         self.plugin.db.remove.assert_called_once_with(
             'approved_domains', 'domain', domain_to_remove)
@@ -123,13 +192,14 @@ class TestWhiteListPlugin(unittest.TestCase):
         )
         self.assertNotIn(domain_to_remove, self.plugin.approved_domains)
         self.assertIn("test.com", self.plugin.approved_domains)
+        self.assertFalse(self.plugin.domain_index.match(domain_to_remove))
 
     def test_handle_delete_with_non_existing_domain(self):
         domain_to_remove = "nonexistent.com"
         self.mock_flow.get_request.return_value.content.decode.return_value = json.dumps(
             {"domain": domain_to_remove})
 
-        self.plugin._handle_delete(self.mock_flow)
+        asyncio.run(self.plugin._handle_delete(self.mock_flow))
 
         self.plugin.db.remove.assert_not_called()
         self.mock_flow.make_response.assert_called_once_with(
@@ -137,6 +207,96 @@ class TestWhiteListPlugin(unittest.TestCase):
                 "Content-Type": CONTENT_TYPE_JSON}
         )
 
+    ### tests for reloading and snapshots ###
+    def test_reload_policy_picks_up_database_changes(self):
+        self.plugin.db.fetch_all.return_value = [{'domain': 'new.com'}]
+
+        self.plugin.reload_policy()
+
+        self.assertEqual(self.plugin.approved_domains, ['new.com'])
+        self.assertTrue(self.plugin.domain_index.match('new.com'))
+        self.assertFalse(self.plugin.domain_index.match('example.com'))
+
+    def test_reload_policy_skips_invalid_stored_domains(self):
+        self.plugin.db.fetch_all.return_value = [{'domain': '.com'}, {'domain': 'new.com'}]
+
+        self.plugin.reload_policy()
+
+        self.assertEqual(self.plugin.approved_domains, ['.com', 'new.com'])
+        self.assertTrue(self.plugin.domain_index.match('new.com'))
+        self.assertFalse(self.plugin.domain_index.match('example.com'))
+
+        # The invalid domain can still be removed from the list
+        self.mock_flow.get_request.return_value.content.decode.return_value = json.dumps({"domain": ".com"})
+        asyncio.run(self.plugin._handle_delete(self.mock_flow))
+
+        self.plugin.db.remove.assert_called_once_with('approved_domains', 'domain', '.com')
+        self.assertEqual(self.plugin.approved_domains, ['new.com'])
+
+    def test_maps_snapshot_and_edits_in_memory(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        self.plugin.db.version.return_value = '1'
+        self.plugin.snapshot_writer = SnapshotWriter(
+            os.path.join(tmp_dir, 'white_list.snapshot'), self.plugin._build_snapshot, self.plugin._map_snapshot)
+        self.plugin.db.fetch_all.return_value = [{'domain': 'example.com'}, {'domain': '*.test.com'}]
+        self.plugin.reload_policy()
+        self.plugin.snapshot_writer.wait()
+
+        # The snapshot replaces the in-memory list and index while it is up to date
+        self.assertIsInstance(self.plugin.domain_index, PolicySnapshot)
+        self.assertTrue(self.plugin.domain_index.match('www.example.com'))
+        self.assertTrue(self.plugin.domain_index.match('a.test.com'))
+        self.assertFalse(self.plugin.domain_index.match('test.com'))
+
+        # A change goes back to the in-memory index until the new snapshot is written
+        self.plugin.db.version.return_value = '2'
+        self.plugin.db.fetch_all.return_value = [
+            {'domain': 'example.com'}, {'domain': '*.test.com'}]
+        self.mock_flow.get_request.return_value.content = json.dumps(
+            {'domain': 'new.com'}).encode()
+        asyncio.run(self.plugin._handle_post(self.mock_flow))
+
+        self.assertTrue(self.plugin.domain_index.match('new.com'))
+        self.plugin.snapshot_writer.wait()
+        self.assertIsInstance(self.plugin.domain_index, PolicySnapshot)
+        self.assertTrue(self.plugin.domain_index.match('new.com'))
+
+    def test_snapshot_takes_the_version_the_list_was_updated_at(self):
+        self.plugin.db.version.return_value = '1'
+        self.plugin.db.fetch_all.return_value = [{'domain': 'example.com'}]
+        self.plugin.reload_policy()
+
+        # A write the list doesn't have yet has moved the table on
+        self.plugin.db.version.return_value = '2'
+        self.assertEqual(self.plugin._build_snapshot(), ('1', ['example.com'], None))
+
+    ### tests for bulk import and export ###
+    def test_handle_import_deduplicates_and_writes_one_batch(self):
+        self.plugin.db = MagicMock()
+        self.mock_flow.get_request.return_value.content = (
+            b"# blocklist\n0.0.0.0 new.com other.com\ndomain,comment\n"
+            b"csv.com,from csv\nexample.com\nnew.com\nbad..com\n")
+
+        asyncio.run(self.plugin._handle_import(self.mock_flow))
+
+        self.plugin.db.transaction.assert_called_once()
+        self.assertEqual(self.plugin.db.insert.call_count, 3)
+        self.mock_flow.make_response.assert_called_once_with(
+            HTTP_OK, json.dumps({'added': 3, 'duplicates': 2, 'invalid': 1}), {
+                "Content-Type": CONTENT_TYPE_JSON}
+        )
+        self.assertEqual(self.plugin.approved_domains, [
+                         "example.com", "test.com", "new.com", "other.com", "csv.com"])
+        self.assertTrue(self.plugin.domain_index.match("www.csv.com"))
+
+    def test_handle_export(self):
+        self.plugin._handle_export(self.mock_flow)
+
+        status, content, headers = self.mock_flow.make_response.call_args[0]
+        self.assertEqual(status, HTTP_OK)
+        self.assertEqual(content, b"example.com\ntest.com\n")
+
 
 if __name__ == '__main__':
     unittest.main()